@@ -0,0 +1,203 @@
+###############################################################################
+###
+### batch.py - Validate a batch of spreadsheets against some metadata.
+###
+###  gov.uk Metadata Standards are a way to increase the interoperability of
+###  spreadsheets between government departments.
+###
+###  batch.py parses a metadata file once and then validates and extracts
+###  every spreadsheet in a directory, or that matches a glob, in parallel
+###  using a pool of worker processes.
+###
+###  Usage: python batch.py [--workers N] [--chunksize N] [--check] [--formulas]
+###                         [--cache DIRECTORY] metadata.slang directory-or-glob...
+###
+###  One line of JSON is written to stdout for each spreadsheet as soon as it
+###  has been dealt with, so the results arrive in completion order rather
+###  than in the order of the files.
+###
+###
+###  Copyright (C) 2019, Andy Bennett, Crown Copyright (Government Digital Service).
+###
+###  Permission is hereby granted, free of charge, to any person obtaining a
+###  copy of this software and associated documentation files (the "Software"),
+###  to deal in the Software without restriction, including without limitation
+###  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+###  and#or sell copies of the Software, and to permit persons to whom the
+###  Software is furnished to do so, subject to the following conditions:
+###
+###  The above copyright notice and this permission notice shall be included in
+###  all copies or substantial portions of the Software.
+###
+###  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+###  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+###  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+###  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+###  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+###  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+###  DEALINGS IN THE SOFTWARE.
+###
+### Andy Bennett <andyjpb@digital.cabinet-office.gov.uk>, 2019/03/19
+###
+###############################################################################
+
+
+from   __future__ import print_function
+import sys
+import os
+import glob
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import slang
+
+################################################################################
+# Configuration
+
+EXTENSIONS = (".ods", ".xlsx")
+
+# How many errors to report for each spreadsheet.
+MAX_ERRORS = 100
+
+
+
+################################################################################
+# Worker processes
+
+# The parsed metadata, whether to only check the spreadsheets rather than
+# extract them, whether to verify their formulae as well and the ResultCache,
+# if any, that remembers what we found. Each worker gets its own copy when it
+# starts.
+metadata        = None
+check_only      = False
+verify_formulas = False
+results         = None
+
+def init_worker(state, check, formulas, cache):
+    global metadata, check_only, verify_formulas, results
+    metadata        = state
+    check_only      = check
+    verify_formulas = formulas
+    results         = slang.ResultCache(cache) if cache != None else None
+
+
+# Validate and extract a single spreadsheet and return a dictionary that
+# describes the result. Anything that goes wrong is reported in the result
+# rather than raised so that one bad file doesn't stop the batch.
+def process(path):
+
+    result = {
+            "file"    : path,
+            "valid"   : False,
+            "rows"    : 0,
+            "errors"  : [],
+            }
+
+    start = time.time()
+
+    try:
+        instance = slang.instance(metadata, open(path, "rb"), results = results)
+
+        # Checking stops reading as soon as there are more errors than we
+        # would report so we don't know how many more there are.
+        if check_only:
+            instance.check(MAX_ERRORS + 1)
+        else:
+            instance.extract_columns()
+
+        # Formulae can only be verified once the header has been read
+        # successfully.
+        errors = instance.errors
+        if verify_formulas and (instance.plan != None) and (len(errors) <= MAX_ERRORS):
+            errors = errors + instance.verify_formulas()
+
+        result["rows"]   = instance.metadata.data.height
+        result["errors"] = [str(error) for error in errors[:MAX_ERRORS]]
+        result["valid"]  = (len(errors) == 0)
+
+        if len(errors) > MAX_ERRORS:
+            if check_only:
+                result["errors"].append("...and more.")
+            else:
+                result["errors"].append("...and %d more." % (len(errors) - MAX_ERRORS))
+
+    except Exception as e:
+        result["errors"] = ["%s: %s" % (type(e).__name__, e)]
+        result["traceback"] = traceback.format_exc()
+
+    result["seconds"] = time.time() - start
+
+    return result
+
+
+
+################################################################################
+# Main program logic
+
+# Returns a sorted list of the spreadsheets named by the directories and globs
+# in patterns.
+def find_spreadsheets(patterns):
+
+    paths = []
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for name in os.listdir(pattern):
+                if name.endswith(EXTENSIONS):
+                    paths.append(os.path.join(pattern, name))
+        else:
+            paths.extend(glob.glob(pattern))
+
+    return sorted(set(paths))
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description = "Validate a batch of spreadsheets against some metadata.")
+    parser.add_argument("metadata",    help = "the .slang file that describes the spreadsheets")
+    parser.add_argument("patterns",    help = "directories or globs that name the spreadsheets", nargs = "+")
+    parser.add_argument("--workers",   help = "number of worker processes (default: one per CPU)", type = int, default = multiprocessing.cpu_count())
+    parser.add_argument("--chunksize", help = "number of spreadsheets to hand to a worker at a time", type = int, default = 1)
+    parser.add_argument("--check",     help = "only check the spreadsheets, without extracting their data", action = "store_true")
+    parser.add_argument("--formulas",  help = "also check the values of formulae against their inputs", action = "store_true")
+    parser.add_argument("--cache",     help = "directory in which to keep the results so that unchanged spreadsheets are not read again")
+    args = parser.parse_args(argv)
+
+    print("Reading metadata from %s..." % args.metadata, file = sys.stderr)
+    metadata = slang.load(args.metadata)
+    state    = metadata.metadata()
+    assert state.validate(), ("batch.py: Could not validate metadata!")
+
+    paths = find_spreadsheets(args.patterns)
+    print("Validating %d spreadsheets with %d workers..." % (len(paths), args.workers), file = sys.stderr)
+
+    start = time.time()
+    valid = 0
+    pool  = multiprocessing.Pool(args.workers, init_worker, (state, args.check, args.formulas, args.cache))
+
+    try:
+        for result in pool.imap_unordered(process, paths, args.chunksize):
+            if result["valid"]:
+                valid += 1
+            print(json.dumps(result))
+            sys.stdout.flush()
+
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+    print("%d of %d spreadsheets were valid. Took %.2f seconds." % (valid, len(paths), time.time() - start), file = sys.stderr)
+
+    return 0 if (valid == len(paths)) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
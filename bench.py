@@ -0,0 +1,566 @@
+###############################################################################
+###
+### bench.py - Benchmarks for the Spreadsheet Description Language tools.
+###
+###  gov.uk Metadata Standards are a way to increase the interoperability of
+###  spreadsheets between government departments.
+###
+###  bench.py generates synthetic workbooks of various sizes, along with the
+###  metadata that describes them, and times how long each stage of reading
+###  them takes.
+###
+###  Usage: python bench.py [--rows 1000,100000] [--columns 4,40]
+###                         [--formats ods] [--phases parse,validate,...]
+###                         [--output bench-results.json] [--compare old.json]
+###
+###  Each phase is run in a fresh process so that its peak memory use can be
+###  measured on its own. The results are written to a JSON file so that runs
+###  from different commits can be compared with --compare.
+###
+###
+###  Copyright (C) 2019, Andy Bennett, Crown Copyright (Government Digital Service).
+###
+###  Permission is hereby granted, free of charge, to any person obtaining a
+###  copy of this software and associated documentation files (the "Software"),
+###  to deal in the Software without restriction, including without limitation
+###  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+###  and#or sell copies of the Software, and to permit persons to whom the
+###  Software is furnished to do so, subject to the following conditions:
+###
+###  The above copyright notice and this permission notice shall be included in
+###  all copies or substantial portions of the Software.
+###
+###  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+###  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+###  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+###  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+###  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+###  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+###  DEALINGS IN THE SOFTWARE.
+###
+### Andy Bennett <andyjpb@digital.cabinet-office.gov.uk>, 2019/03/19
+###
+###############################################################################
+
+
+from   __future__ import print_function
+import sys
+import os
+import json
+import time
+import Queue
+import decimal
+import zipfile
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from   xml.sax.saxutils import escape
+
+import slang
+
+################################################################################
+# Configuration
+
+ROWS       = [1000, 100000]
+COLUMNS    = [4, 40]
+FORMATS    = ["ods", "xlsx"]
+PHASES     = ["parse", "validate", "extract", "columns", "json"]
+OUTPUT     = "bench-results.json"
+WORKDIR    = os.path.join(tempfile.gettempdir(), "slang-bench")
+
+# Every BLANK_EVERY rows of data we insert a run of BLANK_RUN repeated blank
+# rows.
+BLANK_EVERY = 1000
+BLANK_RUN   = 10
+
+
+
+################################################################################
+# Synthetic workbooks
+
+# The layout of a synthetic workbook with the given number of columns.
+# Returns a list of (name, slang type) tuples. The first column is always a
+# string and the rest cycle through a price, a quantity and a total that is
+# calculated from them with a formula.
+def layout(columns):
+
+    result = [("Item", "String")]
+    cycle  = [("Price", "GBPxVAT"), ("Quantity", "Number"), ("Total", "Formula")]
+
+    for c in range(1, columns):
+        (name, type) = cycle[(c - 1) % 3]
+        result.append(("%s %d" % (name, ((c - 1) // 3) + 1), type))
+
+    return result
+
+
+# Returns the value of each cell in the row of data as a list of
+# (slang type, value, formula) tuples. formula is a tuple of the columns that
+# it multiplies together.
+def row_values(columns, i):
+
+    result = [("String", "Item %d" % i, None)]
+    price  = None
+    qty    = None
+
+    for (c, (name, type)) in enumerate(layout(columns)[1:], 1):
+        if type == "GBPxVAT":
+            price = decimal.Decimal((i * 37 + c) % 100000).scaleb(-2)
+            result.append((type, str(price), None))
+        elif type == "Number":
+            qty = (i + c) % 50 + 1
+            result.append((type, str(qty), None))
+        else:
+            result.append((type, str(price * qty), (c - 2, c - 1)))
+
+    return result
+
+
+# Writes the .slang metadata that describes a synthetic workbook.
+def write_metadata(path, rows, columns):
+
+    out = open(path, "w")
+    out.write("#\tSynthetic benchmark metadata\n\n")
+
+    for (name, type) in layout(columns):
+        out.write("declare-type\t\"%s\"\t%s\n" % (name, type))
+
+    last = slang.column_name(columns - 1)
+    out.write("declare-header\tA1:%s1\n" % last)
+    out.write("declare-data\tA2:%s%d\n" % (last, rows + 1))
+    out.close()
+
+
+# Yields the logical row number of each row of data along with whether it is
+# the start of a run of blank rows.
+def data_rows(rows):
+
+    i = 0
+    while i < rows:
+        if (i > 0) and (i % BLANK_EVERY == 0) and (rows - i > BLANK_RUN):
+            yield (i, BLANK_RUN)
+            i += BLANK_RUN
+        else:
+            yield (i, 0)
+            i += 1
+
+
+ods_header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document-content'
+        ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+        ' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+        ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"'
+        ' xmlns:of="urn:oasis:names:tc:opendocument:xmlns:of:1.2"'
+        ' xmlns:calcext="urn:org:documentfoundation:names:experimental:calc:xmlns:calcext:1.0"'
+        ' office:version="1.2"><office:body><office:spreadsheet>'
+        '<table:table table:name="Sheet1">')
+
+ods_footer = '</table:table></office:spreadsheet></office:body></office:document-content>\n'
+
+
+def ods_cell(type, value, formula, row):
+
+    if type == "String":
+        return '<table:table-cell office:value-type="string" calcext:value-type="string"><text:p>%s</text:p></table:table-cell>' % escape(value)
+
+    if formula != None:
+        formula = ' table:formula="of:=[.%s%d]*[.%s%d]"' % (slang.column_name(formula[0]), row, slang.column_name(formula[1]), row)
+    else:
+        formula = ''
+
+    if type == "Number":
+        return '<table:table-cell office:value-type="float" office:value="%s" calcext:value-type="float"><text:p>%s</text:p></table:table-cell>' % (value, value)
+
+    return '<table:table-cell%s office:value-type="currency" office:currency="GBP" office:value="%s" calcext:value-type="currency"><text:p>&#163;%s</text:p></table:table-cell>' % (formula, value, value)
+
+
+# Writes a synthetic OpenDocument Spreadsheet. The XML is written to a
+# temporary file first so that the whole document never has to be held in
+# memory.
+def write_ods(path, rows, columns):
+
+    xml = path + ".content.xml"
+    out = open(xml, "w")
+    out.write(ods_header)
+
+    blank_columns = '<table:table-cell table:number-columns-repeated="%d"/>' % (1024 - columns)
+
+    out.write('<table:table-row>')
+    for (name, type) in layout(columns):
+        out.write(ods_cell("String", name, None, 1))
+    out.write(blank_columns + '</table:table-row>\n')
+
+    for (i, blank) in data_rows(rows):
+        if blank:
+            out.write('<table:table-row table:number-rows-repeated="%d"><table:table-cell table:number-columns-repeated="1024"/></table:table-row>\n' % blank)
+            continue
+        out.write('<table:table-row>')
+        for (type, value, formula) in row_values(columns, i):
+            out.write(ods_cell(type, value, formula, i + 2))
+        out.write(blank_columns + '</table:table-row>\n')
+
+    out.write('<table:table-row table:number-rows-repeated="%d"><table:table-cell table:number-columns-repeated="1024"/></table:table-row>' % (1048576 - rows - 1))
+    out.write(ods_footer)
+    out.close()
+
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    archive.writestr(zipfile.ZipInfo("mimetype"), "application/vnd.oasis.opendocument.spreadsheet")
+    archive.write(xml, "content.xml")
+    archive.close()
+    os.remove(xml)
+
+
+xlsx_content_types = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>')
+
+xlsx_rels = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>')
+
+xlsx_workbook = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>')
+
+xlsx_workbook_rels = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>')
+
+xlsx_styles = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="&quot;&#163;&quot;#,##0.00"/></numFmts>'
+        '<fonts count="1"><font/></fonts><fills count="1"><fill/></fills><borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0"/><xf numFmtId="164" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>')
+
+
+def xlsx_cell(type, value, formula, row, column):
+
+    ref = "%s%d" % (slang.column_name(column), row)
+
+    if type == "String":
+        return '<c r="%s" t="inlineStr"><is><t>%s</t></is></c>' % (ref, escape(value))
+
+    if type == "Number":
+        return '<c r="%s"><v>%s</v></c>' % (ref, value)
+
+    if formula != None:
+        return '<c r="%s" s="1"><f>%s%d*%s%d</f><v>%s</v></c>' % (ref, slang.column_name(formula[0]), row, slang.column_name(formula[1]), row, value)
+
+    return '<c r="%s" s="1"><v>%s</v></c>' % (ref, value)
+
+
+# Writes a synthetic Office Open XML Workbook. As with write_ods(), the sheet
+# is written to a temporary file first. Blank rows are simply left out, as
+# Excel does.
+def write_xlsx(path, rows, columns):
+
+    xml = path + ".sheet1.xml"
+    out = open(xml, "w")
+    out.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+
+    out.write('<row r="1">')
+    for (c, (name, type)) in enumerate(layout(columns)):
+        out.write(xlsx_cell("String", name, None, 1, c))
+    out.write('</row>\n')
+
+    for (i, blank) in data_rows(rows):
+        if blank:
+            continue
+        out.write('<row r="%d">' % (i + 2))
+        for (c, (type, value, formula)) in enumerate(row_values(columns, i)):
+            out.write(xlsx_cell(type, value, formula, i + 2, c))
+        out.write('</row>\n')
+
+    out.write('</sheetData></worksheet>\n')
+    out.close()
+
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    archive.writestr("[Content_Types].xml",        xlsx_content_types)
+    archive.writestr("_rels/.rels",                xlsx_rels)
+    archive.writestr("xl/workbook.xml",            xlsx_workbook)
+    archive.writestr("xl/_rels/workbook.xml.rels", xlsx_workbook_rels)
+    archive.writestr("xl/styles.xml",              xlsx_styles)
+    archive.write(xml, "xl/worksheets/sheet1.xml")
+    archive.close()
+    os.remove(xml)
+
+
+writers = {
+        "ods"  : write_ods,
+        "xlsx" : write_xlsx,
+        }
+
+
+# Returns the paths of the metadata and the workbook for the given size and
+# format, generating them if they don't already exist.
+def generate(workdir, format, rows, columns):
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    base     = os.path.join(workdir, "bench-%dx%d" % (rows, columns))
+    metadata = base + ".slang"
+    workbook = base + "." + format
+
+    if not os.path.exists(metadata):
+        write_metadata(metadata, rows, columns)
+
+    if not os.path.exists(workbook):
+        print("Generating %s..." % workbook, file = sys.stderr)
+        writers[format](workbook + ".tmp", rows, columns)
+        os.rename(workbook + ".tmp", workbook)
+
+    return (metadata, workbook)
+
+
+
+################################################################################
+# Phases
+#
+# Each phase does whatever it needs to get ready and then returns the time
+# taken by the part that is being measured.
+
+def phase_parse(metadata, workbook):
+
+    start = time.time()
+    slang.slang(open(metadata)).parse()
+
+    return time.time() - start
+
+
+def phase_validate(metadata, workbook):
+
+    description = slang.slang(open(metadata))
+    description.parse()
+
+    start = time.time()
+    description.validate(open(workbook, "rb"))
+
+    return time.time() - start
+
+
+def prepare(metadata, workbook):
+
+    description = slang.slang(open(metadata))
+    description.parse()
+
+    return description.validate(open(workbook, "rb"))
+
+
+def phase_extract(metadata, workbook):
+
+    instance = prepare(metadata, workbook)
+
+    start = time.time()
+    instance.extract()
+
+    return time.time() - start
+
+
+def phase_columns(metadata, workbook):
+
+    instance = prepare(metadata, workbook)
+
+    start = time.time()
+    instance.extract_columns()
+
+    return time.time() - start
+
+
+def phase_json(metadata, workbook):
+
+    instance = prepare(metadata, workbook)
+    out      = open(os.devnull, "wb")
+
+    start = time.time()
+    instance.write_json(out)
+
+    return time.time() - start
+
+
+phases = {
+        "parse"    : (phase_parse,    False),
+        "validate" : (phase_validate, False),
+        "extract"  : (phase_extract,  True),
+        "columns"  : (phase_columns,  True),
+        "json"     : (phase_json,     True),
+        }
+
+
+# Returns the peak resident set size of this process in kilobytes.
+def peak_rss():
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak // 1024
+
+    return peak
+
+
+# The body of the process that runs a single phase.
+def run_phase(queue, phase, metadata, workbook):
+
+    # Keep the phase's own output out of the way.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    try:
+        seconds = phases[phase][0](metadata, workbook)
+        queue.put({"seconds": seconds, "peak_rss_kb": peak_rss()})
+    except Exception as e:
+        queue.put({"error": "%s: %s" % (type(e).__name__, e)})
+
+
+# Runs a phase in its own process and returns a dictionary that describes
+# how it went.
+# A process that dies without putting anything on the queue, such as one that
+# runs out of memory, is recorded as an error rather than waited for forever.
+def measure(phase, format, rows, columns, metadata, workbook):
+
+    queue   = multiprocessing.Queue()
+    process = multiprocessing.Process(target = run_phase, args = (queue, phase, metadata, workbook))
+    process.start()
+
+    result = None
+    while result == None:
+        alive = process.is_alive()
+        try:
+            result = queue.get(timeout = 1)
+        except Queue.Empty:
+            if not alive:
+                result = {"error": "exit code %d" % process.exitcode}
+
+    process.join()
+
+    result.update({
+        "phase"   : phase,
+        "format"  : format,
+        "rows"    : rows,
+        "columns" : columns,
+        })
+
+    if ("seconds" in result) and phases[phase][1] and (result["seconds"] > 0):
+        result["rows_per_second"] = rows / result["seconds"]
+
+    return result
+
+
+
+################################################################################
+# Reporting
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr = open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(result):
+    return (result["format"], result["rows"], result["columns"], result["phase"])
+
+
+def describe(result):
+
+    if "error" in result:
+        return "%-5s %9d x %-4d %-9s FAILED: %s" % (result["format"], result["rows"], result["columns"], result["phase"], result["error"])
+
+    line = "%-5s %9d x %-4d %-9s %9.3fs %9d KB" % (result["format"], result["rows"], result["columns"], result["phase"], result["seconds"], result["peak_rss_kb"])
+    if "rows_per_second" in result:
+        line += " %11.0f rows/s" % result["rows_per_second"]
+
+    return line
+
+
+# Prints how each result compares with the matching one from an earlier run.
+def compare(results, path):
+
+    previous = json.load(open(path))
+    before   = dict((key(result), result) for result in previous["results"] if "seconds" in result)
+
+    print("\nCompared with %s (commit %s):" % (path, previous.get("commit")))
+    for result in results:
+        old = before.get(key(result))
+        if (old == None) or ("seconds" not in result):
+            continue
+        print("%-5s %9d x %-4d %-9s time %6.2fx  peak RSS %6.2fx" % (result["format"], result["rows"], result["columns"], result["phase"],
+            result["seconds"] / max(old["seconds"], 1e-9), float(result["peak_rss_kb"]) / max(old["peak_rss_kb"], 1)))
+
+
+
+################################################################################
+# Main program logic
+
+def numbers(arg):
+    return [int(x) for x in arg.split(",")]
+
+def names(arg):
+    return arg.split(",")
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description = "Benchmark reading synthetic spreadsheets.")
+    parser.add_argument("--rows",    help = "comma separated numbers of rows of data", type = numbers, default = ROWS)
+    parser.add_argument("--columns", help = "comma separated numbers of columns",      type = numbers, default = COLUMNS)
+    parser.add_argument("--formats", help = "comma separated workbook formats",        type = names,   default = FORMATS)
+    parser.add_argument("--phases",  help = "comma separated phases to time",          type = names,   default = PHASES)
+    parser.add_argument("--workdir", help = "where to keep the generated workbooks",   default = WORKDIR)
+    parser.add_argument("--output",  help = "where to write the results",              default = OUTPUT)
+    parser.add_argument("--compare", help = "results from an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    for phase in args.phases:
+        assert (phase in phases), ("bench.py: Unknown phase %s." % phase)
+    for format in args.formats:
+        assert (format in writers), ("bench.py: Unknown format %s." % format)
+
+    results = []
+
+    for format in args.formats:
+        for rows in args.rows:
+            for columns in args.columns:
+                (metadata, workbook) = generate(args.workdir, format, rows, columns)
+                for phase in args.phases:
+                    result = measure(phase, format, rows, columns, metadata, workbook)
+                    print(describe(result))
+                    sys.stdout.flush()
+                    results.append(result)
+
+    out = open(args.output, "w")
+    json.dump({
+        "commit"    : git_commit(),
+        "python"    : platform.python_version(),
+        "platform"  : platform.platform(),
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results"   : results,
+        }, out, indent = 2, sort_keys = True)
+    out.close()
+
+    print("Results written to %s." % args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -34,6 +34,7 @@
 ###############################################################################
 
 
+import sys
 import slang
 
 ################################################################################
@@ -44,27 +45,6 @@ SPREADSHEETS = ["office-supplies-order.ods", "office-supplies-order.ods"]
 
 
 
-################################################################################
-# JSON rendering logic
-
-def render_value(cell):
-    if isinstance(cell.type, slang.slang_String):
-        return ("\"%s\"" % cell.value())
-    else:
-        return cell.value()
-
-# Mutate the result object to affect what's returned from extract().
-# Row is an array of CellValues
-def render_json(result, row):
-    print("  {")
-    for c in row:
-        print("    \"%s\":\t%s," % (c.name, render_value(c)))
-    print("  },")
-
-    return True
-
-
-
 ################################################################################
 # Main program logic
 
@@ -72,14 +52,17 @@ print("Reading metadata from %s..." % METADATA)
 metadata = slang.slang(open(METADATA))
 metadata.parse()
 
+# The same spreadsheet may appear more than once so only parse each one once.
+workbooks = slang.WorkbookCache()
+
 
 for sheet in SPREADSHEETS:
 
     print("Validating spreadsheet %s against metadata..." % sheet)
-    instance = metadata.validate(open(sheet))
+    instance = metadata.validate(open(sheet), workbooks)
 
     print("Extracting typed data from spreadsheet...")
-    print("[")
-    instance.extract(render_json)
-    print("]")
+    sys.stdout.flush()
+    instance.write_json(sys.stdout)
 
+print("Workbook cache: %s" % workbooks.stats())
@@ -0,0 +1,699 @@
+###############################################################################
+###
+### service.py - A local HTTP service that validates uploaded spreadsheets.
+###
+###  gov.uk Metadata Standards are a way to increase the interoperability of
+###  spreadsheets between government departments.
+###
+###  service.py accepts spreadsheets over HTTP and checks or extracts them
+###  against some metadata using a bounded pool of worker processes. It is the
+###  upload flow that the "Submit Your Spreadsheet To Treasury" mock-up in
+###  widgets/ depicts.
+###
+###  Usage: python service.py serve [--port 8080] [--workers N]
+###                                 [--queue N] metadata.slang...
+###         python service.py load [--requests 100] [--concurrency 8]
+###                                URL spreadsheet
+###
+###  Spreadsheets are POSTed as the body of the request, for example:
+###
+###         curl --data-binary @office-supplies-order.ods \
+###              "http://localhost:8080/validate?schema=poc"
+###
+###  POST /validate  Checks the spreadsheet and returns {"valid": ...,
+###                  "errors": [...]}.
+###  POST /extract   Extracts the data and streams it back as JSON as it is
+###                  read.
+###  GET  /schemas   Lists the metadata that the service knows about.
+###  GET  /stats     Returns counters and latencies for the service.
+###
+###  schema names the metadata to use, which is the name of its .slang file
+###  without the extension. If it is left out then the metadata is chosen by
+###  matching the spreadsheet's header. max_errors limits how many errors
+###  /validate reports.
+###
+###  Each request holds one of --queue slots from when its upload starts until
+###  its response has been sent and its worker has finished with it. When they
+###  are all taken new requests are turned away with 503 Service Unavailable
+###  straight away rather than being left to pile up. A spreadsheet that takes
+###  longer than the timeout is answered with 504 but keeps its slot until its
+###  worker gives up on it. The metadata is parsed once when the service starts and
+###  each worker keeps it for as long as it runs.
+###
+###  The load command POSTs a spreadsheet to a running service from several
+###  threads at once and reports the throughput and latency.
+###
+###
+###  Copyright (C) 2019, Andy Bennett, Crown Copyright (Government Digital Service).
+###
+###  Permission is hereby granted, free of charge, to any person obtaining a
+###  copy of this software and associated documentation files (the "Software"),
+###  to deal in the Software without restriction, including without limitation
+###  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+###  and#or sell copies of the Software, and to permit persons to whom the
+###  Software is furnished to do so, subject to the following conditions:
+###
+###  The above copyright notice and this permission notice shall be included in
+###  all copies or substantial portions of the Software.
+###
+###  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+###  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+###  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+###  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+###  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+###  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+###  DEALINGS IN THE SOFTWARE.
+###
+### Andy Bennett <andyjpb@digital.cabinet-office.gov.uk>, 2019/03/19
+###
+###############################################################################
+
+
+from   __future__ import print_function
+import sys
+import os
+import json
+import time
+import urlparse
+import httplib
+import argparse
+import socket
+import tempfile
+import threading
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+import slang
+
+################################################################################
+# Configuration
+
+PORT = 8080
+
+# How many requests can be uploading, waiting for a worker or being answered
+# at once, for each worker.
+QUEUE_PER_WORKER = 4
+
+# The largest spreadsheet that we accept.
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+# How many bytes of a request or response we handle at a time.
+CHUNK_BYTES = 64 * 1024
+
+# How long a worker can take over a spreadsheet before we give up on it.
+TIMEOUT_SECONDS = 300
+
+# How often we look for more of the JSON that a worker is extracting.
+POLL_SECONDS = 0.05
+
+# How many errors /validate reports unless it is asked for fewer.
+MAX_ERRORS = 100
+
+# How many recent requests the latencies in /stats are worked out from.
+LATENCY_WINDOW = 1000
+
+
+
+################################################################################
+# Worker processes
+
+# The metadata that the worker can check spreadsheets against. Each worker
+# loads it when it starts, from the .slangc files that the service made, and
+# keeps it until it exits.
+registry = None
+
+def init_worker(paths):
+    global registry
+    registry = slang.SchemaRegistry()
+    for (name, path) in paths:
+        registry.add(name, slang.load_state(path))
+
+
+# Returns the (name, metadata) that the spreadsheet should be read with.
+def choose_schema(spreadsheet, schema):
+
+    if schema != None:
+        assert (schema in registry), ("service.py: There is no metadata called %s." % schema)
+        return (schema, registry.schemas[schema])
+
+    found = registry.find(spreadsheet)
+    if found == None:
+        raise slang.SpreadsheetError("service.py: None of the metadata matches the spreadsheet.")
+
+    return found
+
+
+# Checks the spreadsheet at path and returns a dictionary that describes the
+# result.
+def validate_upload(path, schema, max_errors):
+
+    start       = time.time()
+    spreadsheet = open(path, "rb")
+
+    try:
+        (name, metadata) = choose_schema(spreadsheet, schema)
+        errors = slang.instance(metadata, spreadsheet).check(max_errors)
+    finally:
+        spreadsheet.close()
+
+    return {
+            "schema"  : name,
+            "valid"   : (len(errors) == 0),
+            "errors"  : [str(error) for error in errors],
+            "seconds" : time.time() - start,
+            }
+
+
+# Extracts the data from the spreadsheet at path, writes it to output as
+# JSON and returns a dictionary that describes the result.
+# The service sends the JSON on as it is written so the name of the metadata
+# that was chosen is written to output.schema before any of it.
+def extract_upload(path, schema, output):
+
+    start       = time.time()
+    spreadsheet = open(path, "rb")
+
+    try:
+        (name, metadata) = choose_schema(spreadsheet, schema)
+
+        stream = open(output + ".schema", "wb")
+        try:
+            stream.write(name)
+        finally:
+            stream.close()
+
+        stream = open(output, "wb")
+        try:
+            writer = slang.instance(metadata, spreadsheet).write_json(stream)
+        finally:
+            stream.close()
+    finally:
+        spreadsheet.close()
+
+    return {
+            "schema"  : name,
+            "rows"    : writer.rows,
+            "seconds" : time.time() - start,
+            }
+
+
+# Runs one of the procedures above and returns a (result, error) tuple rather
+# than raising so that the reason for a failure gets back to the service.
+def run_task(proc, args):
+
+    try:
+        return (apply(proc, args), None)
+    except Exception as e:
+        return (None, "%s: %s" % (type(e).__name__, e))
+
+
+
+################################################################################
+# The HTTP service
+
+# Keeps count of what the service has done and how long it took.
+class Stats:
+
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.counts    = collections.defaultdict(int)
+        self.latencies = collections.deque(maxlen = LATENCY_WINDOW)
+
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+    def finished(self, seconds):
+        with self.lock:
+            self.counts["finished"] += 1
+            self.latencies.append(seconds)
+
+
+    # Returns the counters along with the 50th, 95th and 99th percentile and
+    # the maximum latency over the recent requests.
+    def snapshot(self):
+
+        with self.lock:
+            result    = dict(self.counts)
+            latencies = sorted(self.latencies)
+
+        if latencies:
+            result["latency"] = dict(
+                    [("p%d" % p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)]) for p in (50, 95, 99)] +
+                    [("max", latencies[-1])])
+
+        return result
+
+
+# Raised when the body of a request isn't what its headers said it would be.
+class UploadError(Exception):
+    None
+
+
+class Service(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    # schemas is a list of the (name, path) of each .slang file.
+    def __init__(self, address, schemas, workers, queue):
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+
+        self.schemas = schemas
+        self.queue   = queue
+        self.slots   = threading.BoundedSemaphore(queue)
+        self.stats   = Stats()
+        self.pool    = multiprocessing.Pool(workers, init_worker, (schemas,))
+
+
+    # Starts proc in a worker and returns the AsyncResult for its
+    # (result, error).
+    def start(self, proc, *args):
+        return self.pool.apply_async(run_task, (proc, args))
+
+
+    # Gives back the slot that a request took and removes its files once task,
+    # if there is one, has finished with them.
+    # The workers can't be interrupted so a task that timed out is still
+    # running. Its slot is kept until it finishes so that requests are turned
+    # away, rather than queued behind it, while the workers are busy.
+    def finish(self, paths, task = None):
+
+        if (task != None) and not task.ready():
+            thread = threading.Thread(target = self.finish_after, args = (paths, task))
+            thread.daemon = True
+            thread.start()
+            return
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.slots.release()
+
+
+    def finish_after(self, paths, task):
+        task.wait()
+        self.finish(paths)
+
+
+    # Clients that have gone away before their response was sent, such as
+    # those whose uploads end early, aren't worth a traceback.
+    def handle_error(self, request, client_address):
+
+        if isinstance(sys.exc_info()[1], socket.error):
+            print("%s - Connection lost: %s" % (client_address[0], sys.exc_info()[1]), file = sys.stderr)
+            return
+
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+    def close(self):
+        self.server_close()
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    server_version = "slang-service/0.1"
+
+    # Writes a response with a JSON body.
+    def send_json(self, status, value, headers = {}):
+
+        body = json.dumps(value)
+
+        self.send_response(status)
+        self.send_header("Content-Type",   "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for (header, content) in headers.iteritems():
+            self.send_header(header, content)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_error_json(self, status, message, headers = {}):
+        self.server.stats.count("status-%d" % status)
+        self.send_json(status, {"error": message}, headers)
+
+
+    def do_GET(self):
+
+        url = urlparse.urlparse(self.path)
+
+        if url.path == "/schemas":
+            self.send_json(200, [name for (name, path) in self.server.schemas])
+        elif url.path == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_error_json(404, "There is nothing at %s." % url.path)
+
+
+    def do_POST(self):
+
+        url   = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        if url.path not in ("/validate", "/extract"):
+            return self.send_error_json(404, "There is nothing at %s." % url.path)
+
+        length = self.headers.getheader("Content-Length")
+        if length == None:
+            return self.send_error_json(411, "Please say how long the spreadsheet is with Content-Length.")
+
+        length = int(length)
+        if length > MAX_UPLOAD_BYTES:
+            return self.send_error_json(413, "Spreadsheets can be no larger than %d bytes." % MAX_UPLOAD_BYTES)
+
+        schema = query.get("schema", [None])[0]
+        if (schema != None) and (schema not in [name for (name, path) in self.server.schemas]):
+            self.discard(length)
+            return self.send_error_json(404, "There is no metadata called %s." % schema)
+
+        max_errors = MAX_ERRORS
+        if "max_errors" in query:
+            try:
+                max_errors = int(query["max_errors"][0])
+            except ValueError:
+                max_errors = 0
+            if max_errors <= 0:
+                self.discard(length)
+                return self.send_error_json(400, "max_errors must be a positive number. We got %s." % query["max_errors"][0])
+            max_errors = min(max_errors, MAX_ERRORS)
+
+        # Turn the request away, rather than queue it, if we're already busy.
+        if not self.server.slots.acquire(False):
+            self.discard(length)
+            return self.send_error_json(503, "The service is busy. Please try again shortly.", {"Retry-After": "1"})
+
+        start = time.time()
+        paths = []
+        task  = None
+
+        try:
+            self.server.stats.count("accepted")
+
+            upload = self.receive(length)
+            paths.append(upload)
+
+            if url.path == "/validate":
+                task = self.server.start(validate_upload, upload, schema, max_errors)
+            else:
+                output = upload + ".json"
+                paths.extend([output, output + ".schema"])
+                task = self.server.start(extract_upload, upload, schema, output)
+
+            deadline = time.time() + TIMEOUT_SECONDS
+
+            # Large extracts are sent as they are written rather than once
+            # they have finished.
+            if (url.path == "/extract") and self.wait_for_output(task, output, deadline):
+                self.stream_file(output, task, deadline)
+                self.server.stats.finished(time.time() - start)
+                return
+
+            (result, error) = task.get(max(0, deadline - time.time()))
+
+            if error != None:
+                self.send_error_json(422, error)
+            elif url.path == "/validate":
+                self.send_json(200, result)
+            else:
+                self.send_file(output, result)
+
+            self.server.stats.finished(time.time() - start)
+
+        except UploadError as e:
+            self.close_connection = 1
+            self.send_error_json(400, str(e))
+
+        except multiprocessing.TimeoutError:
+            self.send_error_json(504, "The spreadsheet took too long to read.")
+            self.server.stats.finished(time.time() - start)
+
+        finally:
+            self.server.finish(paths, task)
+
+
+    # Streams length bytes of the request body to a temporary file and returns
+    # its path. Raises an UploadError if the client stops sending before then.
+    def receive(self, length):
+
+        (fd, path) = tempfile.mkstemp(prefix = "slang-upload-")
+        output     = os.fdopen(fd, "wb")
+        expected   = length
+
+        try:
+            while length > 0:
+                chunk = self.rfile.read(min(CHUNK_BYTES, length))
+                if chunk == "":
+                    break
+                output.write(chunk)
+                length -= len(chunk)
+        finally:
+            output.close()
+
+        if length > 0:
+            os.remove(path)
+            raise UploadError("The upload ended after %d of the %d bytes that Content-Length promised." % (expected - length, expected))
+
+        return path
+
+
+    # Reads and throws away length bytes of the request body so that the
+    # client gets to see our response.
+    def discard(self, length):
+
+        while length > 0:
+            chunk = self.rfile.read(min(CHUNK_BYTES, length))
+            if chunk == "":
+                return
+            length -= len(chunk)
+
+
+    # Waits until task has written some output to path or has finished and
+    # returns True if there is output to stream or False if it has finished
+    # first. Raises multiprocessing.TimeoutError if neither happens by
+    # deadline.
+    # write_json() only writes once the header has been read so the problems
+    # that stop a spreadsheet from being read at all are still answered with
+    # an error rather than a 200.
+    def wait_for_output(self, task, path, deadline):
+
+        while not task.ready():
+            if os.path.exists(path) and (os.path.getsize(path) > 0):
+                return True
+            if time.time() > deadline:
+                raise multiprocessing.TimeoutError()
+            task.wait(POLL_SECONDS)
+
+        return False
+
+
+    # Streams the JSON that task is writing to path back to the client as it
+    # is written, until task finishes.
+    # The rows aren't known until the end so there is no X-Slang-Rows and the
+    # end of the response is marked by closing the connection. If task fails
+    # or runs past deadline then the JSON is cut short.
+    def stream_file(self, path, task, deadline):
+
+        schema = open(path + ".schema", "rb")
+        try:
+            name = schema.read()
+        finally:
+            schema.close()
+
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header("Content-Type",   "application/json")
+        self.send_header("X-Slang-Schema", name)
+        self.end_headers()
+
+        input = open(path, "rb")
+        try:
+            while True:
+                done  = task.ready()
+                chunk = input.read(CHUNK_BYTES)
+                while chunk != "":
+                    self.wfile.write(chunk)
+                    chunk = input.read(CHUNK_BYTES)
+
+                if done:
+                    break
+                if time.time() > deadline:
+                    self.server.stats.count("truncated")
+                    self.log_message("%s", "The spreadsheet took too long to read. The JSON was cut short.")
+                    return
+                task.wait(POLL_SECONDS)
+        finally:
+            input.close()
+
+        (result, error) = task.get()
+        if error != None:
+            self.server.stats.count("truncated")
+            self.log_message("%s", "%s The JSON was cut short." % error)
+
+
+    # Sends the JSON that a worker wrote to path back to the client once it
+    # has all been written.
+    def send_file(self, path, result):
+
+        self.send_response(200)
+        self.send_header("Content-Type",   "application/json")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("X-Slang-Schema", result["schema"])
+        self.send_header("X-Slang-Rows",   str(result["rows"]))
+        self.end_headers()
+
+        input = open(path, "rb")
+        try:
+            chunk = input.read(CHUNK_BYTES)
+            while chunk != "":
+                self.wfile.write(chunk)
+                chunk = input.read(CHUNK_BYTES)
+        finally:
+            input.close()
+
+
+    def log_message(self, format, *args):
+        print("%s - %s" % (self.address_string(), format % args), file = sys.stderr)
+
+
+
+################################################################################
+# Load testing
+
+# POSTs the spreadsheet at path to url requests times from concurrency threads
+# at once and returns a dictionary that describes how long it took.
+def load_test(url, path, requests, concurrency):
+
+    body      = open(path, "rb").read()
+    url       = urlparse.urlparse(url)
+    lock      = threading.Lock()
+    remaining = [requests]
+    statuses  = collections.defaultdict(int)
+    latencies = []
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+
+            start      = time.time()
+            connection = httplib.HTTPConnection(url.hostname, url.port or 80)
+            try:
+                connection.request("POST", url.path + ("?" + url.query if url.query else ""), body, {"Content-Type": "application/octet-stream"})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except Exception:
+                status = 0
+            finally:
+                connection.close()
+
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(time.time() - start)
+
+    start   = time.time()
+    threads = [threading.Thread(target = client) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies.sort()
+
+    result = {
+            "requests"            : requests,
+            "concurrency"         : concurrency,
+            "seconds"             : seconds,
+            "statuses"            : dict(statuses),
+            "requests_per_second" : statuses[200] / seconds,
+            }
+
+    if latencies:
+        result["latency"] = dict(
+                [("p%d" % p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)]) for p in (50, 95, 99)] +
+                [("max", latencies[-1])])
+
+    return result
+
+
+
+################################################################################
+# Main program logic
+
+def serve(args):
+
+    schemas = []
+    for path in args.metadata:
+        name = os.path.splitext(os.path.basename(path))[0]
+        assert (name not in [n for (n, p) in schemas]), ("service.py: There is more than one metadata file called %s." % name)
+
+        # Parse and check each file now so that the workers can load it from
+        # its .slangc.
+        print("Reading metadata from %s..." % path, file = sys.stderr)
+        state = slang.load_state(path)
+        assert state.validate(), ("service.py: Could not validate metadata!")
+        schemas.append((name, path))
+
+    queue   = args.queue or (args.workers * QUEUE_PER_WORKER)
+    service = Service((args.host, args.port), schemas, args.workers, queue)
+
+    print("Serving %s on http://%s:%d/ with %d workers and %d slots..." % (", ".join(name for (name, path) in schemas), args.host, args.port, args.workers, queue), file = sys.stderr)
+
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+    return 0
+
+
+def load(args):
+
+    result = load_test(args.url, args.spreadsheet, args.requests, args.concurrency)
+    print(json.dumps(result, indent = 2, sort_keys = True))
+
+    return 0 if (result["statuses"].get(200, 0) == args.requests) else 1
+
+
+def main(argv):
+
+    parser   = argparse.ArgumentParser(description = "Validate uploaded spreadsheets over HTTP.")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser("serve", help = "run the service")
+    command.add_argument("metadata",  help = "the .slang files that describe the spreadsheets", nargs = "+")
+    command.add_argument("--host",    help = "address to listen on (default: 127.0.0.1)", default = "127.0.0.1")
+    command.add_argument("--port",    help = "port to listen on (default: %d)" % PORT, type = int, default = PORT)
+    command.add_argument("--workers", help = "number of worker processes (default: one per CPU)", type = int, default = multiprocessing.cpu_count())
+    command.add_argument("--queue",   help = "number of requests to handle at once (default: %d per worker)" % QUEUE_PER_WORKER, type = int)
+    command.set_defaults(command = serve)
+
+    command = commands.add_parser("load", help = "measure a running service under concurrent load")
+    command.add_argument("url",           help = "where to POST the spreadsheet, such as http://localhost:%d/validate" % PORT)
+    command.add_argument("spreadsheet",   help = "the spreadsheet to POST")
+    command.add_argument("--requests",    help = "how many requests to make", type = int, default = 100)
+    command.add_argument("--concurrency", help = "how many requests to make at once", type = int, default = 8)
+    command.set_defaults(command = load)
+
+    args = parser.parse_args(argv)
+
+    return args.command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
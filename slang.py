@@ -39,9 +39,31 @@
 
 from   __future__ import print_function
 import sys
+import os
 import re
-from   odf        import opendocument
-from   odf.table  import Table, TableRow, TableCell
+import json
+import math
+import bisect
+import hashlib
+import copy
+import array
+import decimal
+import itertools
+import collections
+import marshal
+import zlib
+import zipfile
+import time
+import atexit
+from   xml.parsers import expat
+
+# multiprocessing, cProfile, pstats and the odf package are imported where
+# they're used so that loading the metadata doesn't pay for them.
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 
@@ -51,415 +73,5715 @@ from   odf.table  import Table, TableRow, TableCell
 def warn(*args, **kwargs):
     sys.stderr.write("WARNING: ")
     print(*args, file=sys.stderr, **kwargs)
+    hooks.event("warning", message = " ".join(str(arg) for arg in args))
+
+
+
+###############################################################################
+# Instrumentation.
+#
+# slang reports how long each phase of its work takes, and counts the things
+# that it processes, through the hooks object. The default Hooks do nothing
+# and the per-row paths are never instrumented directly: rows and cells are
+# counted once for each range that is read and the time spent parsing XML is
+# added up over a whole sheet before it is reported. Replace the hooks with
+# set_hooks() to find out where the time goes.
+#
+# The phases are:
+#   load       Loading a .slang file, from its compiled .slangc form if that
+#              is up to date. Reported with whether it was.
+#   parse      Reading a .slang file.
+#   open       Opening a workbook's zip archive and the parts that all its
+#              sheets share.
+#   index      Finding the sheets and named ranges in a workbook.
+#   xml        Parsing the XML of a sheet. Reported with the number of bytes
+#              of XML that were read.
+#   header     Reading the header of a table and compiling its plan.
+#   extract    instance.extract() and instance.extract_columns().
+#   blocks     Splitting a large data range into blocks of rows to be read in
+#              parallel.
+#   check      instance.check().
+#   formulas   instance.verify_formulas().
+#   results    Looking for a result in a ResultCache.
+#   serialise  instance.write_json().
+#   tables     extract_tables().
+#   match      SchemaRegistry.match().
+# Phases can be nested inside each other. For example, extract includes
+# header and xml.
+#
+# The counters are rows and cells, for the data that is read, and cache-hits
+# and cache-misses for WorkbookCaches.
+#
+# Setting the SLANG_HOOKS environment variable to "log" logs each phase to
+# stderr as JSON and setting it to "profile" does that and also profiles the
+# phases with cProfile, printing the statistics when the program exits.
+# "profile:path" saves the statistics to path instead.
+
+# The hooks that do nothing.
+# begin() returns a token that is passed back to end() when the phase is
+# over. fields are reported alongside the time that the phase took.
+class Hooks:
+
+    enabled = False
+
+    def begin(self, phase):
+        return None
+
+    def end(self, phase, token, **fields):
+        None
+
+    # Reports time that has been accumulated outside of begin() and end().
+    def time(self, phase, seconds, **fields):
+        None
+
+    def count(self, name, n = 1):
+        None
+
+    def event(self, event, **fields):
+        None
+
+
+# Hooks that write a line of JSON to stream for each phase and event, and
+# keep running totals of the time spent in each phase and of the counters.
+# Each phase is also reported with the peak resident set size of the process
+# so far, where the platform can tell us.
+class LogHooks(Hooks):
+
+    enabled = True
+
+    def __init__(self, stream = sys.stderr):
+
+        self.stream = stream
+        self.times  = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+
+
+    def log(self, record):
+        self.stream.write(json.dumps(record, default = str) + "\n")
+
+
+    def begin(self, phase):
+        return time.time()
+
+
+    def end(self, phase, token, **fields):
+        self.time(phase, time.time() - token, **fields)
+
+
+    def time(self, phase, seconds, **fields):
+
+        self.times[phase] += seconds
+
+        record = collections.OrderedDict([("phase", phase), ("seconds", seconds)])
+        if resource != None:
+            record["peak_rss_kb"] = peak_rss()
+        record.update(fields)
+        self.log(record)
+
+
+    def count(self, name, n = 1):
+        self.counts[name] += n
+
+
+    def event(self, event, **fields):
+
+        record = collections.OrderedDict([("event", event)])
+        record.update(fields)
+        self.log(record)
+
+
+    # Returns the running totals.
+    def summary(self):
+        return {"seconds": dict(self.times), "counts": dict(self.counts)}
+
+
+    # Logs the running totals.
+    def report(self):
+
+        record = collections.OrderedDict([("event", "summary")])
+        record.update(self.summary())
+        self.log(record)
+
+
+# Hooks that log like LogHooks and also profile the outermost phases with
+# cProfile.
+# Python 2 has no tracemalloc so memory is only followed through the peak RSS
+# that LogHooks reports.
+class ProfileHooks(LogHooks):
+
+    def __init__(self, stream = sys.stderr):
+
+        import cProfile
+
+        LogHooks.__init__(self, stream)
+
+        self.profile = cProfile.Profile()
+        self.depth   = 0
+
+
+    def begin(self, phase):
+
+        if self.depth == 0:
+            self.profile.enable()
+        self.depth += 1
+
+        return LogHooks.begin(self, phase)
+
+
+    def end(self, phase, token, **fields):
+
+        LogHooks.end(self, phase, token, **fields)
+
+        self.depth -= 1
+        if self.depth == 0:
+            self.profile.disable()
+
+
+    # Writes the statistics to stream, most expensive first.
+    def print_stats(self, stream = sys.stderr, sort = "cumulative", limit = 40):
+        import pstats
+        pstats.Stats(self.profile, stream = stream).sort_stats(sort).print_stats(limit)
+
+
+    # Saves the statistics to path for pstats or another viewer.
+    def dump_stats(self, path):
+        self.profile.dump_stats(path)
+
+
+# The hooks that slang reports to.
+hooks = Hooks()
+
+# Installs new_hooks and returns the ones that they replace.
+def set_hooks(new_hooks):
+
+    global hooks
+
+    assert isinstance(new_hooks, Hooks), ("set_hooks: Expected new_hooks argument to be of type 'Hooks' but we got %s." % new_hooks)
+
+    old   = hooks
+    hooks = new_hooks
+
+    return old
+
+
+# Times a phase with the current hooks:
+#   with phase("parse", file = name) as fields:
+#       ...
+#       fields["lines"] = n
+# fields are reported with the time when the phase is over, even if it fails.
+class phase:
+
+    def __init__(self, name, **fields):
+        self.name   = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.token = hooks.begin(self.name)
+        return self.fields
+
+    def __exit__(self, type, value, traceback):
+        hooks.end(self.name, self.token, **self.fields)
+
+
+# Returns the peak resident set size of this process in kilobytes.
+def peak_rss():
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak // 1024
+
+    return peak
+
+
+# Sets up the hooks that the SLANG_HOOKS environment variable asks for.
+def hooks_from_environment():
+
+    setting = os.environ.get("SLANG_HOOKS", "")
+
+    if setting == "log":
+        set_hooks(LogHooks())
+
+    elif setting.startswith("profile"):
+        profile = ProfileHooks()
+        set_hooks(profile)
+        path = setting[len("profile:"):]
+        if path != "":
+            atexit.register(profile.dump_stats, path)
+        else:
+            atexit.register(profile.print_stats)
+
+    elif setting != "":
+        warn("SLANG_HOOKS should be \"log\", \"profile\" or \"profile:path\". We got %s." % setting)
+
+hooks_from_environment()
 
 
 
 ###############################################################################
 # Internal Representations of the Spreadsheet Language Domain Objects.
 
-cell_re = re.compile(r"([A-Z]+)([1-9][0-9]*)")
+cell_re = re.compile(r"([A-Z]+)([1-9][0-9]*)")
+
+# A reference to a specific cell in a spreadsheet.
+class CellReference:
+
+    def __init__(self, spec):
+
+        cell = cell_re.match(spec)
+        assert (cell != None), ("CellReference:.__init__ Invalid cell specifier %s." % spec)
+
+        column = cell.group(1)
+        row    = cell.group(2)
+
+        n = 0
+        for c in range(len(column)):
+            n = (n * 26) + (ord(column[c]) - ord('A') + 1)
+
+        self.column = n - 1
+        self.row    = int(row) - 1
+
+        self.cell = spec
+
+
+    def __str__(self):
+        return ("%s" % self.cell)
+
+
+
+# A reference to a range of cells in a spreadsheet.
+# sheet is the name of the sheet that the range is on or None for the first
+# sheet in the workbook.
+class RangeReference:
+
+    def __init__(self, start, end, sheet = None):
+
+        assert isinstance(start, CellReference), ("RangeReference.__init__: Expected start argument to be of type 'CellReference' but we got %s." % start)
+        assert isinstance(end,   CellReference), ("RangeReference.__init__: Expected end argument to be of type 'CellReference' but we got %s." % end)
+        assert ((sheet == None) or isinstance(sheet, basestring)), ("RangeReference.__init__: Expected sheet argument to be of type 'str' but we got %s." % sheet)
+
+        self.start = start
+        self.end   = end
+        self.sheet = sheet
+        self.width = (end.column   - start.column) + 1
+        self.height= (end.row      - start.row)    + 1
+
+
+    # Returns a RangeReference for the rows from first to last, inclusive, of
+    # the sheet that span the same columns as this range.
+    def rows(self, first, last):
+        return RangeReference(CellReference("%s%d" % (column_name(self.start.column), first + 1)), CellReference("%s%d" % (column_name(self.end.column), last + 1)), self.sheet)
+
+
+    def __str__(self):
+
+        if self.sheet != None:
+            return ("RangeReference(%s!%s:%s)" % (self.sheet, self.start, self.end))
+
+        return ("RangeReference(%s:%s)" % (self.start, self.end))
+
+
+
+# A reference to a range of cells by the name that the workbook gives it.
+# Named ranges can only be resolved into a RangeReference once we know which
+# workbook they are in. sheet is the name of the sheet that the name is local
+# to or None.
+class NamedRange:
+
+    def __init__(self, name, sheet = None):
+
+        assert isinstance(name, basestring), ("NamedRange.__init__: Expected name argument to be of type 'str' but we got %s." % name)
+        assert ((sheet == None) or isinstance(sheet, basestring)), ("NamedRange.__init__: Expected sheet argument to be of type 'str' but we got %s." % sheet)
+
+        self.name  = name
+        self.sheet = sheet
+
+
+    def __str__(self):
+
+        if self.sheet != None:
+            return ("NamedRange(%s!%s)" % (self.sheet, self.name))
+
+        return ("NamedRange(%s)" % self.name)
+
+
+    # Returns the RangeReference that the name refers to in the workbook,
+    # which is a WorkbookIndex.
+    def resolve(self, workbook):
+        return workbook.range(self.name, self.sheet)
+
+
+
+# A base class that can be inherited from to encapsulate all the accessor logic
+# for different spreadsheet formats and spreadsheet reading libraries.
+# This differs from a CellValue because it's just the spreadsheet data. It can
+# be any cell in a spreadsheet and does not have to be associated with any
+# slang metadata.
+# There is a Cell for every cell that is read so the streaming cells below
+# use __slots__ and decode their attributes once, when they are made, rather
+# than each time that they are asked about them. The asserts in their
+# constructors only check the types of the arguments so they can be left out
+# with python -O.
+class Cell(object):
+    __slots__ = ()
+
+    # Returns the name of the group of cells that share this cell's formula
+    # or None if it doesn't share one. Only Office Open XML shares formulae
+    # between cells.
+    def shared_formula(self):
+        return None
+
+
+
+# Returns the letters that name the column at the given offset. For example,
+# 0 is A and 27 is AB.
+def column_name(column):
+
+    name = ""
+    column += 1
+    while column > 0:
+        (column, letter) = divmod(column - 1, 26)
+        name = chr(ord('A') + letter) + name
+
+    return name
+
+
+
+# Raised when a spreadsheet doesn't have the shape or the contents that the
+# metadata, or its file format, says that it should.
+# These check the data rather than the program so they are raised explicitly
+# and don't go away under python -O. It is an AssertionError so that callers
+# that catch those still catch it.
+class SpreadsheetError(AssertionError):
+    None
+
+
+
+# A problem with the contents of a cell that was found whilst extracting the
+# data from a spreadsheet.
+class CellError:
+
+    def __init__(self, row, column, name, message):
+
+        self.row     = row
+        self.column  = column
+        self.name    = name
+        self.message = message
+
+
+    def __str__(self):
+
+        if self.name == None:
+            return ("%s%d: %s" % (column_name(self.column), self.row + 1, self.message))
+
+        return ("%s%d (%s): %s" % (column_name(self.column), self.row + 1, self.name, self.message))
+
+
+    def __repr__(self):
+        return ("<CellError %s>" % self)
+
+
+
+# A wrapper around a Cell from an ODF Spreadsheet to encapsulate all the
+# accessor logic.
+class OdfCell(Cell):
+
+        def __init__(self, value, row, column):
+
+            from odf import opendocument
+
+            assert isinstance(value,  opendocument.element.Element), ("OdfCell.__init__: Expected type argument to be of type 'opendocument.element.Element' but we got %s." % value)
+            assert isinstance(row,    int),                          ("OdfCell.__init__: Expected row argument ot be of type 'int' but we got %s." % row)
+            assert isinstance(column, int),                          ("OdfCell.__init__: Expected column argument ot be of type 'int' but we got %s." % column)
+
+            self.cell   = value
+            self.row    = row
+            self.column = column
+
+
+        def __str__(self):
+            return ("<Row: %d, Column: %d, Value: %s>" % (self.row, self.column, self.value()))
+
+
+        def test_attribute(self, key, value):
+            try:
+                if self.cell.attributes[key] == value:
+                    return True
+                else:
+                    return False
+
+            except KeyError:
+                return False
+
+
+        # Returns True if the user specified this cell as a formula; False
+        # otherwise.
+        # The value calculated and cached by the spreadsheet program may be
+        # available via value().
+        def isformula(self):
+            return ((u'urn:oasis:names:tc:opendocument:xmlns:table:1.0', u'formula') in self.cell.attributes)
+
+
+        # Returns True if the value of this cell was formatted as a string by
+        # the spreadsheet program; False otherwise.
+        def isstring(self):
+            return self.test_attribute((u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value-type'), u'string')
+
+
+        # Returns True if the value of this cell was formatted as currency by
+        # the spreadsheet program; False otherwise.
+        def iscurrency(self):
+            return self.test_attribute((u'urn:org:documentfoundation:names:experimental:calc:xmlns:calcext:1.0', u'value-type'), u'currency')
+
+
+        # Returns the spreadsheet program's internal type designation for the
+        # cell.
+        # TODO: Hide the internal type designations behind an interface.
+        def type(self):
+            return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value-type')])
+
+
+        # Returns the raw value that the user entered into the cell in the
+        # spreadsheet program.
+        # Returns a string.
+        def value(self):
+
+            if self.isstring():
+                return unicode(self.cell)
+
+            else:
+                return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value')])
+
+
+        # Throws an exception if isformula() would have returned False.
+        # Returns the spreadsheet program's internal representation of the
+        # formula that the user specified in this cell.
+        # parse_formula() turns it into an expression tree.
+        def formula(self):
+            return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:table:1.0', u'formula')])
+
+
+        # Throws an exception if iscurrency() would have returned False.
+        # Returns the spreadsheet program's internal representation of which
+        # currency it thinks the cell's value is denominated in. For example,
+        # u'GBP'.
+        # TODO: Hide the internal currency designations behind an interface.
+        def currency(self):
+            return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'currency')])
+
+
+        # Returns the (value-type, value, currency, isformula) tuple that the
+        # slang Types convert in bulk. value-type is None if the cell is
+        # empty.
+        def raw(self):
+
+            attributes = self.cell.attributes
+            value_type = attributes.get((u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value-type'))
+
+            if value_type == u'string':
+                value = unicode(self.cell)
+            else:
+                value = attributes.get((u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value'))
+
+            return (value_type, value, attributes.get((u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'currency')), self.isformula())
+
+
+
+# The names that expat reports for the ODF elements and attributes that we are
+# interested in. expat joins the namespace URI and the local name with a
+# space.
+odf_office  = u'urn:oasis:names:tc:opendocument:xmlns:office:1.0 '
+odf_table   = u'urn:oasis:names:tc:opendocument:xmlns:table:1.0 '
+odf_calcext = u'urn:org:documentfoundation:names:experimental:calc:xmlns:calcext:1.0 '
+
+odf_table_table          = odf_table + u'table'
+odf_table_row            = odf_table + u'table-row'
+odf_table_cell           = odf_table + u'table-cell'
+odf_table_covered_cell   = odf_table + u'covered-table-cell'
+odf_rows_repeated        = odf_table + u'number-rows-repeated'
+odf_columns_repeated     = odf_table + u'number-columns-repeated'
+odf_formula              = odf_table + u'formula'
+odf_value_type           = odf_office + u'value-type'
+odf_value                = odf_office + u'value'
+odf_currency             = odf_office + u'currency'
+odf_calcext_value_type   = odf_calcext + u'value-type'
+
+
+# A Cell from an ODF Spreadsheet that has been read by the streaming OdsSheet
+# reader rather than loaded into an odfpy document.
+# It offers the same accessors as OdfCell but only holds on to the cell's
+# attributes and text rather than a live element from the document tree.
+# decoded is the cell's raw() tuple. Cells that are made from the same
+# attributes and text, such as repeated cells, can share it by passing in the
+# result of decode().
+class OdsCell(Cell):
+
+    __slots__ = ("attributes", "text", "row", "column", "decoded")
+
+    def __init__(self, attributes, text, row, column, decoded = None):
+
+        assert isinstance(attributes, dict),    ("OdsCell.__init__: Expected attributes argument to be of type 'dict' but we got %s." % attributes)
+        assert isinstance(text,       unicode), ("OdsCell.__init__: Expected text argument to be of type 'unicode' but we got %s." % text)
+        assert isinstance(row,        int),     ("OdsCell.__init__: Expected row argument ot be of type 'int' but we got %s." % row)
+        assert isinstance(column,     int),     ("OdsCell.__init__: Expected column argument ot be of type 'int' but we got %s." % column)
+
+        self.attributes = attributes
+        self.text       = text
+        self.row        = row
+        self.column     = column
+        self.decoded    = decoded if decoded != None else OdsCell.decode(attributes, text)
+
+
+    # Returns the (value-type, value, currency, isformula) tuple for a cell
+    # with the given attributes and text.
+    @staticmethod
+    def decode(attributes, text):
+
+        value_type = attributes.get(odf_value_type)
+
+        if value_type == u'string':
+            value = text
+        else:
+            value = attributes.get(odf_value)
+
+        return (value_type, value, attributes.get(odf_currency), (odf_formula in attributes))
+
+
+    def __str__(self):
+        return ("<Row: %d, Column: %d, Value: %s>" % (self.row, self.column, self.value()))
+
+
+    def test_attribute(self, key, value):
+        return (self.attributes.get(key) == value)
+
+
+    # Returns True if the user specified this cell as a formula; False
+    # otherwise.
+    def isformula(self):
+        return self.decoded[3]
+
+
+    # Returns True if the value of this cell was formatted as a string by
+    # the spreadsheet program; False otherwise.
+    def isstring(self):
+        return (self.decoded[0] == u'string')
+
+
+    # Returns True if the value of this cell was formatted as currency by
+    # the spreadsheet program; False otherwise.
+    def iscurrency(self):
+        return self.test_attribute(odf_calcext_value_type, u'currency')
+
+
+    # Returns the spreadsheet program's internal type designation for the
+    # cell.
+    def type(self):
+        return self.attributes[odf_value_type]
+
+
+    # Returns the raw value that the user entered into the cell in the
+    # spreadsheet program.
+    # Returns a string or None if the cell is empty.
+    def value(self):
+        return self.decoded[1]
+
+
+    # Throws an exception if isformula() would have returned False.
+    # Returns the spreadsheet program's internal representation of the
+    # formula that the user specified in this cell.
+    def formula(self):
+        return self.attributes[odf_formula]
+
+
+    # Throws an exception if iscurrency() would have returned False.
+    # Returns the spreadsheet program's internal representation of which
+    # currency it thinks the cell's value is denominated in. For example,
+    # u'GBP'.
+    def currency(self):
+        return self.attributes[odf_currency]
+
+
+    # Returns the (value-type, value, currency, isformula) tuple that the
+    # slang Types convert in bulk. value-type is None if the cell is empty.
+    def raw(self):
+        return self.decoded
+
+
+
+# The names that expat reports for the Office Open XML elements and attributes
+# that we are interested in.
+xlsx_main          = u'http://schemas.openxmlformats.org/spreadsheetml/2006/main '
+xlsx_relationships = u'http://schemas.openxmlformats.org/officeDocument/2006/relationships '
+xlsx_package       = u'http://schemas.openxmlformats.org/package/2006/relationships '
+
+xlsx_sheet_data    = xlsx_main + u'sheetData'
+xlsx_row           = xlsx_main + u'row'
+xlsx_cell          = xlsx_main + u'c'
+xlsx_cell_value    = xlsx_main + u'v'
+xlsx_cell_formula  = xlsx_main + u'f'
+xlsx_inline_string = xlsx_main + u'is'
+xlsx_text          = xlsx_main + u't'
+xlsx_string_item   = xlsx_main + u'si'
+xlsx_phonetic_run  = xlsx_main + u'rPh'
+xlsx_sheet         = xlsx_main + u'sheet'
+xlsx_defined_name  = xlsx_main + u'definedName'
+xlsx_num_fmt       = xlsx_main + u'numFmt'
+xlsx_cell_xfs      = xlsx_main + u'cellXfs'
+xlsx_xf            = xlsx_main + u'xf'
+xlsx_relationship  = xlsx_package + u'Relationship'
+xlsx_rid           = xlsx_relationships + u'id'
+
+# The keys of the attributes that XlsxSheet works out for each cell.
+# Office Open XML spreads what ODF keeps in the attributes of a cell across the
+# cell's own attributes, its child elements, the shared strings table and the
+# number formats in the styles so we gather it up into a dictionary that uses
+# the same value types as ODF.
+xlsx_value_type    = u'value-type'
+xlsx_currency      = u'currency'
+xlsx_formula       = u'formula'
+xlsx_shared        = u'shared'
+
+
+# A Cell from an Office Open XML Workbook that has been read by the streaming
+# XlsxSheet reader.
+# attributes is a dictionary with the xlsx_value_type, xlsx_currency,
+# xlsx_formula and xlsx_shared of the cell and text is its value as it
+# appears in the file or, for strings, the string itself. decoded is as for
+# OdsCell.
+class XlsxCell(Cell):
+
+    __slots__ = ("attributes", "text", "row", "column", "decoded")
+
+    def __init__(self, attributes, text, row, column, decoded = None):
+
+        assert isinstance(attributes, dict),    ("XlsxCell.__init__: Expected attributes argument to be of type 'dict' but we got %s." % attributes)
+        assert isinstance(text,       unicode), ("XlsxCell.__init__: Expected text argument to be of type 'unicode' but we got %s." % text)
+        assert isinstance(row,        int),     ("XlsxCell.__init__: Expected row argument ot be of type 'int' but we got %s." % row)
+        assert isinstance(column,     int),     ("XlsxCell.__init__: Expected column argument ot be of type 'int' but we got %s." % column)
+
+        self.attributes = attributes
+        self.text       = text
+        self.row        = row
+        self.column     = column
+        self.decoded    = decoded if decoded != None else XlsxCell.decode(attributes, text)
+
+
+    # Returns the (value-type, value, currency, isformula) tuple for a cell
+    # with the given attributes and text.
+    @staticmethod
+    def decode(attributes, text):
+
+        value_type = attributes.get(xlsx_value_type)
+
+        return (value_type, (text if value_type != None else None), attributes.get(xlsx_currency), (xlsx_formula in attributes))
+
+
+    def __str__(self):
+        return ("<Row: %d, Column: %d, Value: %s>" % (self.row, self.column, self.value()))
+
+
+    def test_attribute(self, key, value):
+        return (self.attributes.get(key) == value)
+
+
+    # Returns True if the user specified this cell as a formula; False
+    # otherwise.
+    def isformula(self):
+        return self.decoded[3]
+
+
+    # Returns True if the value of this cell is a string; False otherwise.
+    def isstring(self):
+        return (self.decoded[0] == u'string')
+
+
+    # Returns True if the value of this cell was formatted as currency by
+    # the spreadsheet program; False otherwise.
+    def iscurrency(self):
+        return self.test_attribute(xlsx_value_type, u'currency')
+
+
+    # Returns the type of the cell, using the same names as ODF. For example,
+    # u'string', u'float' or u'currency'.
+    def type(self):
+        return self.attributes[xlsx_value_type]
+
+
+    # Returns the raw value that the user entered into the cell in the
+    # spreadsheet program.
+    # Returns a string or None if the cell is empty.
+    def value(self):
+        return self.decoded[1]
+
+
+    # Returns the formula that the user specified in this cell. Cells that
+    # share a formula only have it in the first cell of the group so this is
+    # empty for the others.
+    def formula(self):
+        return self.attributes[xlsx_formula]
+
+
+    # Returns the si of the shared formula group that this cell belongs to or
+    # None if it doesn't share a formula.
+    def shared_formula(self):
+        return self.attributes.get(xlsx_shared)
+
+
+    # Returns the ISO 4217 code for the currency that the cell's number format
+    # displays. For example, u'GBP'.
+    def currency(self):
+        return self.attributes[xlsx_currency]
+
+
+    # Returns the (value-type, value, currency, isformula) tuple that the
+    # slang Types convert in bulk. value-type is None if the cell is empty.
+    def raw(self):
+        return self.decoded
+
+
+
+# A slang representation of some data from a spreadsheet cell.
+# It consists of a wrapper around the actual contents of a cell along with the
+# slang type annotations required to validate and extract it.
+class CellValue(object):
+
+    __slots__ = ("type", "name", "cell")
+
+    def __init__(self, type, name, value):
+
+        assert isinstance(type,  Type),    ("CellValue.__init__: Expected type argument to be of type 'Type' but we got %s." % type)
+        assert isinstance(name,  unicode), ("CellValue.__init__: Expected name argument to be of type 'unicode' but we got %s." % name)
+        assert isinstance(value, Cell),    ("CellValue.__init__: Expected value argument to be of type 'Cell' but we got %s." % value)
+
+        self.type = type
+        self.name = name
+        self.cell = value
+
+
+    # TODO: Remove this: it's just a hack for poc.py to easily display things.
+    def __repr__(self):
+        return ("<%s, %s, %s>" % (self.type, self.name, self.value()))
+
+
+    # Returns a CellError if the contents of the cell are not valid for the
+    # slang type or None if they are.
+    def check(self):
+
+        message = self.type.validate(self.cell)
+        if message != None:
+            return CellError(self.cell.row, self.cell.column, self.name, message)
+
+        return None
+
+
+    # Returns the raw value from the spreadsheet as a string.
+    def value(self):
+        return self.cell.value()
+
+
+    # Returns the value converted to the slang type's Python representation.
+    def convert(self):
+        return self.type.convert(self.cell)
+
+
+    # Returns a CellValue for a cell with the same contents as this one in the
+    # given row of the same column, as for the repeated rows of a block.
+    def at_row(self, row):
+
+        cell = self.cell
+
+        return CellValue(self.type, self.name, cell.__class__(cell.attributes, cell.text, row, cell.column, cell.decoded))
+
+
+
+# A column of typed data extracted from a spreadsheet.
+# Cells are appended to the column in their raw form as they are read and then
+# convert() converts the whole column in one go using the slang type's
+# convert_column(). After that the values are kept in a compact buffer that
+# depends on the type of the column: an array('d') of floats for numbers and
+# formulae, an array('l') of integer pence for currency and a list of strings,
+# each of which is only stored once, for strings. valid holds a 1 for each
+# value that was present and valid in the spreadsheet and a 0 for each one
+# that was empty or invalid, in which case the value in the buffer is just a
+# placeholder. errors holds a CellError for each invalid value.
+# Columns do not hold any references back to the spreadsheet that they came
+# from.
+class Column:
+
+    def __init__(self, name, type):
+
+        assert isinstance(type,  Type),    ("Column.__init__: Expected type argument to be of type 'Type' but we got %s." % type)
+        assert isinstance(name,  unicode), ("Column.__init__: Expected name argument to be of type 'unicode' but we got %s." % name)
+
+        self.name    = name
+        self.type    = type
+        self.raw     = []
+        self.rows    = array.array('l')
+        self.columns = array.array('l')
+        self.values  = None
+        self.valid   = None
+        self.errors  = []
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __repr__(self):
+        return ("<Column %s, %s, %d values>" % (self.name, self.type, len(self)))
+
+
+    # Adds the raw contents of the cell to the end of the column.
+    def append(self, cell):
+
+        self.raw.append(cell.raw())
+        self.rows.append(cell.row)
+        self.columns.append(cell.column)
+
+
+    # Converts all the raw values that have been appended to the column.
+    def convert(self):
+
+        (self.values, self.valid, errors) = self.type.convert_column(self.raw)
+
+        self.raw    = None
+        self.errors = [CellError(self.rows[i], self.columns[i], self.name, message) for (i, message) in errors]
+
+
+    # Adds the values of another converted column of the same type, which
+    # holds the rows that follow ours, to the end of the column.
+    def extend(self, other):
+
+        assert (other.type.__class__ == self.type.__class__), ("Column.extend: Expected a column of type %s but we got %s." % (self.type, other.type))
+
+        self.rows.extend(other.rows)
+        self.columns.extend(other.columns)
+        self.values.extend(other.values)
+        self.valid.extend(other.valid)
+        self.errors.extend(other.errors)
+
+
+    # Columns are pickled with their arrays as strings, which are much smaller
+    # and quicker to load than the lists that arrays pickle as.
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        for name in ("rows", "columns", "values"):
+            if isinstance(state[name], array.array):
+                state[name] = (state[name].typecode, state[name].tostring())
+
+        return state
+
+
+    def __setstate__(self, state):
+
+        for name in ("rows", "columns", "values"):
+            if isinstance(state[name], tuple):
+                (typecode, data) = state[name]
+                state[name] = array.array(typecode)
+                state[name].fromstring(data)
+
+        self.__dict__.update(state)
+
+
+    # Returns the column as a NumPy masked array in which the invalid values
+    # are masked out.
+    # NumPy is only needed if this procedure is used.
+    def numpy(self):
+
+        import numpy
+
+        if self.type.typecode == None:
+            values = numpy.array(self.values, dtype = object)
+        else:
+            values = numpy.frombuffer(self.values, dtype = self.values.typecode)
+
+        mask = (numpy.frombuffer(self.valid, dtype = numpy.uint8) == 0)
+
+        return numpy.ma.masked_array(values, mask = mask)
+
+
+
+###############################################################################
+# Handlers for the Datatypes that can be declared in Spreadsheet Metadata.
+
+# The base class for all the types.
+# Each type converts and validates a whole column of raw values, as returned by
+# Cell.raw(), at a time with convert_column(). That returns a (values, valid,
+# errors) tuple where values is a buffer of the converted values, valid is a
+# bytearray with a 1 for each value that was present and valid and errors is
+# a list of (index, message) tuples for the ones that were invalid. Empty cells
+# are not valid but they are not errors either.
+# typecode is the array typecode of the values buffer or None if it is a list.
+# The procedures that deal with single cells are built on convert_column so
+# that there is only one definition of what each type accepts.
+class Type:
+
+    typecode = None
+
+
+    def convert_column(self, raws):
+        return ([value for (value_type, value, currency, formula) in raws], bytearray([1]) * len(raws), [])
+
+
+    # Returns the value of the cell as the type's Python representation.
+    # Raises a ValueError if the cell is not valid for the type.
+    def convert(self, cell):
+
+        (values, valid, errors) = self.convert_column([cell.raw()])
+        if errors:
+            raise ValueError(errors[0][1])
+
+        return self.python(values[0]) if valid[0] else None
+
+
+    # Returns a message describing why the cell is not valid for the type or
+    # None if it is.
+    def validate(self, cell):
+
+        (values, valid, errors) = self.convert_column([cell.raw()])
+        if errors:
+            return errors[0][1]
+
+        return None
+
+
+    # Turns a value from the values buffer into the type's Python
+    # representation.
+    def python(self, value):
+        return value
+
+
+# Any old string.
+class slang_String(Type):
+
+    def __str__(self):
+        return "slang::String"
+
+
+    def convert_column(self, raws):
+
+        values  = []
+        valid   = bytearray(len(raws))
+        errors  = []
+        strings = {}
+
+        for (i, (value_type, value, currency, formula)) in enumerate(raws):
+            if value_type == u'string':
+                values.append(strings.setdefault(value, value))
+                valid[i] = 1
+            else:
+                values.append(None)
+                if value_type != None:
+                    errors.append((i, "Expected a string but we got a %s, %s." % (value_type, value)))
+
+        return (values, valid, errors)
+
+
+pence_re = re.compile(r"(-?[0-9]+)(?:\.([0-9]{0,2}))?\Z")
+
+# Currency in Sterling, excluding VAT.
+# Columns store it as a whole number of pence and it converts to an exact
+# Decimal number of pounds.
+class slang_GBPxVAT(Type):
+
+    typecode = 'l'
+
+    def __str__(self):
+        return "slang::GBPxVAT"
+
+
+    def convert_column(self, raws):
+
+        values  = array.array(self.typecode, [0]) * len(raws)
+        valid   = bytearray(len(raws))
+        errors  = []
+        Decimal = decimal.Decimal
+        even    = decimal.ROUND_HALF_EVEN
+
+        for (i, (value_type, value, currency, formula)) in enumerate(raws):
+            if value_type == None:
+                continue
+            if value_type != u'currency':
+                errors.append((i, "Expected currency but we got a %s, %s." % (value_type, value)))
+                continue
+            if currency != u'GBP':
+                errors.append((i, "Expected an amount in GBP but we got one in %s, %s." % (currency, value)))
+                continue
+            # Amounts are almost always plain pounds and pence so we avoid
+            # the cost of a Decimal unless we have to round.
+            plain = pence_re.match(value) if value != None else None
+            try:
+                if plain != None:
+                    values[i] = int(plain.group(1) + (plain.group(2) or "").ljust(2, "0"))
+                else:
+                    values[i] = int((Decimal(value).scaleb(2)).to_integral_value(even))
+                valid[i]  = 1
+            except (TypeError, decimal.InvalidOperation):
+                errors.append((i, "Could not read the amount %s." % value))
+
+        return (values, valid, errors)
+
+
+    def python(self, value):
+        return decimal.Decimal(value).scaleb(-2)
+
+
+# Any old number.
+class slang_Number(Type):
+
+    typecode = 'd'
+
+    def __str__(self):
+        return "slang::Number"
+
+
+    def convert_column(self, raws):
+
+        values  = array.array(self.typecode, [0.0]) * len(raws)
+        valid   = bytearray(len(raws))
+        errors  = []
+
+        for (i, (value_type, value, currency, formula)) in enumerate(raws):
+            if value_type == None:
+                continue
+            if value_type == u'string':
+                errors.append((i, "Expected a number but we got a string, %s." % value))
+                continue
+            try:
+                values[i] = float(value)
+                valid[i]  = 1
+            except (TypeError, ValueError):
+                errors.append((i, "Could not read the number %s." % value))
+
+        return (values, valid, errors)
+
+
+# Any old formula.
+# Columns store the value that the spreadsheet program calculated for it.
+class slang_Formula(Type):
+
+    typecode = 'd'
+
+    def __str__(self):
+        return "slang::Formula"
+
+
+    def convert_column(self, raws):
+
+        values  = array.array(self.typecode, [0.0]) * len(raws)
+        valid   = bytearray(len(raws))
+        errors  = []
+
+        for (i, (value_type, value, currency, formula)) in enumerate(raws):
+            if value_type == None:
+                continue
+            if not formula:
+                errors.append((i, "Expected a formula but we got a %s, %s." % (value_type, value)))
+                continue
+            try:
+                values[i] = float(value)
+                valid[i]  = 1
+            except (TypeError, ValueError):
+                errors.append((i, "Expected the formula to calculate a number but we got a %s, %s." % (value_type, value)))
+
+        return (values, valid, errors)
+
+
+
+###############################################################################
+# Formulae.
+#
+# Formulae in the data range are parsed into expression trees so that the
+# values that the spreadsheet program cached for them can be checked against
+# their inputs. ODF formulae look like of:=[.B4]*[.C4] and Office Open XML
+# ones look like B4*C4. Both are tokenised with their references made
+# relative to the cell that the formula is in, so a formula that has been
+# filled down a column produces the same tokens, and hence the same tree, in
+# every row. Each distinct tree is then evaluated once for all the rows that
+# share it: first with floats, as the spreadsheet program does, and then, for
+# the cells that don't seem to match, exactly with Decimals.
+# Only arithmetic on numbers and references to cells on the same sheet is
+# supported, along with the SUM, ABS and ROUND functions. Anything else raises
+# a ValueError and the formula is not checked.
+
+# A coordinate in a reference is (True, n) if it is absolute, as in $B$4, or
+# (False, offset) from the row or column of the formula's own cell.
+formula_token_re = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<ods>\[(?P<ods_sheet>[^\].]*)\.(?P<c1>\$?[A-Za-z]+)(?P<r1>\$?\d+)(?::(?P<ods_sheet2>[^\].]*)\.(?P<c2>\$?[A-Za-z]+)(?P<r2>\$?\d+))?\])
+    | (?P<function>[A-Za-z][A-Za-z0-9.]*)\s*\(
+    | (?P<sheet>(?:'(?:[^']|'')*'|[A-Za-z0-9_.]+)!)
+    | (?P<xlsx>(?P<xc1>\$?[A-Za-z]{1,3})(?P<xr1>\$?\d+)(?::(?P<xc2>\$?[A-Za-z]{1,3})(?P<xr2>\$?\d+))?)
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    | (?P<operator>[-+*/^%(),;])
+    | (?P<other>.)
+    """, re.VERBOSE | re.UNICODE)
+
+formula_columns = {}
+
+# Returns the coordinate for the column letters or row digits of a reference
+# from a formula in the given column or row. column is True for letters.
+def formula_coordinate(spec, origin, column):
+
+    absolute = spec.startswith(u'$')
+    spec     = spec.lstrip(u'$')
+
+    if column:
+        n = formula_columns.get(spec)
+        if n == None:
+            n = formula_columns[spec] = CellReference(str(spec.upper()) + "1").column
+    else:
+        n = int(spec) - 1
+
+    return (True, n) if absolute else (False, n - origin)
+
+
+# Returns a tuple of tokens for the formula text from the cell at row,
+# column. References are ("cell", row, column) or ("range", (row, column),
+# (row, column)) tuples of coordinates, numbers are ("number", text) and
+# everything else is a string.
+# Raises a ValueError if the formula uses anything that we can't evaluate.
+def formula_tokens(text, row, column):
+
+    if text.startswith(u'of:='):
+        text = text[4:]
+    elif text.startswith(u'='):
+        text = text[1:]
+
+    tokens = []
+
+    for match in formula_token_re.finditer(text):
+        kind = match.lastgroup
+        if kind in ("ods", "xlsx"):
+            if kind == "ods":
+                if match.group("ods_sheet") or match.group("ods_sheet2"):
+                    raise ValueError("References to other sheets are not supported. We got %s." % match.group(0))
+                (c1, r1, c2, r2) = match.group("c1", "r1", "c2", "r2")
+            else:
+                (c1, r1, c2, r2) = match.group("xc1", "xr1", "xc2", "xr2")
+            start = (formula_coordinate(r1, row, False), formula_coordinate(c1, column, True))
+            if c2 == None:
+                tokens.append(("cell",) + start)
+            else:
+                tokens.append(("range", start, (formula_coordinate(r2, row, False), formula_coordinate(c2, column, True))))
+        elif kind == "function":
+            tokens.append(("function", match.group("function").upper()))
+        elif kind == "number":
+            tokens.append(("number", match.group("number")))
+        elif kind == "operator":
+            tokens.append(match.group("operator"))
+        elif kind == "space":
+            continue
+        elif kind == "sheet":
+            raise ValueError("References to other sheets are not supported. We got %s." % match.group(0))
+        else:
+            raise ValueError("Unsupported formula syntax %s." % match.group(0))
+
+    return tuple(tokens)
+
+
+# Rounds x to n decimal places, with halves rounded away from zero as
+# spreadsheet programs do. x may be a float or a Decimal.
+def formula_round(x, n):
+
+    if isinstance(x, decimal.Decimal):
+        return x.quantize(decimal.Decimal(1).scaleb(-int(n)), decimal.ROUND_HALF_UP)
+
+    return round(x, int(n))
+
+
+# The functions that formulae can use. Aggregates take any number of
+# arguments, which may be ranges, and the others take a fixed number of
+# numbers. They work with both floats and Decimals.
+formula_aggregates = {
+        u'SUM'   : lambda values: sum(values, 0),
+        }
+
+formula_functions = {
+        u'ABS'   : (1, abs),
+        u'ROUND' : (2, formula_round),
+        }
+
+
+# A recursive descent parser that turns the tokens from formula_tokens() into
+# a tree of tuples:
+#   ("number", text)
+#   ("cell", row, column)
+#   (operator, left, right)             for +, -, *, / and ^
+#   ("negate", x) and ("percent", x)
+#   ("call", name, (arguments...))      where arguments to aggregates may be
+#                                       ("range", start, end)
+# As in spreadsheets, unary minus binds more tightly than ^.
+class FormulaParser:
+
+    def __init__(self, tokens):
+
+        self.tokens   = tokens
+        self.position = 0
+
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+
+    def next(self):
+
+        token = self.peek()
+        if token == None:
+            raise ValueError("The formula ends unexpectedly.")
+        self.position += 1
+
+        return token
+
+
+    def expect(self, token):
+
+        got = self.next()
+        if got != token:
+            raise ValueError("Expected %s in the formula but we got %s." % (token, got))
+
+
+    def parse(self):
+
+        tree = self.additive()
+        if self.peek() != None:
+            raise ValueError("Unexpected %s in the formula." % (self.peek(),))
+
+        return tree
+
+
+    def additive(self):
+
+        tree = self.multiplicative()
+        while self.peek() in ("+", "-"):
+            tree = (self.next(), tree, self.multiplicative())
+
+        return tree
+
+
+    def multiplicative(self):
+
+        tree = self.power()
+        while self.peek() in ("*", "/"):
+            tree = (self.next(), tree, self.power())
+
+        return tree
+
+
+    def power(self):
+
+        tree = self.unary()
+        while self.peek() == "^":
+            tree = (self.next(), tree, self.unary())
+
+        return tree
+
+
+    def unary(self):
+
+        if self.peek() == "-":
+            self.next()
+            return ("negate", self.unary())
+        if self.peek() == "+":
+            self.next()
+            return self.unary()
+
+        tree = self.primary()
+        while self.peek() == "%":
+            self.next()
+            tree = ("percent", tree)
+
+        return tree
+
+
+    def primary(self):
+
+        token = self.next()
+
+        if token == "(":
+            tree = self.additive()
+            self.expect(")")
+            return tree
+
+        if isinstance(token, tuple) and (token[0] in ("number", "cell")):
+            return token
+
+        if isinstance(token, tuple) and (token[0] == "function"):
+            return self.call(token[1])
+
+        raise ValueError("Unexpected %s in the formula." % (token,))
+
+
+    def call(self, name):
+
+        aggregate = (name in formula_aggregates)
+        if not (aggregate or (name in formula_functions)):
+            raise ValueError("Unsupported function %s in the formula." % name)
+
+        arguments = []
+        if self.peek() != ")":
+            while True:
+                token = self.peek()
+                if aggregate and isinstance(token, tuple) and (token[0] == "range"):
+                    arguments.append(self.next())
+                else:
+                    arguments.append(self.additive())
+                if self.peek() not in (";", ","):
+                    break
+                self.next()
+        self.expect(")")
+
+        if (not aggregate) and (len(arguments) != formula_functions[name][0]):
+            raise ValueError("Expected %d arguments to %s but we got %d." % (formula_functions[name][0], name, len(arguments)))
+
+        return ("call", name, tuple(arguments))
+
+
+# Returns the tree for the formula text from the cell at row, column.
+# Raises a ValueError if we can't evaluate the formula.
+def parse_formula(text, row, column):
+    return FormulaParser(formula_tokens(text, row, column)).parse()
+
+
+# Applies proc to each tuple of values from the vectors. The result is None
+# wherever any of the values is None or proc fails, as it does for division
+# by zero.
+def formula_apply(proc, *vectors):
+
+    result = []
+    for values in itertools.izip(*vectors):
+        if None in values:
+            result.append(None)
+            continue
+        try:
+            result.append(proc(*values))
+        except (ArithmeticError, ValueError):
+            result.append(None)
+
+    return result
+
+
+formula_operators = {
+        "+" : lambda x, y: x + y,
+        "-" : lambda x, y: x - y,
+        "*" : lambda x, y: x * y,
+        "/" : lambda x, y: x / y,
+        "^" : lambda x, y: x ** y,
+        }
+
+
+# Turns a float from the inputs, or the text of a number from a formula, into
+# a Decimal. The shortest repr of a float is the number as it was written in
+# the spreadsheet.
+def formula_decimal(value):
+
+    if isinstance(value, float):
+        value = repr(value)
+
+    return decimal.Decimal(value)
+
+
+# Evaluates the formula tree for a batch of cells in the given rows of the
+# given column and returns a list with a number for each of them, or None
+# where it can't be calculated. number turns the floats from the inputs and
+# the text of numbers in the formula into the type to calculate with, which
+# is float or formula_decimal.
+# inputs maps each column to a (first_row, values) tuple where values is an
+# array('d') of the numbers in that column from first_row onwards. Empty
+# cells are 0.0 and cells that aren't numbers are NaN. References to cells
+# outside inputs can't be calculated.
+def evaluate_formula(tree, rows, column, inputs, number = float):
+
+    kind = tree[0]
+
+    if kind == "number":
+        return [number(tree[1])] * len(rows)
+
+    if kind == "cell":
+        return formula_lookup(tree[1], tree[2], rows, column, inputs, number)
+
+    if kind == "range":
+        ((r1, c1), (r2, c2)) = tree[1:]
+        cells = []
+        for r in range(r1[1], r2[1] + 1):
+            for c in range(c1[1], c2[1] + 1):
+                cells.append(formula_lookup((r1[0], r), (c1[0], c), rows, column, inputs, number))
+        return [list(values) for values in itertools.izip(*cells)]
+
+    if kind in formula_operators:
+        return formula_apply(formula_operators[kind], evaluate_formula(tree[1], rows, column, inputs, number), evaluate_formula(tree[2], rows, column, inputs, number))
+
+    if kind == "negate":
+        return formula_apply(lambda x: -x, evaluate_formula(tree[1], rows, column, inputs, number))
+
+    if kind == "percent":
+        return formula_apply(lambda x: x / 100, evaluate_formula(tree[1], rows, column, inputs, number))
+
+    if kind == "call":
+        arguments = [evaluate_formula(argument, rows, column, inputs, number) for argument in tree[2]]
+        if tree[1] in formula_aggregates:
+            aggregate = formula_aggregates[tree[1]]
+            return formula_apply(lambda *values: aggregate(formula_flatten(values)), *arguments)
+        else:
+            return formula_apply(formula_functions[tree[1]][1], *arguments)
+
+    raise AssertionError("evaluate_formula: Unexpected node in the formula tree. We got %s." % (tree,))
+
+
+# Returns the list of values for a batch of aggregate arguments, some of
+# which may be lists of values from ranges.
+def formula_flatten(values):
+
+    result = []
+    for value in values:
+        if isinstance(value, list):
+            if None in value:
+                raise ValueError("Range contains a value that isn't a number.")
+            result.extend(value)
+        else:
+            result.append(value)
+
+    return result
+
+
+# Returns the values of the cell at the row and column coordinates relative to
+# each of the rows in the given column.
+def formula_lookup(row, column, rows, origin, inputs, number):
+
+    c = column[1] if column[0] else (origin + column[1])
+    if c not in inputs:
+        return [None] * len(rows)
+
+    (first_row, values) = inputs[c]
+    result = []
+    for r in rows:
+        r = row[1] if row[0] else (r + row[1])
+        i = r - first_row
+        if (0 <= i < len(values)) and (values[i] == values[i]):
+            result.append(number(values[i]))
+        else:
+            result.append(None)
+
+    return result
+
+
+# How far a cached value may be from the value that we calculate, relative to
+# the larger of 1 and the size of the cached value. Spreadsheet programs
+# calculate with binary floating point so their results are not exact.
+formula_tolerance = "1e-9"
+
+
+# Returns True if the calculated value is too far from the cached one. number
+# is as for evaluate_formula().
+def formula_mismatch(calculated, cached, number = float):
+    return abs(calculated - cached) > (number(formula_tolerance) * max(1, abs(cached)))
+
+# The value types of the cells whose values formulae can use as numbers.
+formula_numeric_types = (u'float', u'currency', u'percentage')
+
+
+
+###############################################################################
+# Aggregates.
+#
+# declare-aggregate ties a cell, such as the total under a column, to the
+# sum, count, minimum, maximum or average of the valid values in one of the
+# columns that the metadata declares. The aggregates are worked out as the
+# rows stream past, a batch of cells at a time, so the rows don't have to be
+# kept or read again, and the cells that are tied to them are read in the
+# same pass as the data. Each cell's value is then reconciled with what we
+# worked out: exactly, in whole pence, for currency and within
+# formula_tolerance for other numbers, which the spreadsheet program only
+# kept as floats.
+
+aggregate_functions = ("sum", "count", "min", "max", "average")
+
+
+# Adds x to partials, a list of floats that don't overlap and whose sum is
+# exactly the sum of everything that has been added to it, as in math.fsum().
+def exact_add(partials, x):
+
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            (x, y) = (y, x)
+        high = x + y
+        low  = y - (high - x)
+        if low:
+            partials[i] = low
+            i += 1
+        x = high
+
+    partials[i:] = [x]
+
+
+# Keeps the count, total, minimum and maximum of the valid values in a column
+# as the raw values of its cells are appended. Each value may stand for a
+# block of count repeated rows. The raw values are converted batch at a time
+# with the type's convert_column() so there is only one definition of what
+# each type accepts. Only the values of String columns are counted.
+# Currency is totalled in whole pence, in total, and floats are totalled
+# exactly, in partials, so the totals don't depend on the order in which the
+# values are added.
+class ColumnSummary:
+
+    batch = 256
+
+    def __init__(self, name, type):
+
+        assert isinstance(type, Type), ("ColumnSummary.__init__: Expected type argument to be of type 'Type' but we got %s." % type)
+
+        self.name     = name
+        self.type     = type
+        self.raw      = []
+        self.counts   = []
+        self.count    = 0
+        self.total    = 0
+        self.partials = []
+        self.minimum  = None
+        self.maximum  = None
+
+
+    def __repr__(self):
+        return ("<ColumnSummary %s, %s, %d values>" % (self.name, self.type, self.count))
+
+
+    # Adds the raw value of a cell, as returned by Cell.raw(), for count rows.
+    def append(self, raw, count = 1):
+
+        self.raw.append(raw)
+        self.counts.append(count)
+
+        if len(self.raw) >= self.batch:
+            self.flush()
+
+
+    # Folds the values that have been appended into the running aggregates.
+    def flush(self):
+
+        if not self.raw:
+            return
+
+        (values, valid, errors) = self.type.convert_column(self.raw)
+        self.fold(values, valid, self.counts)
+
+        self.raw    = []
+        self.counts = []
+
+
+    # Folds a buffer of converted values, as returned by convert_column() and
+    # kept by Columns, into the running aggregates. valid says which of them
+    # to use and counts, if it is given, how many rows each of them stands
+    # for.
+    def fold(self, values, valid, counts = None):
+
+        present = list(itertools.compress(values, valid))
+        if not present:
+            return
+
+        repeats = []
+        if (counts != None) and (counts.count(1) != len(counts)):
+            repeats = [(value, count - 1) for (value, ok, count) in itertools.izip(values, valid, counts) if ok and (count > 1)]
+
+        self.count += len(present) + sum(count for (value, count) in repeats)
+
+        if self.type.typecode == None:
+            return
+
+        self.minimum = min(present) if (self.minimum == None) else min(self.minimum, min(present))
+        self.maximum = max(present) if (self.maximum == None) else max(self.maximum, max(present))
+
+        if self.type.typecode != 'd':
+            self.total += sum(present) + sum(value * count for (value, count) in repeats)
+            return
+
+        for value in present:
+            exact_add(self.partials, value)
+
+        # Doubling a float is exact so repeated values are added a power of
+        # two at a time.
+        for (value, count) in repeats:
+            while count:
+                if count & 1:
+                    exact_add(self.partials, value)
+                value *= 2
+                count >>= 1
+
+
+    # Adds the aggregates of other, which summarises more of the same column,
+    # to ours.
+    def merge(self, other):
+
+        self.flush()
+        other.flush()
+
+        self.count += other.count
+        self.total += other.total
+        for partial in other.partials:
+            exact_add(self.partials, partial)
+        if (other.minimum != None) and ((self.minimum == None) or (other.minimum < self.minimum)):
+            self.minimum = other.minimum
+        if (other.maximum != None) and ((self.maximum == None) or (other.maximum > self.maximum)):
+            self.maximum = other.maximum
+
+
+    # Returns the value of the aggregate function in the Python
+    # representation of the column's type, or None if there are no values
+    # for it to be taken over.
+    def value(self, function):
+
+        self.flush()
+        python = self.type.python
+        total  = math.fsum(self.partials) if (self.type.typecode == 'd') else self.total
+
+        if function == "count":
+            return self.count
+        elif function == "sum":
+            return python(total)
+        elif function == "min":
+            return python(self.minimum) if (self.minimum != None) else None
+        elif function == "max":
+            return python(self.maximum) if (self.maximum != None) else None
+        elif self.count > 0:
+            return python(total) / self.count
+        else:
+            return None
+
+
+# Returns None if the raw value of a cell, as returned by Cell.raw(), matches
+# value, the result of the aggregate function. Otherwise returns a description
+# of what the cell has instead.
+# Decimals come from currency, whose sums, minima and maxima are exact, so the
+# cell only has to match them to the penny. Averages and floats are compared
+# within formula_tolerance.
+def aggregate_mismatch(function, value, raw):
+
+    (value_type, text, currency, formula) = raw
+
+    if value_type == None:
+        return (None if value == None else "an empty cell")
+
+    if value_type not in formula_numeric_types:
+        return ("a %s, %s" % (value_type, text))
+
+    try:
+        cached = decimal.Decimal(text)
+    except (TypeError, decimal.InvalidOperation):
+        return text
+
+    if value == None:
+        pass
+    elif function == "count":
+        if cached == value:
+            return None
+    elif isinstance(value, decimal.Decimal):
+        if function == "average":
+            if not formula_mismatch(value, cached, decimal.Decimal):
+                return None
+        elif cached.quantize(decimal.Decimal("0.01")) == value:
+            return None
+    elif not formula_mismatch(float(value), float(cached)):
+        return None
+
+    return text
+
+
+# Works out the aggregates that the metadata declares for a table as the
+# rows of its data are read and picks out the cells that they are tied to as
+# they go past. See instance.iter_range().
+# declarations is a list of (CellReference, function, name) tuples and plan
+# is the ExtractionPlan that the rows are being read with, starting at the
+# first row of the range that is read. If columns is a sorted list of the
+# columns that are being read then aggregates of columns that aren't in the
+# plan, or that are tied to cells that aren't in columns, are left out.
+# If capture is False then the cells are left to another Aggregator that
+# reads the end of the range. If tap is False then the rows aren't added as
+# they are read and the Columns that they are read into are given to
+# summarise() instead.
+# Aggregators don't hold any references to the spreadsheet so they can be
+# passed between processes.
+class Aggregator:
+
+    def __init__(self, declarations, plan, columns = None, capture = True, tap = True):
+
+        assert isinstance(plan, ExtractionPlan), ("Aggregator.__init__: Expected plan argument to be of type 'ExtractionPlan' but we got %s." % plan)
+
+        types = {}
+        for row in plan.rows:
+            for (name, type, converter) in row:
+                types[name] = type
+
+        self.declarations = [(cell, function, name) for (cell, function, name) in declarations if (name in types) and ((columns == None) or (cell.column in columns))]
+        self.summaries    = collections.OrderedDict()
+        for (cell, function, name) in self.declarations:
+            if name not in self.summaries:
+                self.summaries[name] = ColumnSummary(name, types[name])
+
+        # The (offset, ColumnSummary) of each summarised cell in each row of
+        # the plan.
+        self.taps = tuple(tuple((c, self.summaries[name]) for (c, (name, type, converter)) in enumerate(row) if tap and (name in self.summaries)) for row in plan.rows)
+
+        # The rows of the cells that we pick out in each column, the last of
+        # them and the raw values of the ones that we've found.
+        self.wanted   = {}
+        self.last_row = -1
+        self.captured = {}
+        if capture:
+            for (cell, function, name) in self.declarations:
+                self.wanted.setdefault(cell.column, []).append(cell.row)
+                self.last_row = max(self.last_row, cell.row)
+
+
+    def __len__(self):
+        return len(self.declarations)
+
+
+    # Adds a block of count rows, that are offset rows into the range that
+    # is being read, to the aggregates.
+    def add(self, offset, count, cells):
+
+        for (c, summary) in self.taps[offset % len(self.taps)]:
+            summary.append(cells[c].raw(), count)
+
+
+    # Picks out any of the cells that we want from a block of count rows
+    # starting at row r.
+    def capture(self, r, count, cells):
+
+        for cell in cells:
+            for row in self.wanted.get(cell.column, ()):
+                if r <= row < r + count:
+                    self.captured[(row, cell.column)] = cell.raw()
+
+
+    # Adds the values in converted Columns, as returned by
+    # instance.extract_columns(), to the aggregates.
+    def summarise(self, columns):
+
+        for (name, summary) in self.summaries.iteritems():
+            summary.fold(columns[name].values, columns[name].valid)
+
+
+    # Adds what other has found in another part of the range to what we
+    # have found.
+    def merge(self, other):
+
+        for (name, summary) in self.summaries.iteritems():
+            summary.merge(other.summaries[name])
+
+        self.captured.update(other.captured)
+
+
+    # Returns an OrderedDict that maps the (function, name) of each aggregate
+    # to its value, as returned by ColumnSummary.value(), and a list of
+    # CellErrors for the cells that don't match their aggregates.
+    # Cells that weren't found are taken to be empty.
+    def reconcile(self):
+
+        values = collections.OrderedDict()
+        errors = []
+
+        for (cell, function, name) in self.declarations:
+            value = self.summaries[name].value(function)
+            found = aggregate_mismatch(function, value, self.captured.get((cell.row, cell.column), (None, None, None, False)))
+
+            values[(function, name)] = value
+            if found != None:
+                errors.append(CellError(cell.row, cell.column, None, "The %s of %s is %s but the spreadsheet has %s." % (function, name, value, found)))
+
+        errors.sort(key = lambda error: (error.row, error.column))
+
+        return (values, errors)
+
+
+
+###############################################################################
+# Internal Representation of a Spreadsheet Metadata Language description
+
+# A description can declare several tables, each with a header and a data
+# range, perhaps on different sheets. tables holds a [header, data] pair for
+# each of them, in the order that they were declared, and header and data are
+# those of the first table.
+# aggregates holds a (table, CellReference, function, name) tuple for each
+# declare-aggregate, where table is the index of the table in tables.
+class state:
+
+    def __init__(self):
+
+        self.keys       = {}
+        self.header     = None
+        self.data       = None
+        self.tables     = []
+        self.aggregates = []
+        self.plans      = {}
+
+
+    # declare-type Price GBPxVAT
+    def declare_type(self, name, type):
+
+        assert isinstance(name, str),  ("state.declare_type: Expected name argument to be of type 'str' but we got %s." % name)
+        assert isinstance(type, Type), ("state.declare_type: Expected type argument to be of type 'Type' but we got %s." % type)
+        assert (name not in self.keys),  ("state.delatre_type: Conflicting declaration for name %s as %s. %s has already been declared as %s." % (name, type, name, self.keys[name]))
+
+        self.keys[name] = type
+
+        hooks.event("declare-type", name = name, type = str(type))
+
+
+    # Adds a range to the table that is currently being declared or, if that
+    # already has one of these, starts a new table.
+    # which is 0 for the header and 1 for the data.
+    def declare_table(self, which, range):
+
+        if (len(self.tables) == 0) or (self.tables[-1][which] != None):
+            self.tables.append([None, None])
+
+        self.tables[-1][which] = range
+        (self.header, self.data) = self.tables[0]
+
+
+    # declare-header A3:D3
+    # declare-header Sheet2!A3:D3
+    # declare-header OrderHeader
+    def declare_header(self, range):
+
+        assert isinstance(range, (RangeReference, NamedRange)), ("state.declare_header: Expected range argument to be of type 'RangeReference' but we got %s." % range)
+        assert (isinstance(range, NamedRange) or (range.height == 1) or (range.width) == 1), ("state.declare_header: range argument must describe either a single row or a single column. We got %s." % range)
+
+        self.declare_table(0, range)
+
+        hooks.event("declare-header", range = str(range))
+
+
+    # declare-data A4:D8
+    # declare-data Sheet2!A4:D8
+    # declare-data Orders
+    def declare_data(self, range):
+
+        assert isinstance(range, (RangeReference, NamedRange)), ("state.declare_data: Expected range argument to be of type 'RangeReference' but we got %s." % range)
+
+        self.declare_table(1, range)
+
+        hooks.event("declare-data", range = str(range))
+
+
+    # declare-aggregate D10 sum Total
+    # Ties the cell to an aggregate of the column in the data of the table
+    # that was declared last. The cell must be below the data and in one of
+    # its columns.
+    def declare_aggregate(self, cell, function, name):
+
+        assert isinstance(cell, CellReference),  ("state.declare_aggregate: Expected cell argument to be of type 'CellReference' but we got %s." % cell)
+        assert (function in aggregate_functions), ("state.declare_aggregate: Expected one of %s but we got %s." % (", ".join(aggregate_functions), function))
+        assert (name in self.keys),               ("state.declare_aggregate: %s has not been declared with declare-type." % name)
+        assert ((function == "count") or (self.keys[name].typecode != None)), ("state.declare_aggregate: %s is a %s so it can only be counted." % (name, self.keys[name]))
+        assert ((len(self.tables) > 0) and (self.tables[-1][1] != None)), ("state.declare_aggregate: Please declare the data with the 'declare_data' directive before its aggregates.")
+
+        self.aggregates.append((len(self.tables) - 1, cell, function, name))
+
+        hooks.event("declare-aggregate", cell = str(cell), function = function, name = name)
+
+
+    # Check that we have most of what we need to extract some data from a spreadsheet
+    def validate(self):
+
+        assert isinstance(self.keys,   dict),           ("state.validate: keys is no longer a dictionary! We got %s." % self.keys)
+        assert (len(self.tables) > 0),                  ("state.validate: Please provide a valid header reference with the 'declare_header' directive. We got %s." % self.header)
+
+        for (header, data) in self.tables:
+
+            assert isinstance(header, (RangeReference, NamedRange)), ("state.validate: Please provide a valid header reference with the 'declare_header' directive. We got %s." % header)
+            assert isinstance(data,   (RangeReference, NamedRange)), ("state.validate: Please provide a valid data reference with the 'declare_data' directive. We got %s." % data)
+
+            # Named ranges are checked once they have been resolved.
+            if isinstance(header, NamedRange) or isinstance(data, NamedRange):
+                continue
+
+            assert (header.sheet == data.sheet),        ("state.validate: header and data must be on the same sheet. We got header = %s and data = %s." % (header, data))
+
+            if (header.height == 1):
+                assert (data.width == header.width),    ("state.validate: header describes a row so data must have the same number of columns. We got header = %s and data = %s." % (header, data))
+
+            if (header.width == 1):
+                assert (data.height == header.height),  ("state.validate: header describes a column so data must have the same number of rows. We got header = %s and data = %s." % (header, data))
+
+        for (table, cell, function, name) in self.aggregates:
+
+            data = self.tables[table][1]
+            if isinstance(data, NamedRange):
+                continue
+
+            assert (cell.row > data.end.row), ("state.validate: The %s of %s must be below the data. We got %s and data = %s." % (function, name, cell, data))
+            assert (data.start.column <= cell.column <= data.end.column), ("state.validate: The %s of %s must be in one of the columns of the data. We got %s and data = %s." % (function, name, cell, data))
+
+        return True
+
+
+    # Returns a copy of the state that describes just the table at index in
+    # tables. The copy shares its keys and plans with this state.
+    def table(self, index):
+
+        assert isinstance(index, int),                 ("state.table: Expected index argument to be of type 'int' but we got %s." % index)
+        assert (0 <= index < len(self.tables)),        ("state.table: There is no table %d. There are only %d tables." % (index, len(self.tables)))
+
+        result = copy.copy(self)
+        result.tables     = [self.tables[index]]
+        result.aggregates = [(0, cell, function, name) for (table, cell, function, name) in self.aggregates if table == index]
+        (result.header, result.data) = self.tables[index]
+
+        return result
+
+
+    # Returns the (CellReference, function, name) of each aggregate of the
+    # first table.
+    def table_aggregates(self):
+        return [(cell, function, name) for (table, cell, function, name) in self.aggregates if table == 0]
+
+
+    # Returns True if any of the tables use named ranges.
+    def named(self):
+
+        for table in self.tables:
+            for range in table:
+                if isinstance(range, NamedRange):
+                    return True
+
+        return False
+
+
+    # Returns a SHA-1 of the declarations in the state. It changes whenever
+    # the state could give different results for the same spreadsheet.
+    def digest(self):
+
+        keys   = sorted((name, str(type)) for (name, type) in self.keys.iteritems())
+        tables = []
+        for table in self.tables:
+            for range in table:
+                if isinstance(range, NamedRange):
+                    tables.append(("name", range.sheet, range.name))
+                else:
+                    tables.append(("range", range.sheet, range.start.row, range.start.column, range.end.row, range.end.column))
+
+        aggregates = [(table, cell.row, cell.column, function, name) for (table, cell, function, name) in self.aggregates]
+
+        return hashlib.sha1(repr((keys, tables, aggregates))).hexdigest()
+
+
+    # Returns a copy of the state with the named ranges resolved into
+    # RangeReferences using workbook, which is a WorkbookIndex. The copy
+    # shares its keys and plans with this state.
+    def resolve(self, workbook):
+
+        assert isinstance(workbook, WorkbookIndex), ("state.resolve: Expected workbook argument to be of type 'WorkbookIndex' but we got %s." % workbook)
+
+        if not self.named():
+            return self
+
+        result = copy.copy(self)
+        result.tables = [[(range.resolve(workbook) if isinstance(range, NamedRange) else range) for range in table] for table in self.tables]
+        (result.header, result.data) = result.tables[0]
+
+        # Whether the names fit the metadata depends on the workbook so a
+        # mismatch is a problem with the spreadsheet.
+        try:
+            result.validate()
+        except AssertionError as e:
+            raise SpreadsheetError("state.resolve: The named ranges in the workbook don't fit the metadata. %s" % e)
+
+        return result
+
+
+    # Returns the ExtractionPlan for spreadsheets whose header, as returned
+    # by instance.parse_range, is header.
+    # Plans only depend on the names in the header and the width of the data
+    # so they are compiled once and shared by every spreadsheet, and every
+    # table, that lays its header out the same way.
+    def compile(self, header):
+
+        names = (tuple(tuple(name for (name, type) in row) for row in header), self.data.width)
+
+        if names not in self.plans:
+            self.plans[names] = ExtractionPlan(header, self.data.width)
+
+        return self.plans[names]
+
+
+    # Internal state
+    keys       = {}
+    header     = None
+    data       = None
+    tables     = []
+    aggregates = []
+    plans      = {}
+
+
+
+# Returns a procedure that turns a Cell into a checked CellValue of the given
+# name and type. Any CellErrors are raised as SpreadsheetErrors.
+def cell_value_proc(name, type):
+
+    def proc(cell):
+        value = CellValue(type, name, cell)
+        error = value.check()
+
+        # This checks the data rather than the program so it mustn't go
+        # away under python -O.
+        if error != None:
+            raise SpreadsheetError("cell_value_proc: %s" % error)
+
+        return value
+
+    return proc
+
+
+# Makes the CellValues for a stream of rows and type checks them in batches.
+# Checking each cell on its own converts a column of one value at a time so
+# the CellValues are kept until check() is called and then each column of
+# them is checked in one go with its type's convert_column(). Any CellErrors
+# are added to errors in the order of the cells that they are about.
+class CellValueChecker:
+
+    def __init__(self, errors):
+
+        assert isinstance(errors, list), ("CellValueChecker.__init__: Expected errors argument to be of type 'list' but we got %s." % errors)
+
+        self.errors  = errors
+        self.pending = collections.OrderedDict()   # (name, Type) -> [CellValue]
+
+
+    # Returns a procedure that turns a Cell into a CellValue of the given name
+    # and type that is checked by the next call to check().
+    def proc(self, name, type):
+
+        values = self.pending.setdefault((name, type), [])
+
+        def proc(cell):
+            value = CellValue(type, name, cell)
+            values.append(value)
+            return value
+
+        return proc
+
+
+    # Checks the CellValues that have been made since the last call.
+    def check(self):
+
+        found = []
+
+        for ((name, type), values) in self.pending.iteritems():
+            if len(values) == 0:
+                continue
+
+            (converted, valid, errors) = type.convert_column([value.cell.raw() for value in values])
+            for (i, message) in errors:
+                cell = values[i].cell
+                found.append(CellError(cell.row, cell.column, name, message))
+
+            del values[:]
+
+        found.sort(key = lambda error: (error.row, error.column))
+        self.errors.extend(found)
+
+
+# An immutable plan for extracting the data from a spreadsheet once its header
+# has been read.
+# header is a list of rows of (name, Type) tuples and width is the width of
+# the data range. rows has a tuple for each row of headers that maps each
+# column offset in the data range directly to its (name, Type, converter)
+# tuple and procs has the corresponding procedures that turn cells into
+# CellValues. When the header is a single row there is just one row in the
+# plan and it applies to every row of data.
+class ExtractionPlan:
+
+    def __init__(self, header, width):
+
+        assert isinstance(header, list), ("ExtractionPlan.__init__: Expected header argument to be of type 'list' but we got %s." % header)
+        assert (len(header) > 0),        ("ExtractionPlan.__init__: Expected at least one row of headers.")
+
+        rows = []
+        for row in header:
+            rows.append(tuple((name, type, type.convert) for (name, type) in (row[c % len(row)] for c in range(width))))
+
+        self.rows  = tuple(rows)
+        self.procs = tuple(tuple(cell_value_proc(name, type) for (name, type, converter) in row) for row in self.rows)
+
+
+    # Returns the tuple of (name, Type, converter) for each column of the row
+    # of data at offset r from the start of the data range.
+    def row(self, r):
+        return self.rows[r % len(self.rows)]
+
+
+    # Returns the tuple of procedures that turn each cell in the row of data
+    # at offset r from the start of the data range into a CellValue.
+    def row_procs(self, r):
+        return self.procs[r % len(self.procs)]
+
+
+    # Returns a copy of the plan in which the procedure for each cell is the
+    # result of proc(name, type) rather than one that makes a CellValue.
+    def rebind(self, proc):
+
+        plan       = copy.copy(self)
+        plan.procs = tuple(tuple(proc(name, type) for (name, type, converter) in row) for row in self.rows)
+
+        return plan
+
+
+    # Returns a copy of the plan for reading a range that starts offset rows
+    # into the data range.
+    def shift(self, offset):
+
+        k          = offset % len(self.rows)
+        plan       = copy.copy(self)
+        plan.rows  = self.rows[k:]  + self.rows[:k]
+        plan.procs = self.procs[k:] + self.procs[:k]
+
+        return plan
+
+
+    # Returns a copy of the plan that only covers the columns at the given
+    # offsets from the start of the data range, in the order given.
+    def project(self, offsets):
+
+        plan       = copy.copy(self)
+        plan.rows  = tuple(tuple(row[c] for c in offsets) for row in self.rows)
+        plan.procs = tuple(tuple(procs[c] for c in offsets) for procs in self.procs)
+
+        return plan
+
+
+
+###############################################################################
+# Streaming Spreadsheet Readers.
+#
+# Rather than loading a whole workbook into memory we pull the XML for the
+# sheet out of the zip archive and feed it, a chunk at a time, to an
+# incremental parser. Only the rows and columns inside the ranges that we are
+# asked for are turned into Cell objects and we stop reading as soon as we
+# have passed the last row that we need.
+
+# How many bytes of XML we feed to the parser at a time.
+ods_chunk_size = 64 * 1024
+
+
+# A run-length index over a sequence in which runs of identical items have
+# been compressed into a single entry, as ODF does for rows with
+# table:number-rows-repeated and for cells with table:number-columns-repeated.
+# Runs are appended in order and each occupies count logical positions. We
+# never expand a run so a million repeated blank rows cost the same as one.
+# Looking up a logical position is a binary search over the start of each run.
+class RunIndex:
+
+    # Approximately how many bytes of memory each entry costs.
+    overhead = sys.getsizeof((0, 0, None)) + sys.getsizeof(0) + (2 * sys.getsizeof([None]) - sys.getsizeof([]))
+
+    def __init__(self):
+        self.starts = []    # The logical position of the first item in each run.
+        self.runs   = []    # (start, count, item) for each run.
+        self.length = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def append(self, count, item):
+
+        assert (count > 0), ("RunIndex.append: Expected a positive count but we got %s." % count)
+
+        self.starts.append(self.length)
+        self.runs.append((self.length, count, item))
+        self.length += count
+
+
+    # Returns the (start, count, item) tuple for the run that contains the
+    # logical position or None if the position is beyond the end of the index.
+    def find(self, position):
+
+        if (position < 0) or (position >= self.length):
+            return None
+
+        return self.runs[bisect.bisect_right(self.starts, position) - 1]
+
+
+    # Returns a generator that yields a (start, count, item) tuple for each run
+    # that overlaps the logical positions first to last inclusive. The runs are
+    # clipped so that they do not extend outside of first and last.
+    def between(self, first, last):
+
+        i = max(bisect.bisect_right(self.starts, first) - 1, 0)
+
+        while (i < len(self.runs)) and (self.runs[i][0] <= last):
+            (start, count, item) = self.runs[i]
+            end   = min(start + count - 1, last)
+            start = max(start, first)
+            if end >= start:
+                yield (start, (end - start) + 1, item)
+            i += 1
+
+
+
+# Wraps one of the parsers below so that the time spent in feed() and the
+# number of bytes of XML that it is fed are added up.
+class TimedParser:
+
+    def __init__(self, parser):
+        self.parser  = parser
+        self.seconds = 0.0
+        self.bytes   = 0
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def feed(self, data, final):
+        start = time.time()
+        self.parser.feed(data, final)
+        self.seconds += time.time() - start
+        self.bytes   += len(data)
+
+
+# Returns parser wrapped in a TimedParser if the hooks want to know about it.
+def timed_parser(parser):
+
+    if hooks.enabled:
+        return TimedParser(parser)
+
+    return parser
+
+
+# Reports the time that a TimedParser spent parsing a sheet.
+def report_parser(parser, file, sheet):
+
+    if isinstance(parser, TimedParser):
+        hooks.time("xml", parser.seconds, file = file, sheet = sheet, bytes = parser.bytes)
+
+
+
+# Returns the columns from first to first + count - 1 that are in columns, a
+# sorted list of columns, or all of them if columns is None.
+def projected_columns(columns, first, count):
+
+    if columns == None:
+        return range(first, first + count)
+
+    return columns[bisect.bisect_left(columns, first):bisect.bisect_left(columns, first + count)]
+
+
+# A base class for the sheets in a workbook.
+# Sheets provide blocks(range_ref, columns) which returns a generator that yields a
+# (row, count, cells) tuple for each run of identical rows in range_ref, in
+# order. cells is a list of Cells, from the first of the rows in the run, for
+# the columns that are inside range_ref. Each run is a virtual block of count
+# rows that all have the same contents so callers can skip or fill the whole
+# block at once rather than walking it cell by cell.
+# If the sheet ends before the range does then the generator stops early and
+# the list of cells for short rows will be short.
+# If columns is a sorted list of columns then cells only has the Cells for
+# those of them that are inside range_ref. The readers skip the other cells
+# as early as they can.
+# Sheets that are read from a file provide runs(first_row, last_row,
+# first_column, last_column, columns), which yields the compressed (row,
+# count, cells) tuples where cells is a list of (column, count, attributes,
+# text) tuples, and the class of Cell to make from them in cell_class. The
+# runs may include columns that aren't in columns.
+class Sheet:
+
+    cell_class = None
+
+    # Returns a generator that yields a (row, cells) tuple for each row in
+    # range_ref, in order, expanding the blocks from blocks().
+    def rows(self, range_ref, columns = None):
+
+        cell_class = self.cell_class
+
+        for (r, count, cells) in self.blocks(range_ref, columns):
+            yield (r, cells)
+
+            for row in range(r + 1, r + count):
+                yield (row, [cell_class(cell.attributes, cell.text, row, cell.column, cell.decoded) for cell in cells])
+
+
+    def blocks(self, range_ref, columns = None):
+
+        assert isinstance(range_ref, RangeReference), ("Sheet.blocks: Expected range_ref argument to be of type 'RangeReference' but we got %s." % range_ref)
+
+        cell_class = self.cell_class
+
+        for (r, count, runs) in self.runs(range_ref.start.row, range_ref.end.row, range_ref.start.column, range_ref.end.column, columns):
+            cells = []
+            for (c, n, attributes, text) in runs:
+                wanted = projected_columns(columns, c, n)
+                if wanted:
+                    decoded = cell_class.decode(attributes, text)
+                    for column in wanted:
+                        cells.append(cell_class(attributes, text, r, column, decoded))
+
+            yield (r, count, cells)
+
+
+    # Reads the whole sheet in a single pass and returns an IndexedSheet that
+    # can answer for any of its cells without going back to the file.
+    def load(self):
+
+        sheet = IndexedSheet(self.cell_class)
+
+        for (r, count, runs) in self.runs(0, sys.maxint, 0, sys.maxint):
+            cells = RunIndex()
+            for (c, n, attributes, text) in runs:
+                cells.append(n, (attributes, text))
+                sheet.footprint += sys.getsizeof(attributes) + sys.getsizeof(text) + sum(sys.getsizeof(v) for v in attributes.itervalues()) + RunIndex.overhead
+            sheet.index.append(count, cells)
+            sheet.footprint += RunIndex.overhead + sys.getsizeof(cells)
+
+        return sheet
+
+
+
+# The expat callbacks that pick the rows out of the content.xml of an ODF
+# Spreadsheet.
+# Completed rows are left in pending as (row, count, cells) tuples for
+# OdsSheet.runs() to collect after each chunk has been fed to the parser. Rows
+# in the document may be repeated with table:number-rows-repeated and cells
+# with table:number-columns-repeated so we keep track of the logical row and
+# column that we're up to rather than counting elements. Repeated rows are left
+# as a single entry with a count and cells is a list of (column, count,
+# attributes, text) tuples that are likewise left compressed.
+class OdsParser:
+
+    def __init__(self, sheet, first_row, last_row, first_column, last_column, columns = None, row = 0):
+
+        self.sheet        = sheet
+        self.first_row    = first_row
+        self.last_row     = last_row
+        self.first_column = first_column
+        self.last_column  = last_column
+        self.projection   = columns # Sorted list of the columns we want or None for all of them.
+
+        self.pending      = []
+        self.done         = False
+
+        self.tables       = -1      # Index of the table we're in.
+        self.in_sheet     = False
+        self.row          = row     # First logical row of the current row element.
+        self.row_repeat   = 0
+        self.wanted       = False   # Does the current row overlap the range?
+        self.column       = 0       # First logical column of the current cell element.
+        self.cells        = None    # [(column, count, attributes, text)] for the current row.
+        self.cell         = None    # (attributes, repeat) of the current wanted cell.
+        self.text         = None    # Text accumulated for the current wanted cell.
+
+        self.parser = expat.ParserCreate(namespace_separator = u' ')
+        self.parser.buffer_text         = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler   = self.end
+        self.parser.CharacterDataHandler= self.characters
+
+
+    def feed(self, data, final):
+        self.parser.Parse(data, final)
+
+
+    def start(self, name, attributes):
+
+        if self.done:
+            return
+
+        if name == odf_table_table:
+            self.tables  += 1
+            self.in_sheet = (self.tables == self.sheet)
+
+        elif not self.in_sheet:
+            return
+
+        elif name == odf_table_row:
+            self.row_repeat = int(attributes.get(odf_rows_repeated, 1))
+            self.wanted     = ((self.row <= self.last_row) and ((self.row + self.row_repeat - 1) >= self.first_row))
+            self.column     = 0
+            self.cells      = []
+
+        elif (name == odf_table_cell) or (name == odf_table_covered_cell):
+            repeat = int(attributes.get(odf_columns_repeated, 1))
+            if self.wanted and (self.column <= self.last_column) and ((self.column + repeat - 1) >= self.first_column) and self.projected(repeat):
+                self.cell = (attributes, repeat)
+                self.text = []
+            else:
+                self.column += repeat
+
+
+    # Returns True if the repeat cells from the current column cover one of
+    # the columns that we want.
+    def projected(self, repeat):
+
+        if self.projection == None:
+            return True
+
+        i = bisect.bisect_left(self.projection, self.column)
+
+        return (i < len(self.projection)) and (self.projection[i] < (self.column + repeat))
+
+
+    def end(self, name):
+
+        if self.done or not self.in_sheet:
+            return
+
+        if (name == odf_table_cell) or (name == odf_table_covered_cell):
+            if self.cell != None:
+                (attributes, repeat) = self.cell
+                first = max(self.column, self.first_column)
+                last  = min(self.column + repeat - 1, self.last_column)
+                self.cells.append((first, (last - first) + 1, attributes, u''.join(self.text)))
+                self.column += repeat
+                self.cell    = None
+                self.text    = None
+
+        elif name == odf_table_row:
+            if self.wanted:
+                first = max(self.row, self.first_row)
+                last  = min(self.row + self.row_repeat - 1, self.last_row)
+                self.pending.append((first, (last - first) + 1, self.cells))
+            self.row  += self.row_repeat
+            self.cells = None
+            self.done  = (self.row > self.last_row)
+
+        elif name == odf_table_table:
+            self.in_sheet = False
+            self.done     = True
+
+
+    def characters(self, data):
+        if self.text != None:
+            self.text.append(data)
+
+
+
+# Returns a generator that yields the bytes of stream from offset start up to
+# offset end, or the end of the stream if end is None, a chunk at a time.
+def stream_slice(stream, start, end = None):
+
+    position = 0
+
+    while (end == None) or (position < end):
+        chunk = stream.read(ods_chunk_size)
+        if chunk == "":
+            break
+        first = max(start - position, 0)
+        last  = len(chunk) if (end == None) else min(end - position, len(chunk))
+        if first < last:
+            yield chunk[first:last]
+        position += len(chunk)
+
+
+# A block of the rows of a sheet that can be parsed without the rest of the
+# sheet so that a large range can be read in parallel.
+# start and end are the byte offsets of the block in the part of the archive
+# that holds the sheet and row is the logical row of the first row element in
+# it. head and tail are the XML that has to come before and after the block
+# for it to be parsed on its own: the start and end tags of the elements that
+# it is inside.
+class SheetBlock:
+
+    def __init__(self, start, end, row, head, tail):
+
+        self.start = start
+        self.end   = end
+        self.row   = row
+        self.head  = head
+        self.tail  = tail
+
+
+    def __repr__(self):
+        return ("<SheetBlock: row %d, bytes %d to %s>" % (self.row, self.start, self.end))
+
+
+# A sheet in an ODF Spreadsheet that is read on demand, straight from the
+# file, each time a range of it is asked for.
+# spreadsheet is a file object for the .ods file and index is the position of
+# the sheet in the workbook, starting from 0.
+# If block is a SheetBlock then only the rows in that block are read.
+class OdsSheet(Sheet):
+
+    cell_class = OdsCell
+
+    def __init__(self, spreadsheet, index = 0, workbook = None):
+
+        assert isinstance(spreadsheet, file), ("OdsSheet.__init__: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
+        assert isinstance(index,       int),  ("OdsSheet.__init__: Expected index argument to be of type 'int' but we got %s." % index)
+        assert ((workbook == None) or isinstance(workbook, WorkbookIndex)), ("OdsSheet.__init__: Expected workbook argument to be of type 'WorkbookIndex' but we got %s." % workbook)
+
+        self.spreadsheet = spreadsheet
+        self.index       = index
+        self.workbook    = workbook
+        self.block       = None
+
+
+    # Returns a generator that yields the chunks of XML that the parser needs
+    # to see from content.
+    # If we have a WorkbookIndex then we know where our sheet is in the
+    # content.xml so the parser only sees the root element and our sheet,
+    # which becomes the first sheet in the document. The rest of the document
+    # still has to be decompressed but it doesn't have to be parsed.
+    # A SheetBlock brings its own head and tail, which include the start and
+    # end tags of the sheet.
+    def chunks(self, content):
+
+        if self.block != None:
+            yield self.block.head
+            for chunk in stream_slice(content, self.block.start, self.block.end):
+                yield chunk
+            yield self.block.tail
+            return
+
+        if self.workbook == None:
+            for chunk in stream_slice(content, 0):
+                yield chunk
+            return
+
+        if self.index >= len(self.workbook):
+            raise SpreadsheetError("OdsSheet.chunks: Workbook %s does not contain sheet %d!" % (self.spreadsheet.name, self.index))
+
+        (start, end) = self.workbook.parts[self.index]
+
+        yield self.workbook.prefix
+        for chunk in stream_slice(content, start, end):
+            yield chunk
+        yield self.workbook.suffix
+
+
+    # Returns a generator that yields the compressed (row, count, cells)
+    # tuples that OdsParser collects for the rows and columns between
+    # first_row, first_column and last_row, last_column inclusive, leaving
+    # out any cells that don't cover one of columns.
+    def runs(self, first_row, last_row, first_column, last_column, columns = None):
+
+        with phase("open", file = self.spreadsheet.name):
+            try:
+                archive = zipfile.ZipFile(self.spreadsheet)
+            except zipfile.BadZipfile:
+                raise SpreadsheetError("OdsSheet.runs: %s is not an OpenDocument Spreadsheet!" % self.spreadsheet.name)
+
+        content = None
+        parser  = None
+        try:
+            if "content.xml" not in archive.namelist():
+                raise SpreadsheetError("OdsSheet.runs: %s does not contain a content.xml!" % self.spreadsheet.name)
+
+            content = archive.open("content.xml")
+            index   = self.index if ((self.workbook == None) and (self.block == None)) else 0
+            row     = self.block.row if (self.block != None) else 0
+            parser  = timed_parser(OdsParser(index, first_row, last_row, first_column, last_column, columns, row))
+
+            for chunk in self.chunks(content):
+                parser.feed(chunk, False)
+
+                for run in parser.pending:
+                    yield run
+                del parser.pending[:]
+
+                if parser.done:
+                    break
+
+            if not parser.done:
+                parser.feed("", True)
+                for run in parser.pending:
+                    yield run
+
+            if parser.tables < index:
+                raise SpreadsheetError("OdsSheet.runs: Workbook %s does not contain sheet %d!" % (self.spreadsheet.name, self.index))
+
+        finally:
+            report_parser(parser, self.spreadsheet.name, self.index)
+            if content != None:
+                content.close()
+            archive.close()
+
+
+
+# The most rows and columns that an Office Open XML worksheet can have.
+# Rows and cells that are left out of the file are empty so we fill them in,
+# up to these limits, as ODF does with its repeated rows and columns.
+xlsx_max_rows    = 1048576
+xlsx_max_columns = 16384
+
+# The attributes of an empty cell.
+xlsx_empty = {}
+
+# Currency symbols that can appear in the format code of a number format and
+# the currency that each of them stands for.
+xlsx_currency_symbols = [
+        (u'\xa3',   u'GBP'),
+        (u'\u20ac', u'EUR'),
+        (u'$',      u'USD'),
+        ]
+
+# Locale specific currencies look like [$GBP] or a symbol and a locale such as
+# [$\xa3-809], where \xa3 is the pound sign. Formats can also give just the
+# locale, as in [$-809]\xa3#,##0.00, and put the symbol outside.
+xlsx_locale_currency_re = re.compile(u'\\[\\$([^\\]-]*)[^\\]]*\\]')
+xlsx_iso_currency_re    = re.compile(u'[A-Z]{3}\\Z')
+
+
+# Returns the ISO 4217 code of the currency that the number format code
+# displays its value in or None if it is not a currency format.
+def xlsx_format_currency(format):
+
+    match = xlsx_locale_currency_re.search(format)
+    if match != None:
+        currency = match.group(1)
+        if xlsx_iso_currency_re.match(currency):
+            return currency
+        for (symbol, code) in xlsx_currency_symbols:
+            if symbol in currency:
+                return code
+
+    # Every locale starts with a $ so they're left out of the search.
+    format = xlsx_locale_currency_re.sub(u'', format)
+    for (symbol, code) in xlsx_currency_symbols:
+        if symbol in format:
+            return code
+
+    return None
+
+
+# Feeds the XML in stream to an expat parser with the given callbacks.
+def xlsx_parse(stream, start, end = None, characters = None):
+
+    parser = expat.ParserCreate(namespace_separator = u' ')
+    parser.buffer_text         = True
+    parser.StartElementHandler = start
+    if end != None:
+        parser.EndElementHandler = end
+    if characters != None:
+        parser.CharacterDataHandler = characters
+
+    chunk = stream.read(ods_chunk_size)
+    while chunk != "":
+        parser.Parse(chunk, False)
+        chunk = stream.read(ods_chunk_size)
+    parser.Parse("", True)
+
+
+# Returns a dictionary that maps the Id of each relationship in a .rels part
+# to a (type, target) tuple.
+def xlsx_read_relationships(stream):
+
+    relationships = {}
+
+    def start(name, attributes):
+        if name == xlsx_relationship:
+            relationships[attributes[u'Id']] = (attributes[u'Type'], attributes[u'Target'])
+
+    xlsx_parse(stream, start)
+
+    return relationships
+
+
+# Returns a list of the (name, relationship id) of each sheet in the workbook,
+# in order, and a list of the (name, sheet, reference) of each of the defined
+# names. sheet is the position of the sheet that a name is local to or None
+# if it's global.
+def xlsx_read_workbook(stream):
+
+    sheets  = []
+    defined = []
+    state   = {"name": None, "text": None}
+
+    def start(name, attributes):
+        if name == xlsx_sheet:
+            sheets.append((attributes[u'name'], attributes[xlsx_rid]))
+        elif name == xlsx_defined_name:
+            sheet = attributes.get(u'localSheetId')
+            state["name"] = (attributes[u'name'], (int(sheet) if sheet != None else None))
+            state["text"] = []
+
+    def end(name):
+        if name == xlsx_defined_name:
+            defined.append(state["name"] + (u''.join(state["text"]),))
+            state["text"] = None
+
+    def characters(data):
+        if state["text"] != None:
+            state["text"].append(data)
+
+    xlsx_parse(stream, start, end, characters)
+
+    return (sheets, defined)
+
+
+# Returns the shared strings table as a list.
+# Rich text is split into runs, each with its own text, and may have phonetic
+# runs that are not part of the string.
+def xlsx_read_shared_strings(stream):
+
+    strings = []
+    state   = {"parts": None, "text": False, "phonetic": False}
+
+    def start(name, attributes):
+        if name == xlsx_string_item:
+            state["parts"] = []
+        elif name == xlsx_phonetic_run:
+            state["phonetic"] = True
+        elif (name == xlsx_text) and not state["phonetic"]:
+            state["text"] = True
+
+    def end(name):
+        if name == xlsx_string_item:
+            strings.append(u''.join(state["parts"]))
+            state["parts"] = None
+        elif name == xlsx_phonetic_run:
+            state["phonetic"] = False
+        elif name == xlsx_text:
+            state["text"] = False
+
+    def characters(data):
+        if state["text"]:
+            state["parts"].append(data)
+
+    xlsx_parse(stream, start, end, characters)
+
+    return strings
+
+
+# Returns a list with the currency, or None, of each of the cell formats in
+# the styles. Cells refer to their format by its position in this list.
+def xlsx_read_styles(stream):
+
+    formats = {}
+    xfs     = []
+    state   = {"xfs": False}
+
+    def start(name, attributes):
+        if name == xlsx_num_fmt:
+            formats[attributes[u'numFmtId']] = attributes.get(u'formatCode', u'')
+        elif name == xlsx_cell_xfs:
+            state["xfs"] = True
+        elif (name == xlsx_xf) and state["xfs"]:
+            xfs.append(attributes.get(u'numFmtId', u'0'))
+
+    def end(name):
+        if name == xlsx_cell_xfs:
+            state["xfs"] = False
+
+    xlsx_parse(stream, start, end)
+
+    # numFmts come before cellXfs so we have to wait until the end to look
+    # them up. The built in formats are never in a particular currency.
+    return [(xlsx_format_currency(formats[id]) if id in formats else None) for id in xfs]
+
+
+
+# The expat callbacks that pick the rows out of a worksheet in an Office Open
+# XML Workbook.
+# They leave (row, count, cells) tuples in pending in the same way as
+# OdsParser does. Worksheets leave out empty rows and cells so each row and
+# cell says where it is and we fill in the gaps in the range with runs of
+# empty cells. cells is a list of (column, count, attributes, text) tuples
+# where attributes is a dictionary as described for XlsxCell.
+class XlsxParser:
+
+    def __init__(self, first_row, last_row, first_column, last_column, strings, currencies, columns = None):
+
+        self.first_row    = first_row
+        self.last_row     = min(last_row,    xlsx_max_rows - 1)
+        self.first_column = first_column
+        self.last_column  = min(last_column, xlsx_max_columns - 1)
+        self.strings      = strings
+        self.currencies   = currencies
+
+        self.pending      = []
+        self.done         = False
+
+        self.row          = -1      # The current row.
+        self.next_row     = first_row
+        self.wanted       = False   # Is the current row inside the range?
+        self.column       = -1      # The current cell.
+        self.next_column  = first_column
+        self.cells        = None    # [(column, count, attributes, text)] for the current row.
+        self.cell         = None    # Attributes of the current wanted cell.
+        self.value        = None    # Contents of the <v> of the current cell.
+        self.formula      = None    # Contents of the <f> of the current cell.
+        self.shared       = None    # The si of the current cell's shared formula.
+        self.inline       = None    # Text of the inline string of the current cell.
+        self.text         = None    # Text accumulated for the current element.
+
+        self.columns      = {}      # Column letters that we have already seen.
+        self.attributes   = {}      # Attributes that can be shared between cells.
+        self.projection   = None    # The columns that we want or None for all of them.
+
+        if columns != None:
+            self.projection = frozenset(columns)
+
+        self.parser = expat.ParserCreate(namespace_separator = u' ')
+        self.parser.buffer_text         = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler   = self.end
+        self.parser.CharacterDataHandler= self.characters
+
+
+    def feed(self, data, final):
+        self.parser.Parse(data, final)
+
+
+    # Returns a run of empty cells covering the columns from first to the end
+    # of the range.
+    def blank(self, first):
+        return (first, (self.last_column - first) + 1, xlsx_empty, u'')
+
+
+    # Fills in any rows that are missing before row.
+    def fill_rows(self, row):
+
+        if (row > self.next_row) and (self.next_row <= self.last_row):
+            self.pending.append((self.next_row, min(row, self.last_row + 1) - self.next_row, [self.blank(self.first_column)]))
+        self.next_row = max(self.next_row, row)
+
+
+    def finish(self):
+
+        if not self.done:
+            self.fill_rows(self.last_row + 1)
+            self.done = True
+
+
+    def start(self, name, attributes):
+
+        if self.done:
+            return
+
+        if name == xlsx_row:
+            r = attributes.get(u'r')
+            self.row = (int(r) - 1) if r != None else (self.row + 1)
+
+            if self.row > self.last_row:
+                self.finish()
+                return
+
+            self.wanted      = (self.row >= self.first_row)
+            self.column      = -1
+            self.next_column = self.first_column
+            self.cells       = []
+
+        elif name == xlsx_cell:
+            r = attributes.get(u'r')
+            if r != None:
+                letters = r.rstrip(u'0123456789')
+                column  = self.columns.get(letters)
+                if column == None:
+                    column = self.columns[letters] = CellReference(letters + u'1').column
+                self.column = column
+            else:
+                self.column += 1
+
+            if self.wanted and (self.first_column <= self.column <= self.last_column) and ((self.projection == None) or (self.column in self.projection)):
+                self.cell    = attributes
+                self.value   = None
+                self.formula = None
+                self.shared  = None
+                self.inline  = None
+
+        elif self.cell == None:
+            return
+
+        elif (name == xlsx_cell_value) or (name == xlsx_cell_formula) or (name == xlsx_text):
+            self.text = []
+            if (name == xlsx_cell_formula) and (attributes.get(u't') == u'shared'):
+                self.shared = attributes.get(u'si')
+
+        elif name == xlsx_inline_string:
+            self.inline = []
+
+
+    def end(self, name):
+
+        if self.done:
+            return
+
+        if name == xlsx_cell:
+            if self.cell != None:
+                if self.column > self.next_column:
+                    self.cells.append((self.next_column, self.column - self.next_column, xlsx_empty, u''))
+                (attributes, text) = self.decode(self.cell)
+                self.cells.append((self.column, 1, attributes, text))
+                self.next_column = self.column + 1
+                self.cell        = None
+
+        elif name == xlsx_row:
+            if self.wanted:
+                if self.next_column <= self.last_column:
+                    self.cells.append(self.blank(self.next_column))
+                self.fill_rows(self.row)
+                self.pending.append((self.row, 1, self.cells))
+                self.next_row = self.row + 1
+            self.cells = None
+            if self.row >= self.last_row:
+                self.finish()
+
+        elif name == xlsx_sheet_data:
+            self.finish()
+
+        elif self.text == None:
+            return
+
+        elif name == xlsx_cell_value:
+            self.value = u''.join(self.text)
+            self.text  = None
+
+        elif name == xlsx_cell_formula:
+            self.formula = u''.join(self.text)
+            self.text    = None
+
+        elif name == xlsx_text:
+            if self.inline != None:
+                self.inline.append(u''.join(self.text))
+            self.text = None
+
+
+    def characters(self, data):
+        if self.text != None:
+            self.text.append(data)
+
+
+    # Returns the (attributes, text) for a cell from the attributes of its
+    # element and the value, formula and inline string that we have read.
+    def decode(self, element):
+
+        t        = element.get(u't', u'n')
+        text     = self.value
+        currency = None
+
+        if t == u's':
+            value_type = u'string'
+            if text != None:
+                text = self.strings[int(text)]
+        elif t == u'inlineStr':
+            value_type = u'string'
+            if self.inline != None:
+                text = u''.join(self.inline)
+        elif t == u'str':
+            value_type = u'string'
+        elif t == u'b':
+            value_type = u'boolean'
+        elif t == u'e':
+            value_type = u'error'
+        elif t == u'd':
+            value_type = u'date'
+        else:
+            s = element.get(u's')
+            if s != None:
+                currency = self.currencies[int(s)]
+            value_type = u'currency' if currency != None else u'float'
+
+        if text == None:
+            value_type = None
+            currency   = None
+            text       = u''
+
+        if self.formula == None:
+            key = (value_type, currency)
+            attributes = self.attributes.get(key)
+            if attributes == None:
+                attributes = self.attributes[key] = self.make_attributes(value_type, currency)
+        else:
+            attributes = self.make_attributes(value_type, currency)
+            attributes[xlsx_formula] = self.formula
+            if self.shared != None:
+                attributes[xlsx_shared] = self.shared
+
+        return (attributes, text)
+
+
+    def make_attributes(self, value_type, currency):
+
+        attributes = {}
+        if value_type != None:
+            attributes[xlsx_value_type] = value_type
+        if currency != None:
+            attributes[xlsx_currency] = currency
+
+        return attributes
+
+
+
+# A sheet in an Office Open XML Workbook that is read on demand, straight from
+# the file, each time a range of it is asked for.
+# spreadsheet is a file object for the .xlsx file and index is the position
+# of the sheet in the workbook, starting from 0.
+# The list of sheets, the shared strings and the styles are read the first
+# time that they are needed and then kept.
+class XlsxSheet(Sheet):
+
+    cell_class = XlsxCell
+
+    def __init__(self, spreadsheet, index = 0):
+
+        assert isinstance(spreadsheet, file), ("XlsxSheet.__init__: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
+        assert isinstance(index,       int),  ("XlsxSheet.__init__: Expected index argument to be of type 'int' but we got %s." % index)
+
+        self.spreadsheet = spreadsheet
+        self.index       = index
+        self.block       = None     # The SheetBlock to read or None for the whole sheet.
+        self.sheets      = None     # [(name, path)] for each sheet in the workbook.
+        self.defined     = None     # [(name, sheet, reference)] for each defined name.
+        self.strings     = None
+        self.currencies  = None
+
+
+    # Reads the parts of the workbook that all the sheets share.
+    def read_workbook(self, archive):
+
+        if self.sheets != None:
+            return
+
+        names = set(archive.namelist())
+        if "xl/workbook.xml" not in names:
+            raise SpreadsheetError("XlsxSheet.read_workbook: %s does not contain an xl/workbook.xml!" % self.spreadsheet.name)
+
+        relationships = {}
+        if "xl/_rels/workbook.xml.rels" in names:
+            relationships = xlsx_read_relationships(archive.open("xl/_rels/workbook.xml.rels"))
+
+        # Targets are relative to the xl/ directory unless they're absolute.
+        def path(target):
+            if target.startswith(u'/'):
+                return target[1:]
+            else:
+                return u'xl/' + target
+
+        def find(kind):
+            for (type, target) in relationships.itervalues():
+                if type.endswith(u'/' + kind) and (path(target) in names):
+                    return archive.open(path(target))
+            return None
+
+        (sheets, self.defined) = xlsx_read_workbook(archive.open("xl/workbook.xml"))
+        self.sheets = [(name, path(relationships[rid][1])) for (name, rid) in sheets]
+
+        strings = find(u'sharedStrings')
+        self.strings = xlsx_read_shared_strings(strings) if strings != None else []
+
+        styles = find(u'styles')
+        self.currencies = xlsx_read_styles(styles) if styles != None else []
+
+
+    # Returns a list of the (name, path) of each sheet in the workbook.
+    def workbook_sheets(self):
+
+        if self.sheets == None:
+            archive = zipfile.ZipFile(self.spreadsheet)
+            try:
+                self.read_workbook(archive)
+            finally:
+                archive.close()
+
+        return self.sheets
+
+
+    def runs(self, first_row, last_row, first_column, last_column, columns = None):
+
+        with phase("open", file = self.spreadsheet.name):
+            try:
+                archive = zipfile.ZipFile(self.spreadsheet)
+            except zipfile.BadZipfile:
+                raise SpreadsheetError("XlsxSheet.runs: %s is not an Office Open XML Workbook!" % self.spreadsheet.name)
+
+        content = None
+        parser  = None
+        try:
+            with phase("open", file = self.spreadsheet.name, part = "workbook"):
+                self.read_workbook(archive)
+            if self.index >= len(self.sheets):
+                raise SpreadsheetError("XlsxSheet.runs: Workbook %s does not contain sheet %d!" % (self.spreadsheet.name, self.index))
+
+            content = archive.open(self.sheets[self.index][1])
+            parser  = timed_parser(XlsxParser(first_row, last_row, first_column, last_column, self.strings, self.currencies, columns))
+
+            if self.block != None:
+                chunks = itertools.chain([self.block.head], stream_slice(content, self.block.start, self.block.end), [self.block.tail])
+            else:
+                chunks = stream_slice(content, 0)
+
+            for chunk in chunks:
+                parser.feed(chunk, False)
+
+                for run in parser.pending:
+                    yield run
+                del parser.pending[:]
+
+                if parser.done:
+                    break
+
+            if not parser.done:
+                parser.feed("", True)
+                parser.finish()
+                for run in parser.pending:
+                    yield run
+
+        finally:
+            report_parser(parser, self.spreadsheet.name, self.index)
+            if content != None:
+                content.close()
+            archive.close()
+
+
+
+# The mimetype that the first file in an OpenDocument Spreadsheet contains.
+ods_mimetype = "application/vnd.oasis.opendocument.spreadsheet"
+
+# Returns "ods" or "xlsx" depending on the format of the spreadsheet file.
+# OpenDocument Spreadsheets and Office Open XML Workbooks are both zip archives
+# so we tell them apart by what's inside.
+def workbook_format(spreadsheet):
+
+    try:
+        archive = zipfile.ZipFile(spreadsheet)
+    except zipfile.BadZipfile:
+        raise SpreadsheetError("workbook_format: %s is not a spreadsheet!" % spreadsheet.name)
+
+    try:
+        names = archive.namelist()
+
+        if ("mimetype" in names) and (archive.read("mimetype").strip() == ods_mimetype):
+            return "ods"
+        elif "content.xml" in names:
+            return "ods"
+        elif "xl/workbook.xml" in names:
+            return "xlsx"
+        else:
+            raise SpreadsheetError("workbook_format: %s is neither an OpenDocument Spreadsheet nor an Office Open XML Workbook!" % spreadsheet.name)
+
+    finally:
+        archive.close()
+
+
+# Returns a Sheet of the appropriate kind for the sheet at index in the
+# spreadsheet file.
+# workbook is an optional WorkbookIndex for the spreadsheet that lets OdsSheets
+# go straight to their sheet.
+def workbook_sheet(spreadsheet, index = 0, workbook = None):
+
+    if workbook != None:
+        format = workbook.format
+    else:
+        format = workbook_format(spreadsheet)
+
+    if format == "ods":
+        return OdsSheet(spreadsheet, index, workbook)
+    else:
+        return XlsxSheet(spreadsheet, index)
+
+
+
+# An index of the sheets in a workbook that is built in a single pass over the
+# file.
+# names holds the name of each sheet in order. For OpenDocument Spreadsheets,
+# which keep all their sheets in content.xml, parts holds the (start, end)
+# byte offsets of each sheet's table:table element in the content.xml and
+# prefix and suffix are the start and end tags of the root element, which
+# declare the namespaces that the sheet uses. For Office Open XML Workbooks
+# parts holds the path of each sheet in the archive.
+# ranges maps the (sheet, name) of each named range in the workbook to a
+# RangeReference. sheet is the name of the sheet that the name is local to or
+# None if it can be used anywhere in the workbook.
+# WorkbookIndexes do not refer to the file so they can be passed to other
+# processes.
+class WorkbookIndex:
+
+    def __init__(self, format):
+
+        self.format = format
+        self.names  = []
+        self.parts  = []
+        self.prefix = None
+        self.suffix = None
+        self.ranges = {}
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __repr__(self):
+        return ("<WorkbookIndex: %s %s>" % (self.format, self.names))
+
+
+    # Returns the position of the sheet called name.
+    def sheet(self, name):
+
+        if name not in self.names:
+            raise SpreadsheetError("WorkbookIndex.sheet: There is no sheet called %s. The sheets are %s." % (name, self.names))
+
+        return self.names.index(name)
+
+
+    # Returns the RangeReference for the named range. If sheet is None then
+    # the name must be global or local to exactly one sheet.
+    def range(self, name, sheet = None):
+
+        if (sheet, name) in self.ranges:
+            return self.ranges[(sheet, name)]
+
+        if sheet != None:
+            raise SpreadsheetError("WorkbookIndex.range: Sheet %s does not have a range called %s." % (sheet, name))
+
+        local = [range for ((scope, n), range) in self.ranges.iteritems() if n == name]
+        if len(local) == 0:
+            raise SpreadsheetError("WorkbookIndex.range: There is no range called %s. The names are %s." % (name, sorted(n for (scope, n) in self.ranges)))
+        if len(local) > 1:
+            raise SpreadsheetError("WorkbookIndex.range: %s is defined on more than one sheet. Please say which one you mean with Sheet!%s." % (name, name))
+
+        return local[0]
+
+
+# Named ranges refer to their cells in a formula-like syntax that depends on
+# the format of the workbook. For example, $'Bob''s Sheet'.$A$4:.$D$8 in ODF
+# and 'Bob''s Sheet'!$A$4:$D$8 in Office Open XML.
+ods_address_re  = re.compile(ur"\$?(?:'((?:[^']|'')*)'|([^.']*))\.\$?([A-Z]+)\$?([0-9]+)(?::\$?(?:'(?:[^']|'')*'|[^.']*)\.\$?([A-Z]+)\$?([0-9]+))?\Z")
+xlsx_address_re = re.compile(ur"(?:'((?:[^']|'')*)'|([^!']*))!\$?([A-Z]+)\$?([0-9]+)(?::\$?([A-Z]+)\$?([0-9]+))?\Z")
+
+# Returns a RangeReference for the address of a named range or None if the
+# name refers to something other than a single range of cells.
+def named_range_reference(address_re, address):
+
+    match = address_re.match(address)
+    if match == None:
+        return None
+
+    (quoted, sheet, start_column, start_row, end_column, end_row) = match.groups()
+    if quoted != None:
+        sheet = quoted.replace(u"''", u"'")
+    if end_column == None:
+        (end_column, end_row) = (start_column, start_row)
+
+    return RangeReference(CellReference(start_column + start_row), CellReference(end_column + end_row), sheet)
+
+
+# The root element of an ODF document and the namespace declaration for tables.
+ods_root_re      = re.compile(r"<(([\w.-]+:)?document-content)\b[^>]*>")
+ods_table_ns_re  = re.compile(r"""xmlns:([\w.-]+)=["']urn:oasis:names:tc:opendocument:xmlns:table:1\.0["']""")
+
+# Returns a WorkbookIndex for an OpenDocument Spreadsheet.
+# Finding the tables by scanning the text of the content.xml for their start
+# and end tags is much quicker than parsing it. Only the start tags of the
+# tables and named ranges are actually parsed, to get their names and
+# addresses. The named ranges are usually at the end of the document so we
+# pick them up in the same pass.
+def ods_workbook_index(archive):
+
+    workbook = WorkbookIndex("ods")
+    content  = archive.open("content.xml")
+
+    try:
+        buffer = ""
+        offset = 0      # Offset of buffer[0] in the content.xml.
+        final  = False
+        root   = None
+
+        while (root == None) and not final:
+            chunk  = content.read(ods_chunk_size)
+            final  = (chunk == "")
+            buffer += chunk
+            root   = ods_root_re.search(buffer)
+
+        if root == None:
+            raise SpreadsheetError("ods_workbook_index: content.xml does not contain an office:document-content element!")
+
+        workbook.prefix = buffer[:root.end()]
+        workbook.suffix = "</%s>" % root.group(1)
+
+        namespace = ods_table_ns_re.search(root.group(0))
+        if namespace == None:
+            raise SpreadsheetError("ods_workbook_index: content.xml does not declare the table namespace!")
+
+        prefix      = namespace.group(1)
+        tag_re      = re.compile(r"<(/?)%s:(table|named-range)(?=[\s/>])" % re.escape(prefix))
+        name_key    = "%s:name" % prefix
+        address_key = "%s:cell-range-address" % prefix
+        depth    = 0
+        start    = None
+        name     = None
+        position = root.end()
+
+        while True:
+            tag = tag_re.search(buffer, position)
+            end = (buffer.find(">", tag.end()) if tag != None else -1)
+
+            if end == -1:
+                if final:
+                    break
+                # Read some more of the document, keeping enough of what we
+                # have to match a tag that straddles the chunks.
+                if tag != None:
+                    cut = tag.start()
+                else:
+                    cut = max(position, len(buffer) - 64)
+                chunk    = content.read(ods_chunk_size)
+                final    = (chunk == "")
+                offset  += cut
+                buffer   = buffer[cut:] + chunk
+                position = 0
+                continue
+
+            text     = buffer[tag.start():end + 1]
+            position = end + 1
+
+            # Named ranges inside a table are local to it.
+            if tag.group(2) == "named-range":
+                if tag.group(1) == "":
+                    attributes = ods_tag_attributes(text)
+                    range      = named_range_reference(ods_address_re, attributes.get(address_key, u''))
+                    if range != None:
+                        workbook.ranges[((name if depth > 0 else None), attributes[name_key])] = range
+                continue
+
+            if tag.group(1) == "":
+                depth += 1
+                if depth == 1:
+                    start = offset + tag.start()
+                    name  = ods_tag_attributes(text).get(name_key, u'')
+                if text.endswith("/>"):
+                    depth -= 1
+            else:
+                depth -= 1
+
+            if (depth == 0) and (start != None):
+                workbook.names.append(name)
+                workbook.parts.append((start, offset + end + 1))
+                start = None
+
+    finally:
+        content.close()
+
+    return workbook
+
+
+# Returns the attributes of a start tag, without processing namespaces.
+def ods_tag_attributes(text):
+
+    attributes = {}
+
+    def start(name, attrs):
+        attributes.update(attrs)
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    if not text.endswith("/>"):
+        text = text[:-1] + "/>"
+    parser.Parse(text, True)
+
+    return attributes
+
+
+# Returns a WorkbookIndex for an Office Open XML Workbook.
+def xlsx_workbook_index(spreadsheet):
+
+    workbook = WorkbookIndex("xlsx")
+
+    sheet = XlsxSheet(spreadsheet)
+
+    for (name, path) in sheet.workbook_sheets():
+        workbook.names.append(name)
+        workbook.parts.append(path)
+
+    for (name, local, address) in sheet.defined:
+        range = named_range_reference(xlsx_address_re, address)
+        if range != None:
+            workbook.ranges[((workbook.names[local] if local != None else None), name)] = range
+
+    return workbook
+
+
+# Returns a WorkbookIndex for the spreadsheet file.
+def workbook_index(spreadsheet):
+
+    assert isinstance(spreadsheet, file), ("workbook_index: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
+
+    with phase("index", file = spreadsheet.name) as fields:
+
+        if workbook_format(spreadsheet) == "xlsx":
+            workbook = xlsx_workbook_index(spreadsheet)
+        else:
+            archive = zipfile.ZipFile(spreadsheet)
+            try:
+                workbook = ods_workbook_index(archive)
+            finally:
+                archive.close()
+
+        fields["sheets"] = len(workbook.names)
+        fields["ranges"] = len(workbook.ranges)
+
+    return workbook
+
+
+
+# Returns a list of SheetBlocks that split the rows from first_row to
+# last_row of the sheet at index in the spreadsheet into blocks of at least
+# rows rows each, or None if there would only be one block or the sheet can't
+# be split. Sheets whose XML is smaller than min_bytes aren't split.
+# Only the tags of the rows are looked at, so finding the blocks is much
+# quicker than parsing them.
+def sheet_blocks(spreadsheet, index, workbook, first_row, last_row, rows, min_bytes = 0):
+
+    assert isinstance(workbook, WorkbookIndex), ("sheet_blocks: Expected workbook argument to be of type 'WorkbookIndex' but we got %s." % workbook)
+    if index >= len(workbook):
+        raise SpreadsheetError("sheet_blocks: Workbook %s does not contain sheet %d!" % (spreadsheet.name, index))
+
+    with phase("blocks", file = spreadsheet.name, sheet = index) as fields:
+        archive = zipfile.ZipFile(spreadsheet)
+        try:
+            if workbook.format == "ods":
+                (start, end) = workbook.parts[index]
+                size   = end - start
+                part   = "content.xml"
+                scan   = lambda content: ods_sheet_blocks(content, workbook, index, first_row, last_row, rows)
+            else:
+                size   = archive.getinfo(workbook.parts[index]).file_size
+                part   = workbook.parts[index]
+                scan   = lambda content: xlsx_sheet_blocks(content, first_row, last_row, rows)
+
+            blocks = None
+            if size >= min_bytes:
+                content = archive.open(part)
+                try:
+                    blocks = scan(content)
+                finally:
+                    content.close()
+
+        finally:
+            archive.close()
+
+        if (blocks != None) and (len(blocks) < 2):
+            blocks = None
+
+        fields["bytes"]  = size
+        fields["blocks"] = len(blocks) if blocks != None else 0
+
+    return blocks
+
+
+# Returns a generator that yields (tag, offset) for each match of tag_re in
+# the text of stream, where offset is the offset of the tag in the stream,
+# starting from offset start. Each tag is matched up to the > that ends it.
+# Whatever follows the last complete tag is ignored.
+def scan_tags(stream, tag_re, start = 0):
+
+    buffer   = ""
+    offset   = start    # Offset of buffer[0] in the stream.
+    position = 0
+    final    = False
+    chunks   = stream_slice(stream, start)
+
+    while True:
+        tag = tag_re.search(buffer, position)
+        end = (buffer.find(">", tag.end()) if tag != None else -1)
+
+        if end == -1:
+            if final:
+                return
+            # Read some more, keeping enough of what we have to match a tag
+            # that straddles the chunks.
+            cut      = tag.start() if (tag != None) else max(position, len(buffer) - 64)
+            chunk    = next(chunks, "")
+            final    = (chunk == "")
+            offset  += cut
+            buffer   = buffer[cut:] + chunk
+            position = 0
+            continue
+
+        position = end + 1
+
+        yield (buffer[tag.start():end + 1], offset + tag.start())
+
+
+# Returns the SheetBlocks for the sheet at index in the content.xml of an
+# OpenDocument Spreadsheet. See sheet_blocks().
+# Blocks start at rows that are directly inside the table so that each one
+# is a run of whole elements. Rows that are repeated stay in one block.
+def ods_sheet_blocks(content, workbook, index, first_row, last_row, rows):
+
+    namespace = ods_table_ns_re.search(workbook.prefix)
+    if namespace == None:
+        raise SpreadsheetError("ods_sheet_blocks: content.xml does not declare the table namespace!")
+
+    prefix    = namespace.group(1)
+    tag_re    = re.compile(r"<(/?)%s:(table|table-row|table-row-group|table-header-rows|table-rows)(?=[\s/>])" % re.escape(prefix))
+    repeat_re = re.compile(r"""%s:number-rows-repeated=["'](\d+)["']""" % re.escape(prefix))
+
+    (start, end) = workbook.parts[index]
+    head   = None
+    tail   = "</%s:table>%s" % (prefix, workbook.suffix)
+    blocks = []
+    depth  = 0      # How many groups of rows we're inside.
+    row    = 0
+
+    for (text, offset) in scan_tags(content, tag_re, start):
+        match = tag_re.match(text)
+        (closing, name) = match.groups()
+
+        if name == "table":
+            if blocks:
+                # The sheet has ended, or contains another table, before
+                # last_row so we leave it to the serial reader.
+                return None
+            head = workbook.prefix + text
+            blocks.append(SheetBlock(offset + len(text), end, 0, head, tail))
+
+        elif name != "table-row":
+            if closing:
+                depth -= 1
+            elif not text.endswith("/>"):
+                depth += 1
+
+        elif not closing:
+            if (depth == 0) and (first_row < row <= last_row) and (row >= (max(blocks[-1].row, first_row) + rows)):
+                blocks[-1].end = offset
+                blocks.append(SheetBlock(offset, end, row, head, tail))
+
+            repeat = repeat_re.search(text)
+            row   += int(repeat.group(1)) if (repeat != None) else 1
+
+            if row > last_row:
+                return blocks
+
+    return None
+
+
+# Returns the SheetBlocks for an Office Open XML worksheet. See
+# sheet_blocks().
+# Rows say which row they are so the blocks can start at any of them, but we
+# give up if they don't.
+def xlsx_sheet_blocks(content, first_row, last_row, rows):
+
+    tag_re = re.compile(r"<(/?)([\w.-]+:)?(worksheet|sheetData|row)(?=[\s/>])")
+    row_re = re.compile(r"""\sr=["'](\d+)["']""")
+
+    blocks = []
+    root   = ""
+    head   = None
+    tail   = None
+
+    for (text, offset) in scan_tags(content, tag_re):
+        (closing, prefix, name) = tag_re.match(text).groups()
+        prefix = prefix or ""
+
+        if name == "worksheet":
+            if closing:
+                break
+            root = text
+
+        elif name == "sheetData":
+            if closing or text.endswith("/>"):
+                break
+            head = root + text
+            tail = "</%ssheetData></%sworksheet>" % (prefix, prefix)
+            blocks.append(SheetBlock(offset + len(text), None, first_row, head, tail))
+
+        elif (name == "row") and (not closing) and blocks:
+            r = row_re.search(text)
+            if r == None:
+                return None
+            row = int(r.group(1)) - 1
+
+            if (first_row < row <= last_row) and (row >= blocks[-1].row + rows):
+                blocks[-1].end = offset
+                blocks.append(SheetBlock(offset, None, row, head, tail))
+
+            if row > last_row:
+                break
+
+    return blocks if blocks else None
+
+
+
+# A sheet that has been read into memory as a RunIndex of rows, each of which
+# is a RunIndex of the (attributes, text) of its cells.
+# Any cell can be found in O(log n) time and repeated rows and cells are kept
+# compressed. cell_class is the class of Cell that the sheet was read as.
+class IndexedSheet(Sheet):
+
+    def __init__(self, cell_class):
+        self.cell_class = cell_class
+        self.index      = RunIndex()
+        self.footprint  = 0          # Approximately how many bytes of memory the sheet uses.
+
+
+    # Returns the Cell at the logical row and column or None if the sheet
+    # does not extend that far.
+    def cell(self, row, column):
+
+        run = self.index.find(row)
+        if run == None:
+            return None
+
+        run = run[2].find(column)
+        if run == None:
+            return None
+
+        (attributes, text) = run[2]
+
+        return self.cell_class(attributes, text, row, column)
+
+
+    def blocks(self, range_ref, columns = None):
+
+        assert isinstance(range_ref, RangeReference), ("IndexedSheet.blocks: Expected range_ref argument to be of type 'RangeReference' but we got %s." % range_ref)
+
+        cell_class = self.cell_class
+
+        for (r, count, row) in self.index.between(range_ref.start.row, range_ref.end.row):
+            cells = []
+            for (c, n, (attributes, text)) in row.between(range_ref.start.column, range_ref.end.column):
+                wanted = projected_columns(columns, c, n)
+                if wanted:
+                    decoded = cell_class.decode(attributes, text)
+                    for column in wanted:
+                        cells.append(cell_class(attributes, text, r, column, decoded))
+
+            yield (r, count, cells)
+
+
+
+# Returns the SHA-1 of the contents of the spreadsheet file, leaving it at the
+# start.
+def stream_digest(spreadsheet):
+
+    digest = hashlib.sha1()
+    spreadsheet.seek(0)
+    chunk = spreadsheet.read(ods_chunk_size)
+    while chunk != "":
+        digest.update(chunk)
+        chunk = spreadsheet.read(ods_chunk_size)
+    spreadsheet.seek(0)
+
+    return digest.hexdigest()
+
+
+# A cache of sheets that have already been read from spreadsheet files so that
+# validating or extracting the same file more than once, perhaps against
+# several different metadata descriptions, only parses it once.
+# Files are identified by their path, size and modification time or, if
+# hash_contents is True, by a hash of their contents. The least recently used
+# sheets are evicted when there are more than max_entries of them or when
+# their approximate footprint exceeds max_bytes.
+# A single cache can be shared by any number of instance objects.
+class WorkbookCache:
+
+    def __init__(self, max_bytes = 256 * 1024 * 1024, max_entries = 64, hash_contents = False):
+
+        assert isinstance(max_bytes,   (int, long)), ("WorkbookCache.__init__: Expected max_bytes argument to be of type 'int' but we got %s." % max_bytes)
+        assert isinstance(max_entries, int),         ("WorkbookCache.__init__: Expected max_entries argument to be of type 'int' but we got %s." % max_entries)
+
+        self.max_bytes     = max_bytes
+        self.max_entries   = max_entries
+        self.hash_contents = hash_contents
+
+        self.entries   = collections.OrderedDict()  # Least recently used first.
+        self.workbooks = collections.OrderedDict()  # WorkbookIndexes, least recently used first.
+        self.bytes     = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+
+    # Returns a key that identifies the contents of the spreadsheet file.
+    def identify(self, spreadsheet):
+
+        if self.hash_contents:
+            return stream_digest(spreadsheet)
+
+        info = os.fstat(spreadsheet.fileno())
+
+        return (os.path.realpath(spreadsheet.name), info.st_size, info.st_mtime)
+
+
+    # Returns the WorkbookIndex for the spreadsheet file, indexing it if it
+    # isn't already in the cache.
+    def workbook(self, spreadsheet):
+
+        key = self.identify(spreadsheet)
+
+        if key in self.workbooks:
+            workbook = self.workbooks.pop(key)
+        else:
+            workbook = workbook_index(spreadsheet)
+
+        self.workbooks[key] = workbook
+        while len(self.workbooks) > self.max_entries:
+            self.workbooks.popitem(last = False)
+
+        return workbook
+
+
+    # Returns the IndexedSheet for the sheet at index in the spreadsheet file,
+    # reading it from the file if it isn't already in the cache.
+    # workbook is an optional WorkbookIndex for the spreadsheet.
+    def sheet(self, spreadsheet, index = 0, workbook = None):
+
+        key = (self.identify(spreadsheet), index)
+
+        if key in self.entries:
+            self.hits += 1
+            hooks.count("cache-hits")
+            sheet = self.entries.pop(key)
+            self.entries[key] = sheet
+            return sheet
+
+        self.misses += 1
+        hooks.count("cache-misses")
+        sheet = workbook_sheet(spreadsheet, index, workbook).load()
+
+        if sheet.footprint <= self.max_bytes:
+            self.entries[key] = sheet
+            self.bytes       += sheet.footprint
+            self.evict()
+
+        return sheet
+
+
+    # Drops the least recently used sheets until we're within our budget.
+    def evict(self):
+
+        while (len(self.entries) > self.max_entries) or (self.bytes > self.max_bytes):
+            (key, sheet)    = self.entries.popitem(last = False)
+            self.bytes     -= sheet.footprint
+            self.evictions += 1
+
+
+    def clear(self):
+
+        self.entries.clear()
+        self.workbooks.clear()
+        self.bytes = 0
+
+
+    def stats(self):
+        return {
+                "entries"   : len(self.entries),
+                "bytes"     : self.bytes,
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evictions" : self.evictions,
+                }
+
+
+
+###############################################################################
+# Cached Results.
+#
+# The same spreadsheets are often checked and extracted over and over again,
+# perhaps by different processes and after the metadata has been tweaked. A
+# ResultCache keeps the results in a directory, under a key made from the
+# SHA-1 of the spreadsheet's contents, the digest of the metadata and what was
+# asked for, so a spreadsheet that comes round again is answered without
+# reading it. Changing the metadata changes the key.
+#
+# Each result is kept in its own file that holds a header followed by the
+# result, compressed with zlib. Both are written with marshal, which can only
+# hold plain data, rather than pickle so that reading a file that someone else
+# has put in the directory can't run any code. Results are turned into plain
+# data with the procedures below: arrays are kept as strings and the Types are
+# looked up again in the metadata rather than stored. Files are written to a
+# temporary file and renamed into place so that concurrent processes never
+# see half of one. Reading a file marks it as recently used and the least
+# recently used files are removed when there are more than max_bytes of them.
+#
+# Bump slangr_version whenever the results change shape.
+
+slangr_magic   = "slangr"
+slangr_version = 3
+
+# Arrays are stored as their machine representation so they can only be
+# read back on machines that lay them out in the same way.
+slangr_arrays  = (sys.byteorder, array.array('l').itemsize, array.array('d').itemsize)
+
+
+# Each of these turns part of a result into plain data that marshal can store
+# or back again. The ones that read plain data raise a ValueError, TypeError,
+# KeyError or IndexError if it is not in the form that they expect.
+
+# A RangeReference or NamedRange.
+def plain_range(range):
+
+    if isinstance(range, NamedRange):
+        return ("name", range.name, range.sheet)
+
+    return ("range", range.sheet, range.start.row, range.start.column, range.end.row, range.end.column)
+
+
+def range_from_plain(value):
+
+    if value[0] == "name":
+        (kind, name, sheet) = value
+        return NamedRange(name, sheet)
+
+    (kind, sheet, first_row, first_column, last_row, last_column) = value
+    if (kind != "range") or not (0 <= first_row <= last_row) or not (0 <= first_column <= last_column):
+        raise ValueError("range_from_plain: Expected a range but we got %s." % (value,))
+
+    return RangeReference(CellReference("%s%d" % (column_name(first_column), first_row + 1)), CellReference("%s%d" % (column_name(last_column), last_row + 1)), sheet)
+
+
+def plain_error(error):
+    return (error.row, error.column, error.name, error.message)
+
+
+def error_from_plain(value):
+
+    (row, column, name, message) = value
+
+    return CellError(int(row), int(column), name, message)
+
+
+# The value of an aggregate.
+def plain_value(value):
+
+    if isinstance(value, decimal.Decimal):
+        return ("decimal", str(value))
+
+    return value
+
+
+def value_from_plain(value):
+
+    if isinstance(value, tuple):
+        (kind, text) = value
+        if kind != "decimal":
+            raise ValueError("value_from_plain: Expected a value but we got %s." % (value,))
+        return decimal.Decimal(text)
+
+    return value
+
+
+# A converted Column.
+def plain_column(column):
+
+    if isinstance(column.values, array.array):
+        values = column.values.tostring()
+    else:
+        values = list(column.values)
+
+    return (column.name, values, str(column.valid), column.rows.tostring(), column.columns.tostring(), [plain_error(error) for error in column.errors])
+
+
+# keys maps the names in the metadata to their Types.
+def column_from_plain(value, keys):
+
+    (name, values, valid, rows, columns, errors) = value
+
+    column        = Column(name, keys[name])
+    column.raw    = None
+    column.valid  = bytearray(valid)
+    column.rows.fromstring(rows)
+    column.columns.fromstring(columns)
+    column.errors = [error_from_plain(error) for error in errors]
+
+    if column.type.typecode != None:
+        column.values = array.array(column.type.typecode)
+        column.values.fromstring(values)
+    else:
+        # Each string is only kept once, as convert_column() does.
+        strings = {}
+        column.values = [strings.setdefault(v, v) for v in values]
+
+    if not (len(column.values) == len(column.valid) == len(column.rows) == len(column.columns)):
+        raise ValueError("column_from_plain: The parts of column %s are different lengths." % name)
+
+    return column
+
+
+class ResultCache:
+
+    suffix = ".slangr"
+
+    def __init__(self, directory, max_bytes = 256 * 1024 * 1024):
+
+        assert isinstance(directory, basestring),  ("ResultCache.__init__: Expected directory argument to be of type 'str' but we got %s." % directory)
+        assert isinstance(max_bytes, (int, long)), ("ResultCache.__init__: Expected max_bytes argument to be of type 'int' but we got %s." % max_bytes)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.digests   = {}     # SHA-1s of spreadsheets by path, size and modification time.
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+    # Returns the key for the result of operation, a tuple that names what was
+    # asked for and its arguments, on the spreadsheet with the metadata.
+    # The SHA-1 of each spreadsheet is remembered for as long as its size and
+    # modification time stay the same so that asking for several results only
+    # reads it once.
+    def key(self, spreadsheet, metadata, operation):
+
+        assert isinstance(metadata, state), ("ResultCache.key: Expected metadata argument to be of type 'state' but we got %s." % metadata)
+
+        info     = os.fstat(spreadsheet.fileno())
+        identity = (os.path.realpath(spreadsheet.name), info.st_size, info.st_mtime)
+
+        digest = self.digests.get(identity)
+        if digest == None:
+            digest = self.digests[identity] = stream_digest(spreadsheet)
+
+        return hashlib.sha1(repr((digest, metadata.digest(), operation))).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+
+    # Returns the result stored under key or None if there isn't one or it
+    # can't be read.
+    def get(self, key):
+
+        path = self.path(key)
+
+        with phase("results", key = key) as fields:
+            result = None
+
+            try:
+                input = open(path, "rb")
+                try:
+                    header = marshal.load(input)
+                    if isinstance(header, dict) and (header.get("magic") == slangr_magic) and (header.get("version") == slangr_version) and (header.get("key") == key) and (header.get("arrays") == slangr_arrays):
+                        result = marshal.loads(zlib.decompress(input.read()))
+                finally:
+                    input.close()
+
+                if not isinstance(result, dict):
+                    result = None
+
+                os.utime(path, None)
+
+            except (IOError, OSError, EOFError, zlib.error, TypeError, ValueError):
+                result = None
+
+            fields["hit"] = (result != None)
+
+        if result == None:
+            self.misses += 1
+            hooks.count("results-misses")
+        else:
+            self.hits += 1
+            hooks.count("results-hits")
+
+        return result
+
+
+    # Stores result, a dictionary of plain data, under key. If it can't be
+    # written then we carry on without it.
+    def put(self, key, result):
+
+        header = {
+                "magic"   : slangr_magic,
+                "version" : slangr_version,
+                "key"     : key,
+                "arrays"  : slangr_arrays,
+                }
+
+        target    = self.path(key)
+        temporary = "%s.%d.%d.tmp" % (target, os.getpid(), id(result))
+
+        try:
+            output = open(temporary, "wb")
+            try:
+                marshal.dump(header, output, 2)
+                output.write(zlib.compress(marshal.dumps(result, 2)))
+            finally:
+                output.close()
+            os.rename(temporary, target)
+
+        except (IOError, OSError) as e:
+            warn("ResultCache.put: Could not write %s: %s" % (target, e))
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return False
+
+        self.evict()
+
+        return True
+
+
+    # Returns a list of (mtime, size, path) for each result in the directory,
+    # least recently used first.
+    def files(self):
+
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+
+        files.sort()
+
+        return files
+
+
+    # Removes the least recently used results until we're within our budget.
+    # Other processes may be removing them too so files that have already
+    # gone are ignored.
+    def evict(self):
+
+        files = self.files()
+        total = sum(size for (mtime, size, path) in files)
+
+        for (mtime, size, path) in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+
+    def clear(self):
+
+        for (mtime, size, path) in self.files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        self.digests.clear()
+
+
+    def stats(self):
+
+        files = self.files()
+
+        return {
+                "entries"   : len(files),
+                "bytes"     : sum(size for (mtime, size, path) in files),
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evictions" : self.evictions,
+                }
+
+
+
+###############################################################################
+# Serialisers for Extracted Data.
+
+json_number_re = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?\Z")
+
+
+# Each of these turns the raw (value-type, value, currency, isformula) tuple of
+# a cell of the corresponding slang type into a JSON value. Values that are
+# empty or not valid for the type become null.
+
+def json_string(raw):
+    if raw[0] != u'string':
+        return "null"
+    return json.encoder.encode_basestring_ascii(raw[1])
+
+
+# Numbers are written exactly as the spreadsheet stored them whenever that is
+# already a valid JSON number.
+def json_number(raw):
+    if (raw[0] == None) or (raw[0] == u'string') or (raw[1] == None):
+        return "null"
+    if json_number_re.match(raw[1]):
+        return str(raw[1])
+    try:
+        value = float(raw[1])
+    except ValueError:
+        return "null"
+    if math.isinf(value) or math.isnan(value):
+        return "null"
+    return repr(value)
+
+
+def json_gbp(raw):
+    if (raw[0] != u'currency') or (raw[2] != u'GBP'):
+        return "null"
+    return json_number(raw)
+
+
+def json_formula(raw):
+    if not raw[3]:
+        return "null"
+    return json_number(raw)
+
+
+json_formatters = {
+        slang_String  : json_string,
+        slang_GBPxVAT : json_gbp,
+        slang_Number  : json_number,
+        slang_Formula : json_formula,
+        }
+
+
+# Writes rows of CellValues to a binary stream as JSON, one object per row
+# mapping each header name to its value.
+# In "json" mode the rows are written as a single JSON array and in "ndjson"
+# mode they are written one per line. Output is collected into chunks of about
+# buffer_size bytes before being written to the stream.
+# row_proc() can be passed to instance.extract() so that each row is written
+# as soon as it has been read rather than being kept.
+class JsonWriter:
+
+    def __init__(self, stream, mode = "json", buffer_size = 64 * 1024):
+
+        assert (mode in ("json", "ndjson")), ("JsonWriter.__init__: Expected mode argument to be 'json' or 'ndjson' but we got %s." % mode)
+
+        self.stream      = stream
+        self.mode        = mode
+        self.buffer_size = buffer_size
+        self.buffer      = []
+        self.buffered    = 0
+        self.keys        = {}
+        self.rows        = 0
+        self.started     = False
+
+
+    def write(self, data):
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+
+        self.stream.write("".join(self.buffer))
+        self.buffer   = []
+        self.buffered = 0
+
+
+    def begin(self):
+
+        if self.mode == "json":
+            self.write("[")
+        self.started = True
+
+
+    # Returns the JSON for the key that the name is written under.
+    def key(self, name):
+
+        key = self.keys.get(name)
+        if key == None:
+            key = self.keys[name] = json.encoder.encode_basestring_ascii(name) + ": "
+
+        return key
+
+
+    # Writes a row, which is a list of CellValues.
+    def row(self, row):
+        self.fields([self.key(value.name) + json_formatters[value.type.__class__](value.cell.raw()) for value in row])
+
+
+    # Returns a procedure that turns a Cell of the given name and type straight
+    # into the JSON for its field. This can be used with
+    # ExtractionPlan.rebind() so that the CellValues never need to be made.
+    def cell_proc(self, name, type):
+
+        key       = self.key(name)
+        formatter = json_formatters[type.__class__]
+
+        return lambda cell: key + formatter(cell.raw())
+
+
+    # Writes a row, which is a list of fields from the procedures returned by
+    # cell_proc().
+    def fields(self, parts):
+
+        if not self.started:
+            self.begin()
+
+        line = "{" + ", ".join(parts) + "}"
+
+        if self.mode == "json":
+            if self.rows == 0:
+                self.write("\n" + line)
+            else:
+                self.write(",\n" + line)
+        else:
+            self.write(line + "\n")
+
+        self.rows += 1
+
+
+    # A row_proc for instance.extract() that writes each row rather than
+    # adding it to the result.
+    def row_proc(self, result, row):
+        self.row(row)
+
+
+    # A row_proc for instance.parse_range() that writes each row of fields
+    # from the procedures returned by cell_proc().
+    def fields_proc(self, result, parts):
+        self.fields(parts)
+
+
+    def end(self):
+
+        if not self.started:
+            self.begin()
+
+        if self.mode == "json":
+            self.write("\n]\n")
+
+        self.flush()
+
+
+
+###############################################################################
+# A spreadsheet and some metadata that might be valid for it.
+
+class instance:
+
+    # If cache is a WorkbookCache then the spreadsheet is read through it.
+    # Otherwise it is streamed from the file each time it is needed.
+    # workbook is an optional WorkbookIndex for the spreadsheet. If the
+    # metadata refers to sheets by name and we haven't been given one then it
+    # is made when it is first needed.
+    # If results is a ResultCache then extract_columns() and check() look
+    # for their results there before reading the spreadsheet and leave them
+    # there afterwards.
+    # An instance deals with the first table that the metadata declares. Use
+    # metadata.table() or extract_tables() for the others.
+    def __init__(self, metadata, spreadsheet, cache = None, workbook = None, results = None):
+
+        assert isinstance(metadata,    state), ("instance.__init__: Expected metadata argument to be of type 'state' but we got %s."   % metadata)
+        assert isinstance(spreadsheet, file),  ("instance.__init__: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
+        assert ((cache == None) or isinstance(cache, WorkbookCache)), ("instance.__init__: Expected cache argument to be of type 'WorkbookCache' but we got %s." % cache)
+        assert ((workbook == None) or isinstance(workbook, WorkbookIndex)), ("instance.__init__: Expected workbook argument to be of type 'WorkbookIndex' but we got %s." % workbook)
+        assert ((results == None) or isinstance(results, ResultCache)), ("instance.__init__: Expected results argument to be of type 'ResultCache' but we got %s." % results)
+
+        self.metadata    = metadata
+        self.declared    = metadata     # The metadata before any named ranges are resolved.
+        self.spreadsheet = spreadsheet
+        self.cache       = cache
+        self.workbook    = workbook
+        self.results     = results
+        self.unused_keys = dict(metadata.keys)
+        self.aggregates  = None
+
+
+    # Returns the appropriate (name, slang Type Constructor) tuple for the
+    # given row and column.
+    # row and column are relative to the data range, not the sheet. i.e. the
+    # top left cell in a range is always (0, 0).
+    # Assumes that the headers have already been parsed successfully.
+    # Assumes that the is either only one row or one column of headers.
+    def find_constructor(self, row, column):
+
+        assert isinstance(row,    int), ("find_constructor: Expected row argument ot be of type 'int' but we got %s." % row)
+        assert isinstance(column, int), ("find_constructor: Expected column argument ot be of type 'int' but we got %s." % column)
+
+        (name, type, converter) = self.plan.row(row)[column]
+
+        return (name, type)
+
+
+    # Returns a generator that reads a range of cells from the sheet, calls
+    # proc for each cell and yields the results of proc for each row as a
+    # list.
+    # cell_proc may also be an ExtractionPlan in which case the procedure for
+    # each cell comes from the plan.
+    # If bulk is True then proc is called once for each block of repeated rows
+    # and the results are reused for every row in the block. CellValues are
+    # moved to the row that they are reused in but anything else is reused as
+    # it is so this is only correct when it does not depend on which row the
+    # cell is in.
+    # If columns is a sorted list of columns inside the range then only the
+    # cells in those columns are read and each row only has their results. A
+    # plan should have been projected onto the same columns.
+    # If aggregator is an Aggregator then each row is added to it as it is
+    # read and the rows below the range, down to the last of the cells that
+    # it wants, are read in the same pass for it to pick them out.
+    # Rows are only read from the sheet as they are asked for.
+    def iter_range(self, sheet, range_ref, cell_proc, bulk = False, columns = None, aggregator = None):
+        next_row = range_ref.start.row
+        last_row = range_ref.end.row
+        width    = range_ref.width if (columns == None) else len(columns)
+
+        if isinstance(cell_proc, ExtractionPlan):
+            row_procs = cell_proc.row_procs
+        else:
+            procs     = (cell_proc,) * width
+            row_procs = lambda r: procs
+
+        read_ref = range_ref
+        if (aggregator != None) and (aggregator.last_row > last_row):
+            read_ref = range_ref.rows(range_ref.start.row, aggregator.last_row)
+
+        if bulk:
+            blocks = sheet.blocks(read_ref, columns)
+        else:
+            blocks = ((r, 1, cells) for (r, cells) in sheet.rows(read_ref, columns))
+
+        for (r, count, cells) in blocks:
+
+            # Rows below the range are only read for the aggregator.
+            if r + count > last_row + 1:
+                if aggregator != None:
+                    aggregator.capture(r, count, cells)
+                if r > last_row:
+                    continue
+                count = last_row + 1 - r
+
+            if len(cells) != width:
+                raise SpreadsheetError("instance.parse_range: Row %d does not contain enough columns to contain the range specified! Range is at %s. We got %s." % (r, range_ref, [str(cell) for cell in cells]))
+
+            if aggregator != None:
+                aggregator.add(r - range_ref.start.row, count, cells)
+
+            new_row = [proc(cell) for (proc, cell) in itertools.izip(row_procs(r - range_ref.start.row), cells)]
+
+            yield new_row
+            for row in range(r + 1, r + count):
+                yield [(value.at_row(row) if isinstance(value, CellValue) else value) for value in new_row]
+
+            next_row = r + count
+
+        rows = next_row - range_ref.start.row
+        hooks.count("rows",  rows)
+        hooks.count("cells", rows * width)
+
+        if next_row <= range_ref.end.row:
+            raise SpreadsheetError("instance.parse_range: Sheet does not contain enough rows to contain the range specified! Range is at %s." % range_ref)
+
+
+    # Read a range of cells from the sheet, call proc for each cell and return
+    # the results of proc as a two-dimensional array.
+    # See iter_range() for cell_proc, bulk, columns and aggregator.
+    def parse_range(self, sheet, range_ref, cell_proc, row_proc = list.append, bulk = False, columns = None, aggregator = None):
+        result = []
+
+        for row in self.iter_range(sheet, range_ref, cell_proc, bulk, columns, aggregator):
+            row_proc(result, row)
+
+        return result
+
+
+    # Read the contents of a cell that's supposed to be part of the header and
+    # return a tuple consisting of the name of the column and the slang Type
+    # constructor appropriate for the corresponding cells from the data
+    # region.
+    def parse_header_cell(self, cell):
+
+        assert isinstance(cell, Cell),        ("read_header: Expected cell argument to be of type 'Cell' but we got %s." % cell)
+
+        if not cell.isstring():
+            raise SpreadsheetError("read_header: Expected Cell of type string but we got %s." % cell)
+
+        value = cell.value()
+        if value not in self.metadata.keys:
+            raise SpreadsheetError("read_header: The spreadsheet contains an unexpected header! We got %s." % cell.value())
+
+        if value in self.unused_keys:
+            del self.unused_keys[value]
+        else:
+            warn("Duplicate header detected! We got %s" % value)
+
+        return (value, self.metadata.keys[cell.value()])
+
+
+    def parse_data_cell(self, cell):
+
+        assert isinstance(cell, Cell),        ("read_header: Expected cell argument to be of type 'Cell' but we got %s." % cell)
+
+        (name, type)  = self.find_constructor(cell.row - self.metadata.data.start.row, cell.column - self.metadata.data.start.column)
+        value = CellValue(type, name, cell)
+
+        value.check()
+
+        return value
+
+
+    # Returns the WorkbookIndex for the spreadsheet.
+    def open_workbook(self):
+
+        if self.workbook == None:
+            if self.cache != None:
+                self.workbook = self.cache.workbook(self.spreadsheet)
+            else:
+                self.workbook = workbook_index(self.spreadsheet)
+
+        return self.workbook
+
+
+    # Find the sheet inside the document.
+    # If the data range doesn't name a sheet then we use the first one.
+    # Unless we have a cache, the sheet is streamed from the file so each
+    # parse_range() only reads as far into the document as the range that it
+    # needs.
+    def open_sheet(self):
+
+        # Resolve any named ranges now that we know which workbook they're in.
+        if self.metadata.named():
+            self.metadata = self.metadata.resolve(self.open_workbook())
+
+        index = 0
+        if self.metadata.data.sheet != None:
+            index = self.open_workbook().sheet(self.metadata.data.sheet)
+
+        if self.cache != None:
+            return self.cache.sheet(self.spreadsheet, index, self.workbook)
+        else:
+            return workbook_sheet(self.spreadsheet, index, self.workbook)
+
+
+    # Read the header from the sheet and compile it into the plan for reading
+    # the data.
+    def read_header(self, sheet):
+
+        with phase("header", range = str(self.metadata.header)):
+
+            # Each time the header is read every key starts off unused.
+            self.unused_keys = dict(self.metadata.keys)
+
+            # Get an array of cell validators of the correct type for that column or row.
+            self.header = self.parse_range(sheet, self.metadata.header, self.parse_header_cell)
+
+            # Emit warnings for any keys declared in the metadata that were not
+            # used in the spreadsheet.
+            for (key, value) in self.unused_keys.iteritems():
+                warn("Header %s of type %s was declared but not used!" % (key, value))
+
+            # Compile the header into a plan that maps each cell in the data range
+            # straight to its type.
+            self.plan = self.metadata.compile(self.header)
+
+
+    # Returns the (plan, columns) for reading only the columns of the data
+    # whose headers are in names, or (plan, None) for all of them if names is
+    # None. columns is the sorted list of the columns in the sheet to pass to
+    # iter_range() and plan is projected onto them.
+    # Assumes that the header has already been read. Only a single row of
+    # headers can be projected as the names of the columns are then the same
+    # in every row of the data.
+    def projection(self, names):
+
+        if names == None:
+            return (self.plan, None)
+
+        assert (len(self.plan.rows) == 1), ("instance.projection: Expected a single row of headers but we got %d." % len(self.plan.rows))
+
+        header = [name for (name, type, converter) in self.plan.rows[0]]
+        for name in names:
+            assert (name in header), ("instance.projection: Expected the name of a column in the header but we got %s." % name)
+
+        offsets = [c for (c, name) in enumerate(header) if name in names]
+        columns = [self.metadata.data.start.column + c for c in offsets]
+
+        return (self.plan.project(offsets), columns)
+
+
+    # Returns an Aggregator for the aggregates that the metadata declares
+    # when the data is read with plan and columns, as returned by
+    # projection(), or None if there aren't any. See Aggregator for capture
+    # and tap.
+    def aggregator(self, plan, columns, capture = True, tap = True):
+
+        aggregator = Aggregator(self.metadata.table_aggregates(), plan, columns, capture, tap)
+
+        return aggregator if (len(aggregator) > 0) else None
+
+
+    # Reconciles the aggregates that aggregator has worked out with the cells
+    # that they are tied to. The value of each aggregate is put in
+    # aggregates, under its (function, name), and the cells that don't match
+    # are added to errors.
+    def reconcile(self, aggregator):
+
+        if aggregator == None:
+            self.aggregates = collections.OrderedDict()
+            return
+
+        (self.aggregates, errors) = aggregator.reconcile()
+        self.errors.extend(errors)
+
+
+    # Returns a generator that yields each row of the data in the spreadsheet
+    # as a list of CellValues.
+    # The rows are read from the spreadsheet as they are asked for and are
+    # not kept so the memory used does not depend on how many rows there are.
+    # Any cells that are not valid for their types are listed in errors. The
+    # cells are checked check_rows rows at a time, as check() does, so the
+    # errors for a row may not be listed until a few more have been read.
+    # If names is a list of the names of some of the columns then the rows
+    # only have the CellValues for those columns and the other cells are not
+    # read. The whole header is still read and checked.
+    # Once the last row has been read, aggregates and errors have the
+    # aggregates, as for extract_columns().
+    def iter_rows(self, names = None):
+
+        sheet1 = self.open_sheet()
+
+        # Read the header.
+        self.read_header(sheet1)
+
+        # Read the data
+        # When there is only one row of headers every row of data has the same
+        # types so blocks of repeated rows can be filled in one go.
+        # Repeated rows only report their errors once.
+        (plan, columns) = self.projection(names)
+
+        bulk        = (len(plan.rows) == 1)
+        self.errors = []
+        checker     = CellValueChecker(self.errors)
+        aggregator  = self.aggregator(plan, columns)
+        plan        = plan.rebind(checker.proc)
+        rows        = 0
+
+        try:
+            for row in self.iter_range(sheet1, self.metadata.data, plan, bulk, columns, aggregator):
+                rows += 1
+                if rows % self.check_rows == 0:
+                    checker.check()
+                yield row
+        finally:
+            checker.check()
+
+        self.reconcile(aggregator)
+
+
+    # Returns a generator that yields each row of the data in the spreadsheet
+    # as an OrderedDict that maps each name in the header to the value of its
+    # cell converted to the Python representation of its type. Cells that are
+    # empty or not valid for their types have the value None.
+    # See iter_rows() for names.
+    def iter_records(self, names = None):
+
+        for row in self.iter_rows(names):
+            record = collections.OrderedDict()
+            for value in row:
+                try:
+                    record[value.name] = value.convert()
+                except ValueError:
+                    record[value.name] = None
+
+            yield record
+
+
+    # Extract the data in the spreadsheet given the metadata.
+    # Any cells that are not valid for their types are listed in errors.
+    # See iter_rows() for names.
+    def extract(self, row_proc = list.append, names = None):
+
+        self.data = []
+
+        with phase("extract", method = "extract") as fields:
+            for row in self.iter_rows(names):
+                row_proc(self.data, row)
+            fields["errors"] = len(self.errors)
+
+        # Now the data is in an array. We need it in a dict or something?
+
+        return self.data
+
+
+    # Extract the data in the spreadsheet given the metadata and write it to
+    # the binary stream as JSON using a JsonWriter in the given mode. The rows
+    # are written as they are read and are not kept.
+    # Each cell goes straight from the sheet to its JSON without being made
+    # into a CellValue so cells that are not valid for their types are written
+    # as null rather than being listed in errors.
+    # See iter_rows() for names.
+    # Returns the JsonWriter.
+    def write_json(self, stream, mode = "json", names = None):
+
+        writer = JsonWriter(stream, mode)
+
+        with phase("serialise", mode = mode) as fields:
+            sheet1 = self.open_sheet()
+
+            self.read_header(sheet1)
+
+            (plan, columns) = self.projection(names)
+
+            writer.begin()
+            self.parse_range(sheet1, self.metadata.data, plan.rebind(writer.cell_proc), writer.fields_proc, (len(plan.rows) == 1), columns)
+            writer.end()
+
+            fields["rows"] = writer.rows
+
+        return writer
+
+
+    # Extract the data in the spreadsheet given the metadata and return it as
+    # an OrderedDict that maps each name in the header to a Column of typed
+    # values.
+    # Cells are reduced to their raw values as they are read so neither the
+    # rows nor the cells are kept. Each column is then converted and
+    # validated in one go and any cells that are not valid for their types
+    # are listed in errors.
+    # See iter_rows() for names.
+    # If processes is not 1 and the data range is big enough then it is split
+    # into blocks of rows that are read by a pool of processes worker
+    # processes, or one per CPU if processes is None. The columns are the same
+    # either way.
+    # Any aggregates that the metadata declares are worked out from the
+    # columns and put in aggregates. The cells that they are tied to are read
+    # in the same pass as the data and any that don't match are listed in
+    # errors too.
+    def extract_columns(self, names = None, processes = 1):
+
+        key = self.result_key("extract_columns", None if names == None else tuple(sorted(set(unicode(name) for name in names))))
+        if key != None:
+            result = self.results.get(key)
+            if result != None:
+                (restored, columns) = self.restore_result(result)
+                if restored:
+                    return columns
+
+        with phase("extract", method = "extract_columns") as fields:
+
+            sheet1 = self.open_sheet()
+
+            self.read_header(sheet1)
+
+            (plan, projected) = self.projection(names)
+
+            blocks = self.data_blocks(processes) if (processes != 1) else None
+
+            # The columns already hold the converted values so the
+            # aggregates are worked out from them rather than as the cells
+            # are read.
+            if blocks == None:
+                aggregator = self.aggregator(plan, projected, tap = False)
+                columns    = self.read_columns(sheet1, self.metadata.data, plan, projected, aggregator)
+            else:
+                (columns, aggregator) = self.read_blocks(blocks, names, processes)
+                fields["blocks"] = len(blocks)
+
+            if aggregator != None:
+                aggregator.summarise(columns)
+
+            self.errors = []
+            for column in columns.itervalues():
+                self.errors.extend(column.errors)
+
+            self.reconcile(aggregator)
+
+            self.errors.sort(key = lambda error: (error.row, error.column))
+
+            fields["errors"] = len(self.errors)
+
+        if key != None:
+            self.store_result(key, self.header, columns = columns)
+
+        return columns
+
+
+    # Reads the cells in range_ref from the sheet with plan and returns an
+    # OrderedDict that maps each name in the plan to a converted Column.
+    # See iter_range() for columns and aggregator.
+    def read_columns(self, sheet, range_ref, plan, columns = None, aggregator = None):
+
+        result = collections.OrderedDict()
+        for row in plan.rows:
+            for (name, type, converter) in row:
+                if name not in result:
+                    result[name] = Column(name, type)
+
+        # Each cell in the range goes straight into the Column for its header.
+        plan = plan.rebind(lambda name, type: result[name].append)
+
+        self.parse_range(sheet, range_ref, plan, lambda rows, row: None, False, columns, aggregator)
+
+        # Convert and validate each column in one go.
+        for column in result.itervalues():
+            column.convert()
+
+        return result
+
+
+    # Data ranges with fewer rows than this, or on sheets with less XML than
+    # parallel_bytes, are always read serially. The more rows each worker
+    # reads the less of the file is decompressed more than once.
+    parallel_rows  = 25000
+    parallel_bytes = 16 * 1024 * 1024
+
+    # Returns the SheetBlocks for reading the data range with processes
+    # worker processes or None if it should be read serially.
+    # Each worker reads the file for itself so it has to be a real file and
+    # we can't already be holding the sheet in a WorkbookCache.
+    def data_blocks(self, processes):
+
+        if (self.cache != None) or not os.path.isfile(self.spreadsheet.name):
+            return None
+
+        if processes == None:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+
+        data     = self.metadata.data
+        workbook = self.open_workbook()
+        index    = workbook.sheet(data.sheet) if (data.sheet != None) else 0
+        rows     = max(self.parallel_rows, (data.height + processes - 1) // processes)
+
+        return sheet_blocks(self.spreadsheet, index, workbook, data.start.row, data.end.row, rows, self.parallel_bytes)
+
+
+    # Reads the data range a SheetBlock at a time in a pool of processes
+    # worker processes and returns the columns, as read_columns() does, and
+    # an Aggregator that has picked out the cells for the aggregates, or None
+    # if there are no aggregates.
+    # Assumes that the header has already been read. See iter_rows() for
+    # names.
+    def read_blocks(self, blocks, names, processes):
+
+        data  = self.metadata.data
+        tasks = []
+        for (i, block) in enumerate(blocks):
+            last = (blocks[i + 1].row - 1) if (i + 1 < len(blocks)) else data.end.row
+            tasks.append((block, max(block.row, data.start.row), last))
+
+        # Compiled plans refer to bound methods, which can't be sent to the
+        # workers, so they compile the header again.
+        metadata = copy.copy(self.metadata)
+        metadata.plans = {}
+
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, init_block_worker, (metadata, self.spreadsheet.name, self.workbook, self.header, names))
+        try:
+            results = pool.map(block_worker_read, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        # The blocks come back in order so their rows just follow on.
+        (columns, aggregator) = results[0]
+        for (result, block_aggregator) in results[1:]:
+            for (name, column) in columns.iteritems():
+                column.extend(result[name])
+            if aggregator != None:
+                aggregator.merge(block_aggregator)
+
+        return (columns, aggregator)
+
+
+    # Returns the key for the result of the operation in our ResultCache or
+    # None if we don't have one.
+    def result_key(self, *operation):
+
+        if self.results == None:
+            return None
+
+        return self.results.key(self.spreadsheet, self.declared, operation)
+
+
+    # Puts the result of an operation, the header that it read, what it found
+    # and the columns if it returned any, in our ResultCache under key.
+    # The metadata is only stored if its named ranges have been resolved and
+    # then just as the ranges that they resolved to.
+    def store_result(self, key, header, columns = None):
+
+        tables = None
+        if self.metadata is not self.declared:
+            tables = [[plain_range(range) for range in table] for table in self.metadata.tables]
+
+        result = {
+                "tables"     : tables,
+                "header"     : None if (header == None) else [[name for (name, type) in row] for row in header],
+                "errors"     : [plain_error(error) for error in self.errors],
+                "aggregates" : None if (self.aggregates == None) else [(function, name, plain_value(value)) for ((function, name), value) in self.aggregates.iteritems()],
+                "columns"    : None if (columns == None) else [plain_column(column) for column in columns.itervalues()],
+                }
+
+        self.results.put(key, result)
+
+
+    # Puts the instance back into the state that the operation that stored
+    # result left it in and returns True, along with its columns or None if it
+    # didn't return any. Returns (False, None) if result isn't in the form
+    # that store_result() writes, so the operation has to be done again.
+    def restore_result(self, result):
+
+        try:
+            metadata = self.declared
+            if result["tables"] != None:
+                metadata = copy.copy(self.declared)
+                metadata.tables = [[range_from_plain(range) for range in table] for table in result["tables"]]
+                (metadata.header, metadata.data) = metadata.tables[0]
+
+            header = None
+            if result["header"] != None:
+                header = [[(name, metadata.keys[name]) for name in row] for row in result["header"]]
+
+            errors = [error_from_plain(error) for error in result["errors"]]
+
+            aggregates = None
+            if result["aggregates"] != None:
+                aggregates = collections.OrderedDict(((function, name), value_from_plain(value)) for (function, name, value) in result["aggregates"])
+
+            columns = None
+            if result["columns"] != None:
+                columns = collections.OrderedDict()
+                for value in result["columns"]:
+                    column = column_from_plain(value, metadata.keys)
+                    columns[column.name] = column
+
+            plan = metadata.compile(header) if (header != None) else None
+
+        except (KeyError, IndexError, TypeError, ValueError, AssertionError):
+            return (False, None)
+
+        self.metadata   = metadata
+        self.header     = header
+        self.errors     = errors
+        self.aggregates = aggregates
+
+        if plan != None:
+            self.plan = plan
+
+        return (True, columns)
+
+
+    # Checks the spreadsheet against the metadata without extracting any of
+    # the data and returns a list of CellErrors for the problems that it
+    # finds. The spreadsheet is valid if the list is empty.
+    # Missing sheets and names, ranges that run off the end of the sheet and
+    # headers that don't match the metadata are reported in the list rather
+    # than raised. If the header is good then the data is type checked
+    # without making any CellValues. Reading stops as soon as max_errors
+    # problems have been found, or at the end of the data if max_errors is
+    # None, so invalid spreadsheets are usually rejected without reading most
+    # of the file.
+    def check(self, max_errors = 1):
+
+        assert ((max_errors == None) or (max_errors > 0)), ("instance.check: Expected max_errors argument to be None or a positive number but we got %s." % max_errors)
+
+        key = self.result_key("check", max_errors)
+        if key != None:
+            result = self.results.get(key)
+            if result != None:
+                (restored, columns) = self.restore_result(result)
+                if restored:
+                    return self.errors
+
+        self.errors = []
+        header      = None
+
+        with phase("check", max_errors = max_errors) as fields:
+            try:
+                sheet1 = self.open_sheet()
+                header = self.check_header(sheet1, max_errors)
+
+                if header != None:
+                    self.plan = self.metadata.compile(header)
+                    self.check_data(sheet1, max_errors)
+
+            except (SpreadsheetError, zipfile.BadZipfile) as e:
+                range = self.metadata.header
+                if isinstance(range, NamedRange):
+                    range = RangeReference(CellReference("A1"), CellReference("A1"), range.sheet)
+                self.errors.append(CellError(range.start.row, range.start.column, None, str(e)))
+
+            if max_errors != None:
+                del self.errors[max_errors:]
+            fields["errors"] = len(self.errors)
+
+        if key != None:
+            self.store_result(key, header)
+
+        return self.errors
 
-# A reference to a specific cell in a spreadsheet.
-class CellReference:
 
-    def __init__(self, spec):
+    # Reads the header for check() and returns it in the form that
+    # state.compile() expects or None if it has any problems, which are added
+    # to errors.
+    def check_header(self, sheet, max_errors):
 
-        cell = cell_re.match(spec)
-        assert (cell != None), ("CellReference:.__init__ Invalid cell specifier %s." % spec)
+        range  = self.metadata.header
+        header = []
+        errors = self.errors
+        seen   = set()
+        rows   = 0
+        cells  = sheet.rows(range)
 
-        column = cell.group(1)
-        row    = cell.group(2)
+        try:
+            for (r, row_cells) in cells:
+                rows += 1
+                row   = []
 
-        n = 0
-        for c in range(len(column)):
-            n = (n * 26) + (ord(column) - ord('A') + 1)
+                if len(row_cells) < range.width:
+                    errors.append(CellError(r, range.start.column + len(row_cells), None, "Row does not contain enough columns to contain the header! Range is at %s." % range))
 
-        self.column = n - 1
-        self.row    = int(row) - 1
+                for cell in row_cells:
+                    if not cell.isstring():
+                        errors.append(CellError(cell.row, cell.column, None, "Expected a header but we got %s." % ("an empty cell" if cell.raw()[0] == None else "a %s" % cell.type())))
+                    elif cell.value() not in self.metadata.keys:
+                        errors.append(CellError(cell.row, cell.column, None, "The spreadsheet contains an unexpected header! We got %s." % cell.value()))
+                    else:
+                        seen.add(cell.value())
+                        row.append((cell.value(), self.metadata.keys[cell.value()]))
 
-        self.cell = spec
+                    if (max_errors != None) and (len(errors) >= max_errors):
+                        return None
 
+                header.append(row)
 
-    def __str__(self):
-        return ("%s" % self.cell)
+        finally:
+            cells.close()
 
+        if rows < range.height:
+            errors.append(CellError(range.start.row + rows, range.start.column, None, "Sheet does not contain enough rows to contain the header! Range is at %s." % range))
 
+        if errors:
+            return None
 
-# A reference to a range of cells in a spreadsheet.
-class RangeReference:
+        for key in self.metadata.keys:
+            if key not in seen:
+                warn("Header %s of type %s was declared but not used!" % (key, self.metadata.keys[key]))
 
-    def __init__(self, start, end):
+        return header
 
-        assert isinstance(start, CellReference), ("RangeReference.__init__: Expected start argument to be of type 'CellReference' but we got %s." % start)
-        assert isinstance(end,   CellReference), ("RangeReference.__init__: Expected end argument to be of type 'CellReference' but we got %s." % end)
 
-        self.start = start
-        self.end   = end
-        self.width = (end.column   - start.column) + 1
-        self.height= (end.row      - start.row)    + 1
+    # Type checks the data for check(), adding any problems to errors.
+    # Rows are read check_rows at a time and each column of them is checked in
+    # one go with its type's convert_column(), which is much quicker than
+    # checking each cell on its own. When there is only one row of headers,
+    # blocks of repeated rows are only checked once.
+    # Any aggregates are worked out and reconciled as in extract_columns() if
+    # the whole of the data is read.
+    def check_data(self, sheet, max_errors):
 
+        range      = self.metadata.data
+        errors     = self.errors
+        chunk      = []
+        aggregator = self.aggregator(self.plan, None)
 
-    def __str__(self):
-        return ("RangeReference(%s:%s)" % (self.start, self.end))
+        read = range
+        if (aggregator != None) and (aggregator.last_row > range.end.row):
+            read = range.rows(range.start.row, aggregator.last_row)
 
+        if len(self.plan.rows) == 1:
+            blocks = sheet.blocks(read)
+        else:
+            blocks = ((r, 1, cells) for (r, cells) in sheet.rows(read))
 
+        next_row = range.start.row
 
-# A base class that can be inherited from to encapsulate all the accessor logic
-# for different spreadsheet formats and spreadsheet reading libraries.
-# This differs from a CellValue because it's just the spreadsheet data. It can
-# be any cell in a spreadsheet and does not have to be associated with any
-# slang metadata.
-class Cell:
-    None
+        try:
+            for (r, count, cells) in blocks:
+
+                # Rows below the data are only read for the aggregator.
+                if r + count > range.end.row + 1:
+                    if aggregator != None:
+                        aggregator.capture(r, count, cells)
+                    if r > range.end.row:
+                        continue
+                    count = range.end.row + 1 - r
+
+                if len(cells) < range.width:
+                    errors.append(CellError(r, range.start.column + len(cells), None, "Row does not contain enough columns to contain the data! Range is at %s." % range))
+                else:
+                    chunk.append((r, cells))
+                    if aggregator != None:
+                        aggregator.add(r - range.start.row, count, cells)
 
+                next_row = r + count
 
+                if len(chunk) == self.check_rows:
+                    self.check_chunk(chunk)
+                    chunk = []
 
-# A wrapper around a Cell from an ODF Spreadsheet to encapsulate all the
-# accessor logic.
-class OdfCell(Cell):
+                if (max_errors != None) and (len(errors) >= max_errors):
+                    return
 
-        def __init__(self, value, row, column):
+        finally:
+            blocks.close()
 
-            assert isinstance(value,  opendocument.element.Element), ("OdfCell.__init__: Expected type argument to be of type 'opendocument.element.Element' but we got %s." % value)
-            assert isinstance(row,    int),                          ("OdfCell.__init__: Expected row argument ot be of type 'int' but we got %s." % row)
-            assert isinstance(column, int),                          ("OdfCell.__init__: Expected column argument ot be of type 'int' but we got %s." % column)
+        self.check_chunk(chunk)
 
-            self.cell   = value
-            self.row    = row
-            self.column = column
+        rows = next_row - range.start.row
+        hooks.count("rows",  rows)
+        hooks.count("cells", rows * range.width)
 
+        if next_row <= range.end.row:
+            errors.append(CellError(next_row, range.start.column, None, "Sheet does not contain enough rows to contain the data! Range is at %s." % range))
+        else:
+            self.reconcile(aggregator)
 
-        def __str__(self):
-            return ("<Row: %d, Column: %d, Value: %s>" % (self.row, self.column, self.value()))
 
+    # Type checks a list of (row, cells) for check_data() and adds any
+    # problems to errors in the order of the cells that they are about.
+    def check_chunk(self, chunk):
 
-        def test_attribute(self, key, value):
-            try:
-                if self.cell.attributes[key] == value:
-                    return True
-                else:
-                    return False
+        first  = self.metadata.data.start
+        plan   = self.plan.rows
+        found  = []
 
-            except KeyError:
-                return False
+        for (offset, header) in enumerate(plan):
+            rows = [(r, cells) for (r, cells) in chunk if ((r - first.row) % len(plan)) == offset]
+            if len(rows) == 0:
+                continue
 
+            for (c, (name, type, converter)) in enumerate(header):
+                (values, valid, column_errors) = type.convert_column([cells[c].raw() for (r, cells) in rows])
+                for (i, message) in column_errors:
+                    found.append(CellError(rows[i][0], first.column + c, name, message))
+
+        found.sort(key = lambda error: (error.row, error.column))
+        self.errors.extend(found)
+
+
+    # How many rows of data check() and iter_rows() read before checking
+    # them.
+    check_rows = 256
+
+
+    # Checks the values that the spreadsheet program cached for the formulae
+    # in the data range against the values of their inputs and returns a
+    # list of CellErrors for the ones that don't match.
+    # The numbers in each column of the data are gathered into an array as
+    # they are read and each formula is tokenised relative to its cell. The
+    # cells in a column that have the same tokens are then evaluated together
+    # in one batch. Formulae that parse_formula() doesn't support, or that
+    # refer to cells outside the data range or to cells that don't hold
+    # numbers, are not checked.
+    # Office Open XML only gives a shared formula in the master cell, the
+    # first cell of its group, and the others just give the group's si. The
+    # tokens are relative to the cell so the master's tokens are used for the
+    # whole group. Groups whose master is outside the data are not checked.
+    def verify_formulas(self):
+
+        found = []
+
+        with phase("formulas") as fields:
+            sheet1 = self.open_sheet()
+
+            # The header only needs reading if the data hasn't already been.
+            if self.plan == None:
+                self.read_header(sheet1)
+
+            data       = self.metadata.data
+            inputs     = dict((c, (data.start.row, array.array('d'))) for c in range(data.start.column, data.end.column + 1))
+            groups     = collections.OrderedDict()  # (column, tokens) -> [row]
+            shared     = {}                         # si -> the tokens of the master cell of a shared formula.
+            unverified = 0
+            nan        = float("nan")
+
+            for row in self.iter_range(sheet1, data, lambda cell: cell):
+                for cell in row:
+                    (value_type, value, currency, formula) = cell.raw()
+
+                    number = nan
+                    if value_type == None:
+                        number = 0.0
+                    elif value_type in formula_numeric_types:
+                        try:
+                            number = float(value)
+                        except (TypeError, ValueError):
+                            pass
+                    inputs[cell.column][1].append(number)
+
+                    if not formula:
+                        continue
+
+                    si = cell.shared_formula()
+                    try:
+                        text = cell.formula()
+                        if text:
+                            tokens = formula_tokens(text, cell.row, cell.column)
+                            if si != None:
+                                shared[si] = tokens
+                        else:
+                            tokens = shared[si]
+                    except (KeyError, ValueError):
+                        tokens = None
+
+                    if tokens == None:
+                        unverified += 1
+                    else:
+                        groups.setdefault((cell.column, tokens), []).append(cell.row)
+
+            # Each distinct formula is parsed once and evaluated for all the
+            # cells that share it.
+            trees = {}
+            for ((column, tokens), rows) in groups.iteritems():
+                tree = trees.get(tokens)
+                if tree == None:
+                    try:
+                        tree = trees[tokens] = FormulaParser(tokens).parse()
+                    except ValueError:
+                        unverified += len(rows)
+                        continue
+
+                (first_row, values) = inputs[column]
+                suspects = []
+                for (r, calculated) in itertools.izip(rows, evaluate_formula(tree, rows, column, inputs)):
+                    cached = values[r - first_row]
+                    if (calculated == None) or (cached != cached):
+                        unverified += 1
+                    elif formula_mismatch(calculated, cached):
+                        suspects.append(r)
+
+                # Floats are only approximate so the cells that don't seem to
+                # match are calculated again exactly before we report them.
+                for (r, calculated) in itertools.izip(suspects, evaluate_formula(tree, suspects, column, inputs, formula_decimal)):
+                    cached = formula_decimal(values[r - first_row])
+                    if calculated == None:
+                        unverified += 1
+                    elif formula_mismatch(calculated, cached, formula_decimal):
+                        (name, type, converter) = self.plan.row(r - data.start.row)[column - data.start.column]
+                        found.append(CellError(r, column, name, "The formula calculates %s but the spreadsheet has %s." % (calculated, cached)))
+
+            found.sort(key = lambda error: (error.row, error.column))
+
+            fields["formulas"]   = sum(len(rows) for rows in groups.itervalues())
+            fields["groups"]     = len(trees)
+            fields["unverified"] = unverified
+            fields["errors"]     = len(found)
+
+        return found
 
-        # Returns True if the user specified this cell as a formula; False
-        # otherwise.
-        # The value calculated and cached by the spreadsheet program may be
-        # available via value().
-        def isformula(self):
-            return ((u'urn:oasis:names:tc:opendocument:xmlns:table:1.0', u'formula') in self.value.attributes)
+
+    header = None
+    data   = None
+    plan   = None
+    errors = None
 
 
-        # Returns True if the value of this cell was formatted as a string by
-        # the spreadsheet program; False otherwise.
-        def isstring(self):
-            return self.test_attribute((u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value-type'), u'string')
 
+###############################################################################
+# Large data ranges.
+#
+# A data range that is too big to read quickly in one go is split into
+# SheetBlocks by instance.extract_columns(). Each worker process opens the
+# file for itself, skips to the start of its block and reads just the rows
+# in it, so the blocks are parsed, converted and validated concurrently.
 
-        # Returns True if the value of this cell was formatted as currency by
-        # the spreadsheet program; False otherwise.
-        def iscurrency(self):
-            return self.test_attribute((u'urn:org:documentfoundation:names:experimental:calc:xmlns:calcext:1.0', u'value-type'), u'currency')
+# The table that the worker processes read blocks from. Each worker gets its
+# own copy when it starts.
+block_worker = None
 
+def init_block_worker(metadata, path, workbook, header, names):
 
-        # Returns the spreadsheet program's internal type designation for the
-        # cell.
-        # TODO: Hide the internal type designations behind an interface.
-        def type(self):
-            return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value-type')])
+    global block_worker
 
+    table        = instance(metadata, open(path, "rb"), workbook = workbook)
+    table.header = header
+    table.plan   = metadata.compile(header)
 
-        # Returns the raw value that the user entered into the cell in the
-        # spreadsheet program.
-        # Returns a string.
-        def value(self):
+    block_worker = (table, table.projection(names))
 
-            if self.isstring():
-                return unicode(self.cell)
 
-            else:
-                return unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'value')])
+# Returns the Columns for the rows from first_row to last_row of the data
+# range, which are in block, and an Aggregator. Only the last block picks out
+# the cells for the aggregates, which are below the data. task is a (block,
+# first_row, last_row) tuple.
+def block_worker_read(task):
 
+    (block, first_row, last_row) = task
+    (table, (plan, columns))     = block_worker
 
-        # Throws an exception if isformula() would have returned False.
-        # Returns the spreadsheet program's internal representation of the
-        # formula that the user specified in this cell.
-        # TODO: Provide a way to parse the formula as this procedure is not
-        #       much more useful than isformula() at the moment.
-        def formula(self):
-            unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:table:1.0', u'formula')])
+    data  = table.metadata.data
+    sheet = table.open_sheet()
+    sheet.block = block
 
+    plan       = plan.shift(first_row - data.start.row)
+    aggregator = table.aggregator(plan, columns, (last_row == data.end.row), False)
 
-        # Throws an exception if iscurrency() would have returned False.
-        # Returns the spreadsheet program's internal representation of which
-        # currency it thinks the cell's value is denominated in. For example,
-        # u'GBP'.
-        # TODO: Hide the internal currency designations behind an interface.
-        def currency(self):
-            unicode(self.cell.attributes[(u'urn:oasis:names:tc:opendocument:xmlns:office:1.0', u'currency')])
+    return (table.read_columns(sheet, data.rows(first_row, last_row), plan, columns, aggregator), aggregator)
 
 
 
-# A slang representation of some data from a spreadsheet cell.
-# It consists of a wrapper around the actual contents of a cell along with the
-# slang type annotations required to validate and extract it.
-class CellValue:
+###############################################################################
+# Workbooks with several tables.
+#
+# Tables are extracted independently of each other so they can be read
+# concurrently by a pool of worker processes. Each worker opens the file for
+# itself and uses a WorkbookIndex, made once by the parent, to go straight to
+# the sheet that it needs.
 
-    def __init__(self, type, name, value):
+# Extracts the columns of the table at index in the metadata from the
+# spreadsheet at path and returns an (index, columns, errors) tuple.
+def extract_table(metadata, path, workbook, index):
 
-        assert isinstance(type,  Type),    ("CellValue.__init__: Expected type argument to be of type 'Type' but we got %s." % type)
-        assert isinstance(name,  unicode), ("CellValue.__init__: Expected name argument to be of type 'unicode' but we got %s." % name)
-        assert isinstance(value, Cell),    ("CellValue.__init__: Expected value argument to be of type 'Cell' but we got %s." % value)
+    spreadsheet = open(path, "rb")
 
-        self.type = type
-        self.name = name
-        self.cell = value
+    try:
+        table   = instance(metadata.table(index), spreadsheet, workbook = workbook)
+        columns = table.extract_columns()
+    finally:
+        spreadsheet.close()
 
+    return (index, columns, table.errors)
 
-    # TODO: Remove this: it's just a hack for poc.py to easily display things.
-    def __repr__(self):
-        return ("<%s, %s, %s>" % (self.type, self.name, self.value()))
 
+# The metadata, path and WorkbookIndex that the worker processes extract
+# tables from. Each worker gets its own copy when it starts.
+table_worker = None
 
-    def check(self):
+def init_table_worker(metadata, path, workbook):
+    global table_worker
+    table_worker = (metadata, path, workbook)
 
-        assert True
+def table_worker_extract(index):
+    (metadata, path, workbook) = table_worker
+    return extract_table(metadata, path, workbook, index)
 
 
-    def value(self):
-        return self.cell.value()
+# Extracts every table that the metadata declares from the spreadsheet at
+# path using a pool of processes worker processes, or one per CPU if
+# processes is None.
+# Returns a list with a (header, data, columns, errors) tuple for each table,
+# as returned by instance.extract_columns(), in the order that the tables'
+# sheets appear in the workbook and then in the order that they were
+# declared.
+def extract_tables(metadata, path, processes = None):
+
+    assert isinstance(metadata, state),      ("extract_tables: Expected metadata argument to be of type 'state' but we got %s." % metadata)
+    assert isinstance(path,     basestring), ("extract_tables: Expected path argument to be of type 'str' but we got %s." % path)
+    assert metadata.validate(),              ("extract_tables: Could not validate metadata!")
+
+    spreadsheet = open(path, "rb")
+    try:
+        workbook = workbook_index(spreadsheet)
+    finally:
+        spreadsheet.close()
+
+    metadata = metadata.resolve(workbook)
+
+    def position(index):
+        sheet = metadata.tables[index][1].sheet
+        return ((workbook.sheet(sheet) if sheet != None else 0), index)
+
+    tables = sorted(range(len(metadata.tables)), key = position)
+
+    # Compiled plans refer to bound methods, which can't be sent to the
+    # workers, so they start afresh.
+    metadata = copy.copy(metadata)
+    metadata.plans = {}
+
+    with phase("tables", file = path, tables = len(tables), processes = processes):
+        if (processes == 1) or (len(tables) == 1):
+            results = [extract_table(metadata, path, workbook, index) for index in tables]
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes, init_table_worker, (metadata, path, workbook))
+            try:
+                results = pool.map(table_worker_extract, tables)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+    return [(metadata.tables[index][0], metadata.tables[index][1], columns, errors) for (index, columns, errors) in results]
 
 
 
 ###############################################################################
-# Handlers for the Datatypes that can be declared in Spreadsheet Metadata.
+# Compiled Metadata.
+#
+# Parsing a .slang file every time that a program starts soon adds up when
+# there are many of them, so the parsed state is kept in a .slangc file beside
+# each one, much like Python keeps a .pyc beside each .py.
+#
+# A .slangc file holds a header and then the state itself. The header records
+# the format version along with the size, modification time and SHA-1 of the
+# .slang file that it was compiled from. If the size or modification time have
+# changed then the SHA-1 decides whether the .slangc can still be used so that
+# touching a file doesn't throw its compiled form away.
+# Both are written with marshal rather than pickle, as .slangr files are, so
+# that a .slangc that someone else has left beside a .slang can't run any
+# code when it is read. The state is turned into plain data with plain_state()
+# and its Types are named as they are in .slang files.
+#
+# Bump slangc_version whenever state, or anything that it holds, changes shape.
+
+slangc_magic   = "slangc"
+slangc_version = 3
+
+
+# Returns the state as plain data that marshal can store. A table that has a
+# header but no data yet holds None in place of its data range.
+def plain_state(metadata):
+
+    types = dict((type, name) for (name, type) in slang.types.iteritems())
+
+    return {
+            "keys"       : [(name, types[type.__class__]) for (name, type) in metadata.keys.iteritems()],
+            "tables"     : [[(range and plain_range(range)) for range in table] for table in metadata.tables],
+            "aggregates" : [(table, cell.row, cell.column, function, name) for (table, cell, function, name) in metadata.aggregates],
+            }
 
-# The base class for all the types.
-class Type:
-    None
 
+# Returns the state that plain_state() turned into value.
+# Raises a ValueError, TypeError, KeyError or IndexError if value is not in
+# the form that plain_state() returns.
+def state_from_plain(value):
 
-# Any old string.
-class slang_String(Type):
+    metadata = state()
 
-    def __str__(self):
-        return "slang::String"
+    for (name, type) in value["keys"]:
+        metadata.keys[name] = slang.types[type]()
 
+    metadata.tables = [[(range and range_from_plain(range)) for range in table] for table in value["tables"]]
+    if len(metadata.tables) > 0:
+        (metadata.header, metadata.data) = metadata.tables[0]
 
-# Currency in Sterling, excluding VAT.
-class slang_GBPxVAT(Type):
+    for (table, row, column, function, name) in value["aggregates"]:
+        if (function not in aggregate_functions) or (name not in metadata.keys) or not (0 <= table < len(metadata.tables)):
+            raise ValueError("state_from_plain: Expected an aggregate but we got %s." % ((table, row, column, function, name),))
+        metadata.aggregates.append((table, CellReference("%s%d" % (column_name(column), row + 1)), function, name))
 
-    def __str__(self):
-        return "slang::GBPxVAT"
+    return metadata
 
 
-# Any old number.
-class slang_Number(Type):
+# Returns the path of the compiled form of the .slang file at path.
+def compiled_path(path):
+    return os.path.splitext(path)[0] + ".slangc"
 
-    def __str__(self):
-        return "slang::Number"
 
+# Returns the SHA-1 of the contents of the file at path.
+def file_digest(path):
 
-# Any old formula.
-class slang_Formula(Type):
+    input = open(path, "rb")
+    try:
+        return hashlib.sha1(input.read()).hexdigest()
+    finally:
+        input.close()
 
-    def __str__(self):
-        return "slang::Formula"
 
+# Returns the state in the compiled form of the .slang file at path or None if
+# there isn't one or if it's out of date.
+# digest is the SHA-1 of the .slang file if we already know it.
+def read_compiled(path, digest = None):
 
+    try:
+        stat  = os.stat(path)
+        input = open(compiled_path(path), "rb")
+    except (IOError, OSError):
+        return None
 
-###############################################################################
-# Internal Representation of a Spreadsheet Metadata Language description
+    try:
+        try:
+            header = marshal.load(input)
+            if (not isinstance(header, dict)) or (header.get("magic") != slangc_magic) or (header.get("version") != slangc_version):
+                return None
 
-class state:
+            if header["size"] != stat.st_size:
+                return None
 
-    def __init__(self):
-        True
+            if header["mtime"] != stat.st_mtime:
+                if digest == None:
+                    digest = file_digest(path)
+                if header["sha1"] != digest:
+                    return None
 
+            metadata = state_from_plain(marshal.load(input))
 
-    # declare-type Price GBPxVAT
-    def declare_type(self, name, type):
+        except (EOFError, KeyError, IndexError, TypeError, ValueError, AssertionError):
+            return None
 
-        assert isinstance(name, str),  ("state.declare_type: Expected name argument to be of type 'str' but we got %s." % name)
-        assert isinstance(type, Type), ("state.declare_type: Expected type argument to be of type 'Type' but we got %s." % type)
-        assert (name not in self.keys),  ("state.delatre_type: Conflicting declaration for name %s as %s. %s has already been declared as %s." % (name, type, name, self.keys[name]))
+    finally:
+        input.close()
 
-        self.keys[name] = type
+    return metadata
 
-        print("  declare_type: name = %s, type = %s" % (name, type))
 
+# Writes metadata out as the compiled form of the .slang file at path.
+# The .slangc is written to a temporary file and then renamed over the old one
+# so that other processes only ever see a whole one. If it can't be written,
+# for example because the directory is read-only, then we carry on without it.
+def write_compiled(path, metadata, digest = None):
 
-    # declare-header A3:D3
-    def declare_header(self, range):
+    assert isinstance(metadata, state), ("write_compiled: Expected metadata argument to be of type 'state' but we got %s." % metadata)
 
-        assert isinstance(range, RangeReference),           ("state.declare_header: Expected range argument to be of type 'RangeReference' but we got %s." % range)
-        assert ((range.height == 1) or (range.width) == 1), ("state.declare_header: range argument must describe either a single row or a single column. We got %s." % range)
+    if digest == None:
+        digest = file_digest(path)
 
-        self.header = range
+    stat = os.stat(path)
 
-        print("  declare_header: range = %s" % (range))
+    header = {
+            "magic"   : slangc_magic,
+            "version" : slangc_version,
+            "size"    : stat.st_size,
+            "mtime"   : stat.st_mtime,
+            "sha1"    : digest,
+            }
 
+    target    = compiled_path(path)
+    temporary = "%s.%d.tmp" % (target, os.getpid())
 
-    # declare-data A4:D8
-    def declare_data(self, range):
+    try:
+        output = open(temporary, "wb")
+        try:
+            marshal.dump(header,                 output, 2)
+            marshal.dump(plain_state(metadata),  output, 2)
+        finally:
+            output.close()
+        os.rename(temporary, target)
+
+    except (IOError, OSError) as e:
+        warn("write_compiled: Could not write %s: %s" % (target, e))
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        return False
 
-        assert isinstance(range, RangeReference), ("state.declare_data: Expected range argument to be of type 'RangeReference' but we got %s." % range)
+    return True
 
-        self.data = range
 
-        print("  declare_data: range = %s" % (range))
+# Returns the state for the .slang file at path, from its compiled form if
+# that is up to date. Otherwise the file is parsed and, if compile is True,
+# the compiled form is brought up to date.
+def load_state(path, compile = True):
 
+    assert isinstance(path, basestring), ("load_state: Expected path argument to be of type 'str' but we got %s." % path)
 
-    # Check that we have most of what we need to extract some data from a spreadsheet
-    def validate(self):
+    with phase("load", file = path) as fields:
 
-        assert isinstance(self.keys,   dict),           ("state.validate: keys is no longer a dictionary! We got %s." % self.keys)
-        assert isinstance(self.header, RangeReference), ("state.validate: Please provide a valid header reference with the 'declare_header' directive. We got %s." % self.header)
-        assert isinstance(self.data,   RangeReference), ("state.validate: Please provide a valid data reference with the 'declare_data' directive. We got %s." % self.data)
+        digest   = None
+        metadata = read_compiled(path)
+        fields["compiled"] = (metadata != None)
 
-        if (self.header.height == 1):
-            assert (self.data.width == self.header.width),   ("state.validate: header describes a row so data must have the same number of columns. We got header = %s and data = %s." % (self.header, self.data))
+        if metadata == None:
+            digest = file_digest(path)
 
-        if (self.header.width == 1):
-            assert (self.data.height == self.header.height), ("state.validate: header describes a column so data must have the same number of rows. We got header = %s and data = %s." % (self.header, self.data))
+            input = open(path)
+            try:
+                parser = slang(input)
+                parser.parse()
+            finally:
+                input.close()
 
-        return True
+            metadata = parser.state
+            if compile:
+                write_compiled(path, metadata, digest)
 
+    return metadata
 
-    # Internal state
-    keys   = {}
-    header = None
-    data   = None
+
+# Returns a slang object for the .slang file at path.
+# Nothing is read until the metadata is first used.
+def load(path, compile = True):
+    return slang(path, compile)
 
 
 
 ###############################################################################
-# A spreadsheet and some metadata that might be valid for it.
+# Choosing the Metadata for a Spreadsheet.
+#
+# A SchemaRegistry holds the metadata for many kinds of spreadsheet and works
+# out which of them describe a particular workbook without having to try each
+# one in turn.
+#
+# Metadata is indexed by the geometry of its header, which is the sheet and
+# range that it expects the header to be in, and by the names that it
+# declares types for. The fingerprint of some metadata is its geometry along
+# with the set of those names. To match a workbook we read the cells of every
+# distinct header geometry once, reading each sheet only as far as the last
+# header on it, and look up the fingerprint of what we find there. Anything
+# that only partly matches is ranked by how many names it has in common with
+# the header.
+#
+# Only the first table of each metadata is considered as that is the one that
+# an instance deals with.
+
+# Returns the geometry of a header range as something that can be hashed.
+# Named ranges are identified by their names as their cells depend on the
+# workbook.
+def header_geometry(range):
+
+    if isinstance(range, NamedRange):
+        return (range.sheet, range.name)
+
+    return (range.sheet, range.start.row, range.start.column, range.end.row, range.end.column)
+
+
+# Returns the fingerprint of a header with the given geometry that contains
+# the given names.
+def header_fingerprint(geometry, names):
+    return (geometry, frozenset(names))
+
+
+class SchemaRegistry:
 
-class instance:
+    def __init__(self):
 
-    def __init__(self, metadata, spreadsheet):
+        self.schemas      = collections.OrderedDict() # name -> state
+        self.ranges       = collections.OrderedDict() # geometry -> header range
+        self.fingerprints = {}                        # fingerprint -> [name]
+        self.postings     = {}                        # (geometry, header name) -> [name]
 
-        assert isinstance(metadata,    state), ("instance.__init__: Expected metadata argument to be of type 'state' but we got %s."   % metadata)
-        assert isinstance(spreadsheet, file),  ("instance.__init__: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
 
-        self.metadata    = metadata
-        self.spreadsheet = spreadsheet
-        self.unused_keys = dict(metadata.keys)
+    def __len__(self):
+        return len(self.schemas)
 
 
-    # Returns the appropriate (name, slang Type Constructor) tuple for the
-    # given row and column.
-    # row and column are relative to the data range, not the sheet. i.e. the
-    # top left cell in a range is always (0, 0).
-    # Assumes that the headers have already been parsed successfully.
-    # Assumes that the is either only one row or one column of headers.
-    def find_constructor(self, row, column):
+    def __contains__(self, name):
+        return name in self.schemas
 
-        assert isinstance(row,    int), ("find_constructor: Expected row argument ot be of type 'int' but we got %s." % row)
-        assert isinstance(column, int), ("find_constructor: Expected column argument ot be of type 'int' but we got %s." % column)
 
-        row    = row % len(self.header)
-        row    = self.header[row]
-        column = column % len(row)
+    # Adds metadata, which is a state, to the registry under name.
+    def add(self, name, metadata):
 
-        return row[column]
+        assert isinstance(metadata, state),    ("SchemaRegistry.add: Expected metadata argument to be of type 'state' but we got %s." % metadata)
+        assert (name not in self.schemas),     ("SchemaRegistry.add: There is already some metadata called %s." % name)
+        assert (metadata.header != None),      ("SchemaRegistry.add: %s does not declare a header." % name)
 
+        geometry = header_geometry(metadata.header)
+        keys     = frozenset(metadata.keys)
 
-    # Read a range of cells from the sheet, call proc for each cell and return
-    # the results of proc as a two-dimensional array.
-    def parse_range(self, sheet, range_ref, cell_proc, row_proc = list.append):
-        result = []
-        rows   = sheet.getElementsByType(TableRow)
-        n_rows = len(rows)
+        self.schemas[name] = metadata
+        self.ranges.setdefault(geometry, metadata.header)
+        self.fingerprints.setdefault(header_fingerprint(geometry, keys), []).append(name)
 
-        assert (n_rows > range_ref.end.row), ("instance.parse_range: Sheet does not contain enough rows to contain the range specified! Range is at %s." % range_ref)
+        for key in keys:
+            self.postings.setdefault((geometry, key), []).append(name)
 
-        for r in range(range_ref.start.row, range_ref.end.row + 1):
-            new_row = []
-            cells   = rows[r].getElementsByType(TableCell)
-            n_cells = len(cells)
 
-            assert (n_cells > range_ref.end.column), ("instance.parse_range: Row %d does not contain enough columns to contain the range specified! Range is at %s. We got %s." % (r, range_ref, cells))
+    # Adds the metadata in the .slang file at path, which is also its name in
+    # the registry. See load_state() for compile.
+    def load(self, path, compile = True):
+        self.add(path, load_state(path, compile))
 
-            for c in range(range_ref.start.column, range_ref.end.column + 1):
-                new_row.append(cell_proc(OdfCell(cells[c], r, c)))
 
-            row_proc(result, new_row)
+    # Reads the cells of every header geometry in the registry from the
+    # spreadsheet and returns a dictionary that maps each geometry to a list of
+    # the names in its cells, in order. Cells that don't hold a string are None.
+    # Geometries whose sheets or names aren't in the workbook are left out.
+    def read_headers(self, spreadsheet, cache = None, workbook = None):
 
-        return result
+        # Work out which cells each geometry covers.
+        named    = any(((range.sheet != None) or isinstance(range, NamedRange)) for range in self.ranges.itervalues())
+        sheets   = {}
+        resolved = {}
 
+        if named and (workbook == None):
+            if cache != None:
+                workbook = cache.workbook(spreadsheet)
+            else:
+                workbook = workbook_index(spreadsheet)
 
-    # Read the contents of a cell that's supposed to be part of the header and
-    # return a tuple consisting of the name of the column and the slang Type
-    # constructor appropriate for the corresponding cells from the data
-    # region.
-    def parse_header_cell(self, cell):
+        for (geometry, range) in self.ranges.iteritems():
+            try:
+                if isinstance(range, NamedRange):
+                    range = range.resolve(workbook)
+                index = 0
+                if range.sheet != None:
+                    index = workbook.sheet(range.sheet)
+            except AssertionError:
+                continue
 
-        assert isinstance(cell, Cell),        ("read_header: Expected cell argument to be of type 'Cell' but we got %s." % cell)
-        assert (cell.isstring()),             ("read_header: Expected Cell of type string but we got %s." % cell)
+            resolved[geometry] = range
+            sheets.setdefault(index, []).append(range)
 
-        value = cell.value()
-        assert (value in self.metadata.keys), ("read_header: The spreadsheet contains an unexpected header! We got %s." % cell.value())
+        # Read the smallest range on each sheet that covers all of its headers.
+        values = {}
 
-        if value in self.unused_keys:
-            del self.unused_keys[value]
-        else:
-            warn("Duplicate header detected! We got %s" % value)
+        for (index, ranges) in sheets.iteritems():
+            start = CellReference("%s%d" % (column_name(min(range.start.column for range in ranges)), min(range.start.row for range in ranges) + 1))
+            end   = CellReference("%s%d" % (column_name(max(range.end.column   for range in ranges)), max(range.end.row   for range in ranges) + 1))
 
-        return (value, self.metadata.keys[cell.value()])
+            if cache != None:
+                sheet = cache.sheet(spreadsheet, index, workbook)
+            else:
+                sheet = workbook_sheet(spreadsheet, index, workbook)
 
+            for (r, cells) in sheet.rows(RangeReference(start, end)):
+                for cell in cells:
+                    if cell.isstring():
+                        value = cell.value()
+                        if isinstance(value, unicode):
+                            value = value.encode("utf-8")
+                        values[(index, r, cell.column)] = value
 
-    def parse_data_cell(self, cell):
+        headers = {}
 
-        assert isinstance(cell, Cell),        ("read_header: Expected cell argument to be of type 'Cell' but we got %s." % cell)
+        for (geometry, range) in resolved.iteritems():
+            index = 0
+            if range.sheet != None:
+                index = workbook.sheet(range.sheet)
 
-        (name, type)  = self.find_constructor(cell.row, cell.column)
-        value = CellValue(type, name, cell)
+            headers[geometry] = [values.get((index, r, c))
+                    for r in xrange(range.start.row, range.end.row + 1)
+                    for c in xrange(range.start.column, range.end.column + 1)]
 
-        value.check()
+        return headers
 
-        return value
 
+    # Returns a list of (score, name, metadata) tuples for the metadata in the
+    # registry whose headers have something in common with the spreadsheet,
+    # best first.
+    # The score is the number of names that the header and the metadata have
+    # in common over the number of cells in the header and names in the
+    # metadata altogether. It is 1.0 when the header names every type that
+    # the metadata declares and nothing else.
+    # If partial is False then only metadata that matches exactly is returned.
+    # cache and workbook are as for instance.
+    def match(self, spreadsheet, cache = None, workbook = None, partial = True):
 
-    # Extract the data in the spreadsheet given the metadata.
-    def extract(self, row_proc = list.append):
+        assert isinstance(spreadsheet, file), ("SchemaRegistry.match: Expected spreadsheet argument to be of type 'file' but we got %s." % spreadsheet)
 
-        # Find the sheet inside the document.
-        # For now we just use the first sheet and ignore the rest.
-        workbook = opendocument.load(self.spreadsheet)
-        try:
-            workbook.spreadsheet
+        order   = dict((name, i) for (i, name) in enumerate(self.schemas))
+        matches = {}
 
-        except NameError:
-            assert False, ("instance.extract: Workbook %s does not contain a spreadsheet!" % workbook)
+        with phase("match", schemas = len(self.schemas)) as fields:
 
-        sheets = workbook.spreadsheet.getElementsByType(Table)
-        assert (len(sheets) > 0), ("instance.extract: Workbook %s does not contain any sheets!" % workbook)
+            headers = self.read_headers(spreadsheet, cache, workbook)
 
-        sheet1 = sheets[0]
+            for (geometry, names) in headers.iteritems():
+                found = frozenset(name for name in names if name != None)
 
-        # Read the header.
-        # Get an array of cell validators of the correct type for that column or row.
-        self.header = self.parse_range(sheet1, self.metadata.header, self.parse_header_cell)
+                # Exact matches have every header cell naming a different one
+                # of the metadata's types.
+                if len(found) == len(names):
+                    for name in self.fingerprints.get(header_fingerprint(geometry, found), []):
+                        matches[name] = 1.0
 
-        # Emit warnings for any keys declared in the metadata that were not
-        # used in the spreadsheet.
-        for (key, value) in self.unused_keys.iteritems():
-            warn("Header %s of type %s was declared but not used!" % (key, value))
+                if not partial:
+                    continue
 
-        # Read the data
-        self.data = self.parse_range(sheet1, self.metadata.data, self.parse_data_cell, row_proc)
+                common = collections.defaultdict(int)
+                for key in found:
+                    for name in self.postings.get((geometry, key), []):
+                        common[name] += 1
 
-        # Now the data is in an array. We need it in a dict or something?
+                for (name, n) in common.iteritems():
+                    if name not in matches:
+                        matches[name] = float(n) / (len(names) + len(self.schemas[name].keys) - n)
 
-        return self.data
+            fields["geometries"] = len(headers)
+            fields["matches"]    = len(matches)
 
+        ranked = sorted(matches.iteritems(), key = lambda (name, score): (-score, order[name]))
+
+        return [(score, name, self.schemas[name]) for (name, score) in ranked]
+
+
+    # Returns the (name, metadata) of the metadata that matches the
+    # spreadsheet exactly or None if there isn't any. If more than one does
+    # then the one that was added first wins.
+    def find(self, spreadsheet, cache = None, workbook = None):
+
+        matches = self.match(spreadsheet, cache, workbook, partial = False)
+
+        if len(matches) == 0:
+            return None
+
+        (score, name, metadata) = matches[0]
+
+        return (name, metadata)
 
-    header = None
-    data   = None
 
 
 ###############################################################################
@@ -467,14 +5789,17 @@ class instance:
 
 class slang:
 
-    # input is a file descriptor for the metadata
-    def __init__(self, input = sys.stdin):
+    # input is a file descriptor for the metadata or the path of a .slang
+    # file. Paths are read lazily through load_state(), which keeps the
+    # compiled form of the file up to date if compile is True.
+    def __init__(self, input = sys.stdin, compile = True):
 
-        assert isinstance(input, file), ("slang.__init__: Expected input argument to be of type 'file' but we got %s." % input)
+        assert isinstance(input, (file, basestring)), ("slang.__init__: Expected input argument to be of type 'file' or 'str' but we got %s." % input)
 
         # User supplied parameters
-        self.input = input
-        self.state = None
+        self.input   = input
+        self.compile = compile
+        self.state   = None
 
         # Internal Initialisation
         self.string_extract_re        = re.compile(r"^\"(.*)\"$")
@@ -482,7 +5807,10 @@ class slang:
         self.string_unescape_re       = re.compile(r"\\\"")
         self.cell_re                  = re.compile(r"[A-Z]+[1-9][0-9]*")
         self.range_literal_re         = re.compile(r"([A-Z]+[1-9][0-9]*):([A-Z]+[1-9][0-9]*)")
-        self.range_named_re           = re.compile(r"([^!]*)!([^!]*)")
+        self.range_sheet_re           = re.compile(r"(?:'((?:[^']|'')+)'|([^!']+))!([A-Z]+[1-9][0-9]*):([A-Z]+[1-9][0-9]*)\Z")
+        # Names that look like cells, such as A3 or AB12, aren't allowed by
+        # spreadsheets so are taken to be malformed ranges rather than names.
+        self.range_named_re           = re.compile(r"(?:(?:'((?:[^']|'')+)'|([^!']+))!)?(?![A-Za-z]{1,3}[0-9]+\Z)([A-Za-z_\\][\w.]*)\Z")
 
 
     # Unescapes TAB, BACKSLASH and the C0 and C1 Control Characters.
@@ -524,6 +5852,13 @@ class slang:
         return self.types[arg]()
 
 
+    # Deserialises the name of an aggregate function and returns it.
+    def aggregate(self, arg):
+        assert (arg in aggregate_functions), ("slang.aggregate: Unknown aggregate %s." % arg)
+
+        return arg
+
+
     # Deserialises something that specifies a single cell and returns a
     # CellReference object that describes it.
     def cell(self, arg):
@@ -535,11 +5870,26 @@ class slang:
 
 
     # Deserialises something that specifies a range of cells and returns a
-    # RangeReference object that describes it.
-    # TODO: support SheetN!A3:D4
-    # TODO: Support escaped !s in sheet names and range name
+    # RangeReference object that describes it or, for named ranges, a
+    # NamedRange that will be resolved once we know the workbook.
+    # Ranges on a particular sheet look like SheetN!A3:D4. Sheet names that
+    # contain a ! or a ' must be quoted, as in 'Bob''s Sheet'!A3:D4.
+    # Named ranges look like Orders or, if they are local to a sheet,
+    # SheetN!Orders.
     def range(self, arg):
 
+        # Look for a literal range on a particular sheet
+        range = self.range_sheet_re.match(arg)
+        if (range != None):
+            if range.group(1) != None:
+                sheet = range.group(1).replace("''", "'")
+            else:
+                sheet = range.group(2)
+            sheet = sheet.decode("utf-8")
+            start = CellReference(range.group(3))
+            end   = CellReference(range.group(4))
+            return RangeReference(start, end, sheet)
+
         # Look for a literal range
         range = self.range_literal_re.match(arg)
         if (range != None):
@@ -550,9 +5900,14 @@ class slang:
         # Look for a named range
         range = self.range_named_re.match(arg)
         if (range != None):
-            assert false, ("slang.range: Named Ranges are not yet supported. We got %s." % arg)
+            sheet = range.group(1) or range.group(2)
+            if range.group(1) != None:
+                sheet = sheet.replace("''", "'")
+            if sheet != None:
+                sheet = sheet.decode("utf-8")
+            return NamedRange(range.group(3).decode("utf-8"), sheet)
 
-        assert false, ("slang.range: Invalid range specifier %s." % arg)
+        raise AssertionError("slang.range: Invalid range specifier %s." % arg)
 
 
     # Deserialises anything and returns it as-is.
@@ -595,8 +5950,30 @@ class slang:
 
         assert (self.state == None), ("slang.parse: parsing has already been done for this object!")
 
+        if isinstance(self.input, basestring):
+            self.state = load_state(self.input, self.compile)
+            return
+
         self.state = state()
 
+        with phase("parse", file = getattr(self.input, "name", None)) as fields:
+            self.parse_lines()
+            fields["types"]  = len(self.state.keys)
+            fields["tables"] = len(self.state.tables)
+
+
+    # Returns the state object for the metadata, parsing it first if that
+    # hasn't been done yet.
+    def metadata(self):
+
+        if self.state == None:
+            self.parse()
+
+        return self.state
+
+
+    def parse_lines(self):
+
         line = self.input.readline()
         line_no = 1
 
@@ -638,12 +6015,45 @@ class slang:
     # metadata and the spreadsheet match well enough.
     # The user can call validate() multiple times with a variety of
     # spreadsheets.
-    def validate(self, input):
+    # cache is an optional WorkbookCache that the instance will read the
+    # spreadsheet through.
+    def validate(self, input, cache = None, results = None):
 
         assert isinstance(input, file), ("slang.validate: Expected input argument to be of type 'file' but we got %s." % input)
-        assert self.state.validate(),   ("slang.validate: Could not validate metadata!") # Doesn't need an error message because slang.validate will make its own, more specific, assertions.
+        metadata = self.metadata()
+        assert metadata.validate(), ("slang.validate: Could not validate metadata!") # Doesn't need an error message because slang.validate will make its own, more specific, assertions.
+
+        return instance(metadata, input, cache, results = results)
+
+
+    # Checks a spreadsheet against the metadata without extracting its data
+    # and returns a list of the problems that were found, stopping after
+    # max_errors of them. See instance.check().
+    def check(self, input, max_errors = 1, cache = None, results = None):
+
+        assert isinstance(input, file), ("slang.check: Expected input argument to be of type 'file' but we got %s." % input)
+        metadata = self.metadata()
+        assert metadata.validate(), ("slang.check: Could not validate metadata!")
+
+        return instance(metadata, input, cache, results = results).check(max_errors)
+
+
+    # Checks the cached values of the formulae in a spreadsheet against their
+    # inputs and returns a list of the ones that don't match. See
+    # instance.verify_formulas().
+    def verify_formulas(self, input, cache = None):
+
+        assert isinstance(input, file), ("slang.verify_formulas: Expected input argument to be of type 'file' but we got %s." % input)
+        metadata = self.metadata()
+        assert metadata.validate(), ("slang.verify_formulas: Could not validate metadata!")
+
+        return instance(metadata, input, cache).verify_formulas()
+
 
-        return instance(self.state, input)
+    # Extract every table that the metadata declares from the spreadsheet at
+    # path. See extract_tables().
+    def extract_tables(self, path, processes = None):
+        return extract_tables(self.metadata(), path, processes)
 
 
 
@@ -666,9 +6076,10 @@ def comment(*args):
 # remaining arguments. This is useful for directives that can take a variable
 # number of arguments.
 handlers = {
-        "declare-type"   : (state.declare_type,   slang.string, slang.type),
-        "declare-header" : (state.declare_header, slang.range),
-        "declare-data"   : (state.declare_data,   slang.range),
-        "#"              : (comment,              (slang.anything,)),
+        "declare-type"      : (state.declare_type,      slang.string, slang.type),
+        "declare-header"    : (state.declare_header,    slang.range),
+        "declare-data"      : (state.declare_data,      slang.range),
+        "declare-aggregate" : (state.declare_aggregate, slang.cell, slang.aggregate, slang.string),
+        "#"                 : (comment,                 (slang.anything,)),
         }
 
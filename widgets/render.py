@@ -1,22 +1,136 @@
+import os
+import re
+import sys
+import cgi
+import itertools
 
+directory = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(directory, ".."))
+import slang
+
+# How many rows of the spreadsheet to show on each page.
+PAGE_ROWS = 100
+
+
+# Widgets are compiled into a list of (literal, field) pairs: the text up to
+# each %(field)s and the name of the field. The last field is None.
+field_re = re.compile(r"%(?:\((\w+)\)s|(%))")
+
+def compile_widget(text):
+    parts    = []
+    literal  = []
+    position = 0
+
+    for match in field_re.finditer(text):
+        literal.append(text[position:match.start()])
+        if match.group(2):
+            literal.append("%")
+        else:
+            parts.append(("".join(literal), match.group(1)))
+            literal = []
+        position = match.end()
+
+    literal.append(text[position:])
+    parts.append(("".join(literal), None))
+
+    return parts
+
+
+# Compiled widgets are kept until their file changes.
+widgets = {}
 
 def read_widget(filename):
-    widget = open(filename, "r")
-    return widget.read()
+    path   = os.path.join(directory, filename)
+    mtime  = os.stat(path).st_mtime
+    cached = widgets.get(path)
+
+    if (cached == None) or (cached[0] != mtime):
+        cached = (mtime, compile_widget(open(path, "r").read()))
+        widgets[path] = cached
 
+    return cached[1]
+
+
+# Rendering yields the page a piece at a time rather than building it up as
+# one string. The value of a field can be a string or anything that yields
+# strings, such as another widget.
 def render(widget, dictionary):
-    return widget % dictionary
+    for (literal, field) in widget:
+        yield literal
+        if field != None:
+            for chunk in flatten(dictionary[field]):
+                yield chunk
+
+def flatten(value):
+    if isinstance(value, unicode):
+        yield value.encode("utf-8")
+    elif isinstance(value, str):
+        yield value
+    else:
+        for item in value:
+            for chunk in flatten(item):
+                yield chunk
 
 def load_widget(filename):
-    widget = read_widget(filename)
-    return lambda d : render(widget, d)
+    return lambda d : render(read_widget(filename), d)
 
 def cat(*args):
-    return "".join(args)
+    return args
 
 def contents_only(widget):
     return lambda c : widget({"contents": c})
 
+def write(stream, chunks):
+    for chunk in flatten(chunks):
+        stream.write(chunk)
+
+
+# The spreadsheet widget shows a page of rows from an instance. Rows are read
+# from the spreadsheet as they are written out and reading stops at the end of
+# the page.
+currency_symbols = {u"GBP": u"\xa3"}
+
+def render_value(value):
+    (value_type, raw, currency, formula) = value.cell.raw()
+    if value_type == None:
+        return u""
+
+    try:
+        python = value.convert()
+    except ValueError:
+        return cgi.escape(unicode(raw))
+
+    if currency in currency_symbols:
+        return u"%s%.2f" % (currency_symbols[currency], python)
+
+    if isinstance(python, float) and python.is_integer():
+        python = int(python)
+
+    return cgi.escape(unicode(python))
+
+def spreadsheet_rows(instance, first, count):
+    rows = instance.iter_rows()
+    try:
+        for (i, row) in enumerate(itertools.islice(rows, first, first + count)):
+            if i == 0:
+                yield cat("\t<tr>", [u"<td><i>%s</i></td>" % cgi.escape(unicode(value.name)) for value in row], "</tr>\n")
+            yield cat("\t<tr>", [u"<td>%s</td>" % render_value(value) for value in row], "</tr>\n")
+    finally:
+        rows.close()
+
+def spreadsheet_pager(instance, first, count):
+    total = instance.metadata.data.height
+    return "Rows %d to %d of %d" % (min(first + 1, total), min(first + count, total), total)
+
+# Pages past the end show the last page rather than an empty table.
+def spreadsheet_page(instance, page_number):
+    pages = max(1, (instance.metadata.data.height + PAGE_ROWS - 1) // PAGE_ROWS)
+    first = (min(max(page_number, 1), pages) - 1) * PAGE_ROWS
+    return spreadsheet({
+        "rows"  : spreadsheet_rows(instance, first, PAGE_ROWS),
+        "pager" : spreadsheet_pager(instance, first, PAGE_ROWS)})
+
 
 page                 = load_widget("page.html")
 two_thirds_one_third = load_widget("two-thirds-one-third.html")
@@ -28,13 +142,19 @@ radio_buttons        = contents_only(load_widget("radio-buttons.html"))
 radio_item           = contents_only(load_widget("radio-item.html"))
 
 
-print \
+# Usage: python render.py [metadata.slang spreadsheet [page]]
+arguments   = sys.argv[1:]
+metadata    = slang.load(arguments[0] if len(arguments) > 0 else os.path.join(directory, "..", "poc.slang"))
+instance    = metadata.validate(open(arguments[1] if len(arguments) > 1 else os.path.join(directory, "..", "office-supplies-order.ods"), "rb"))
+page_number = int(arguments[2]) if len(arguments) > 2 else 1
+
+write(sys.stdout,
 page({"title"   : "Submit Your Spreadsheet To Treasury",
     "contents": two_thirds_one_third ({
         "heading"       : "Submit Your Spreadsheet To Treasury",
         "first_column"  : cat(
             heading_s("Select the area that contains your spending data"),
-            spreadsheet({}),
+            spreadsheet_page(instance, page_number),
             button("Save and continue")),
         "second_column" : cat(
             radio_buttons(cat(
@@ -47,5 +167,4 @@ page({"title"   : "Submit Your Spreadsheet To Treasury",
                 radio_item("Text")
                 )))
         })
-    })
-
+    }))